@@ -22,15 +22,241 @@
 '''
 Provides common encodings used in Tornado services.
 
-- JSON Encoding Extension adds support for model classes and datetimes
+- JSON Encoding Extension adds support for model classes and datetimes,
+  with interchangeable standard library and orjson backends
 - MessagePack encoding is used to store rich type information when putting
   data into Redis, etc.
 '''
 from json import JSONEncoder
-from datetime import date, time, datetime, timedelta
+import abc
+from datetime import date, time, datetime, timedelta, timezone
 from decimal import Decimal
+from msgpack import ExtType
 import msgpack
 import re
+import struct
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_decimal(obj):
+    return '{0:f}'.format(obj)
+
+
+def _json_datetime(obj):
+    return obj.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _json_date(obj):
+    return obj.strftime('%Y-%m-%d')
+
+
+def _json_time(obj):
+    return obj.strftime('%H:%M:%S')
+
+
+def _json_timedelta(obj):
+    total_s = int(obj.total_seconds())
+    hours = (total_s // 3600)
+    minutes = (total_s // 60) % 60
+    seconds = total_s % 60
+    return '{0:02}:{1:02}:{2:02}'.format(hours, minutes, seconds)
+
+
+# Handlers for the non-native types found in model fields, keyed by exact
+# type so the common case is a single dictionary lookup
+JSON_TYPE_HANDLERS = {
+    Decimal: _json_decimal,
+    datetime: _json_datetime,
+    date: _json_date,
+    time: _json_time,
+    timedelta: _json_timedelta
+}
+
+
+def json_default(obj):
+    '''
+    Return a JSON-serializable stand-in for a value the encoder doesn't know
+    about. Exact types are dispatched through JSON_TYPE_HANDLERS; anything
+    else falls back to the duck-typed checks ModelJSONEncoder has always
+    made, so datetime-like objects from other libraries still work.
+    '''
+    handler = JSON_TYPE_HANDLERS.get(type(obj))
+
+    if handler is not None:
+        return handler(obj)
+    elif hasattr(obj, 'public_dict'):
+        return obj.public_dict
+    elif isinstance(obj, Decimal):
+        return _json_decimal(obj)
+    elif hasattr(obj, 'strftime'):
+        if hasattr(obj, 'year') and hasattr(obj, 'hour'):
+            return _json_datetime(obj)
+        elif hasattr(obj, 'year'):
+            return _json_date(obj)
+        else:
+            return _json_time(obj)
+    elif hasattr(obj, 'total_seconds'):
+        # obj looks like a timedelta
+        return _json_timedelta(obj)
+
+    raise TypeError('Object of type {0} is not JSON serializable'.format(
+        type(obj).__name__))
+
+
+class ModelSerializer(object):
+    '''
+    Converts the rich values in rows of one model class ahead of encoding,
+    so a list of models can be handed to an encoder that never has to call
+    back into Python for them.
+
+    The converter for each key is picked from `handlers` (a mapping of type
+    to conversion function) using the type of the value in the first row.
+    Later rows only have those keys checked: a value of the learned type is
+    converted directly, a value of any other type is looked up again, and
+    keys that were None so far are learned as soon as they hold a value.
+    Values that aren't converted here are left for the encoder's default
+    hook, so the output is the same either way.
+    '''
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self._plan = None
+
+    def _converter(self, kind):
+        '''
+        Return the handler for a type, or None if it doesn't need one
+        '''
+        convert = self.handlers.get(kind)
+
+        if convert is None and kind not in NATIVE_TYPES:
+            for cls, handler in self.handlers.items():
+                if issubclass(kind, cls):
+                    return handler
+
+        return convert
+
+    def _learn(self, row, plan=None):
+        '''
+        Add converters for the keys of row that hold values to the plan
+        '''
+        converters, pending = plan or ((), tuple(row))
+        converters = list(converters)
+        unresolved = []
+
+        for key in pending:
+            value = row.get(key)
+
+            if value is None:
+                unresolved.append(key)
+                continue
+
+            convert = self._converter(type(value))
+
+            if convert is not None:
+                converters.append((key, type(value), convert))
+
+        self._plan = plan = (tuple(converters), tuple(unresolved))
+        return plan
+
+    def convert(self, row):
+        '''
+        Return a copy of a dictionary with its rich values converted
+        '''
+        converters, pending = self._plan or self._learn(row)
+        source, row = row, dict(row)
+
+        for key, kind, convert in converters:
+            value = row.get(key)
+
+            if type(value) is kind:
+                row[key] = convert(value)
+            elif value is not None:
+                convert = self._converter(type(value))
+
+                if convert is not None:
+                    row[key] = convert(value)
+
+        if pending:
+            for key in pending:
+                if source.get(key) is not None:
+                    # The conversion above left these keys alone, so
+                    # convert the row again with the wider plan
+                    self._learn(source, self._plan)
+                    return self.convert(source)
+
+        return row
+
+    def convert_all(self, rows):
+        '''
+        Return a list of converted copies of an iterable of dictionaries
+        '''
+        convert = self.convert
+        return [convert(row) for row in rows]
+
+
+NATIVE_TYPES = frozenset([str, int, float, bool, list, tuple, dict])
+
+_json_serializers = {}
+
+
+def json_serializer(model_class):
+    '''
+    Return the shared serializer for a model class's public_dict
+    '''
+    serializer = _json_serializers.get(model_class)
+
+    if serializer is None:
+        serializer = _json_serializers.setdefault(
+            model_class, ModelSerializer(JSON_TYPE_HANDLERS))
+
+    return serializer
+
+
+def _model_list_class(obj):
+    '''
+    Return the class of the models in a list if they all share one class
+    with a public_dict, otherwise None
+    '''
+    if not isinstance(obj, list) or not obj:
+        return None
+
+    model_class = type(obj[0])
+
+    if not hasattr(model_class, 'public_dict'):
+        return None
+
+    for item in obj:
+        if type(item) is not model_class:
+            return None
+
+    return model_class
+
+
+def _json_model_list(obj):
+    model_class = _model_list_class(obj)
+
+    if model_class is None:
+        return obj
+
+    return json_serializer(model_class).convert_all(
+        item.public_dict for item in obj)
+
+
+def compile_model_lists(obj):
+    '''
+    Replace lists of models of a single class, at the top level or as
+    values of a top-level dictionary, with lists of their converted public
+    dictionaries
+    '''
+    if isinstance(obj, dict):
+        return {key: _json_model_list(val) for key, val in obj.items()}
+
+    return _json_model_list(obj)
 
 
 class ModelJSONEncoder(JSONEncoder):
@@ -42,113 +268,323 @@ class ModelJSONEncoder(JSONEncoder):
     def default(self, obj):
         # pylint: disable=method-hidden
         '''
-        Use the default behavior unless the object is a datetime object
-        (identified by the presence of the strftime attribute) or a model
-        object (identified by the presence of a public_dict attribute)
+        Use the default behavior unless the object is a decimal, a datetime
+        object, or a model object (see json_default)
         '''
+        return json_default(obj)
 
-        if isinstance(obj, Decimal):
-            return '{0:f}'.format(obj)
-        elif hasattr(obj, 'strftime'):
-            if hasattr(obj, 'year') and hasattr(obj, 'hour'):
-                format = '%Y-%m-%dT%H:%M:%SZ'
-            elif hasattr(obj, 'year'):
-                format = '%Y-%m-%d'
-            else:
-                format = '%H:%M:%S'
-
-            return obj.strftime(format)
-        elif hasattr(obj, 'total_seconds'):
-            # obj looks like a timedelta
-            total_s = int(obj.total_seconds())
-            hours = (total_s // 3600)
-            minutes = (total_s // 60) % 60
-            seconds = total_s % 60
-            return '{0:02}:{1:02}:{2:02}'.format(hours, minutes, seconds)
-        elif hasattr(obj, 'public_dict'):
-            return obj.public_dict
-        else:
-            return JSONEncoder.default(self, obj)
+
+class JSONBackend(abc.ABC):
+    '''
+    Base class for JSON backends. Subclasses set `name` and the
+    `item_separator` their arrays use, and implement encode; dumps runs
+    lists of models through their compiled serializers first.
+    '''
+
+    name = None
+    item_separator = None
+
+    @abc.abstractmethod
+    def encode(self, obj):
+        '''
+        Encode an object whose model lists have been compiled as a UTF-8
+        JSON byte string
+        '''
+
+    def dumps(self, obj):
+        '''
+        Encode obj as a UTF-8 JSON byte string
+        '''
+        return self.encode(compile_model_lists(obj))
+
+
+class StandardJSONBackend(JSONBackend):
+    '''
+    JSON backend built on the standard library's json module. Its output is
+    exactly what `json.dumps(obj, cls=ModelJSONEncoder)` has always written:
+    ASCII with escaped non-ASCII characters, a space after separators, and
+    NaN and infinity as the bare `NaN` and `Infinity` tokens.
+    '''
+
+    name = 'json'
+    item_separator = b', '
+
+    def __init__(self):
+        self._encoder = ModelJSONEncoder()
+
+    def encode(self, obj):
+        return self._encoder.encode(obj).encode('utf-8')
+
+
+class OrjsonJSONBackend(JSONBackend):
+    '''
+    JSON backend built on orjson. Its output is compact UTF-8 rather than
+    the standard library's spaced ASCII, but it decodes to the same values:
+    datetimes are passed through to json_default rather than formatted by
+    orjson, and integers wider than 64 bits, which orjson rejects, make the
+    whole value fall back to the standard library.
+
+    The one difference in meaning is that NaN and infinity are written as
+    `null` (as JavaScript's JSON.stringify does) instead of the invalid
+    tokens the standard library writes. Floats in exponent notation are
+    spelled differently (`1e16` vs `1e+16`) but have the same value.
+    '''
+
+    name = 'orjson'
+    item_separator = b','
+
+    def __init__(self):
+        if orjson is None:
+            raise ValueError('orjson is not installed')
+
+        self._options = (orjson.OPT_PASSTHROUGH_DATETIME |
+                         orjson.OPT_NON_STR_KEYS)
+        self._fallback = StandardJSONBackend()
+
+    def encode(self, obj):
+        try:
+            return orjson.dumps(
+                obj, default=json_default, option=self._options)
+        except orjson.JSONEncodeError:
+            # Raises TypeError itself if the value really can't be encoded
+            return self._fallback.encode(obj)
+
+
+JSON_BACKENDS = {
+    StandardJSONBackend.name: StandardJSONBackend,
+    OrjsonJSONBackend.name: OrjsonJSONBackend
+}
+
+_json_backends = {}
+
+
+def get_json_backend(name=None):
+    '''
+    Return the shared instance of the named JSON backend. With no name, use
+    the standard library; with 'auto', use orjson if it's installed.
+    '''
+    if name is None:
+        name = StandardJSONBackend.name
+    elif name == 'auto':
+        name = OrjsonJSONBackend.name if orjson else StandardJSONBackend.name
+
+    backend = _json_backends.get(name)
+
+    if backend is None:
+        if name not in JSON_BACKENDS:
+            raise ValueError('unknown JSON backend {0!r}'.format(name))
+
+        backend = _json_backends.setdefault(name, JSON_BACKENDS[name]())
+
+    return backend
+
+
+EXT_DATETIME = 1
+EXT_DATE = 2
+EXT_TIME = 3
+EXT_TIMEDELTA = 4
+EXT_DECIMAL = 5
 
 
 class MessagePackEncoder(object):
     '''
-    Wrapper for MessagePack to build
+    Wrapper for MessagePack that adds support for the datetime, date, time,
+    timedelta, and Decimal values found in model fields. They're packed as
+    ExtType values with fixed-width binary payloads, so nothing has to be
+    formatted or parsed as a string. Values written by older versions, which
+    wrapped these types in `{'__type__': ..., '__repr__': ...}` maps, can
+    still be decoded.
+
+    Encoders keep one `msgpack.Packer` per thread and reuse it for every
+    call, and one ModelSerializer per model class for model_fields.
     '''
 
+    # year, month, day, hour, minute, second, microsecond
+    _DATETIME = struct.Struct('>HBBBBBI')
+    # year, month, day
+    _DATE = struct.Struct('>HBB')
+    # hour, minute, second, microsecond
+    _TIME = struct.Struct('>BBBI')
+    # days, seconds, microseconds
+    _TIMEDELTA = struct.Struct('>iII')
+    # UTC offset in seconds, appended to the payload of aware datetimes and
+    # times
+    _OFFSET = struct.Struct('>i')
+
+    _LEGACY_TYPES = {
+        'datetime': lambda x: datetime.strptime(x, '%Y-%m-%dT%H:%M:%S.%fZ'),
+        'date': lambda x: datetime.strptime(x, '%Y-%m-%d').date(),
+        'time': lambda x: datetime.strptime(x, '%H:%M:%S.%fZ').time(),
+        'timedelta': lambda x: timedelta(seconds=x),
+        'decimal': Decimal
+    }
+
+    def __init__(self):
+        '''
+        Create a new encoder instance.
+        '''
+        self.hooks = None
+        self._local = threading.local()
+        self._encoders = {
+            datetime: self._encode_datetime,
+            date: self._encode_date,
+            time: self._encode_time,
+            timedelta: self._encode_timedelta,
+            Decimal: self._encode_decimal
+        }
+        self._decoders = {
+            EXT_DATETIME: self._decode_datetime,
+            EXT_DATE: self._decode_date,
+            EXT_TIME: self._decode_time,
+            EXT_TIMEDELTA: self._decode_timedelta,
+            EXT_DECIMAL: self._decode_decimal
+        }
+        self._serializers = {}
+        self._unpack_options = dict(
+            raw=False,
+            use_list=False,
+            strict_map_key=False,
+            ext_hook=self._ext_decode,
+            object_hook=self._legacy_decode
+        )
+
+    def _offset(self, obj):
+        '''
+        Return the packed UTC offset of an aware datetime or time, or an
+        empty string if it's naive
+        '''
+        offset = obj.utcoffset()
+
+        if offset is None:
+            return b''
+
+        return self._OFFSET.pack(int(offset.total_seconds()))
+
+    def _timezone(self, data, size):
+        '''
+        Return the timezone packed after the first `size` bytes of a payload
+        '''
+        if len(data) == size:
+            return None
+
+        seconds, = self._OFFSET.unpack_from(data, size)
+        return timezone(timedelta(seconds=seconds))
+
+    def _encode_datetime(self, obj):
+        return ExtType(EXT_DATETIME, self._DATETIME.pack(
+            obj.year, obj.month, obj.day, obj.hour, obj.minute, obj.second,
+            obj.microsecond) + self._offset(obj))
+
+    def _encode_date(self, obj):
+        return ExtType(EXT_DATE, self._DATE.pack(obj.year, obj.month, obj.day))
+
+    def _encode_time(self, obj):
+        return ExtType(EXT_TIME, self._TIME.pack(
+            obj.hour, obj.minute, obj.second, obj.microsecond) + self._offset(obj))
+
+    def _encode_timedelta(self, obj):
+        return ExtType(EXT_TIMEDELTA, self._TIMEDELTA.pack(
+            obj.days, obj.seconds, obj.microseconds))
+
+    def _encode_decimal(self, obj):
+        return ExtType(EXT_DECIMAL, str(obj).encode('ascii'))
+
+    def _decode_datetime(self, data):
+        tzinfo = self._timezone(data, self._DATETIME.size)
+        return datetime(*self._DATETIME.unpack_from(data), tzinfo=tzinfo)
+
+    def _decode_date(self, data):
+        return date(*self._DATE.unpack(data))
+
+    def _decode_time(self, data):
+        tzinfo = self._timezone(data, self._TIME.size)
+        return time(*self._TIME.unpack_from(data), tzinfo=tzinfo)
+
+    def _decode_timedelta(self, data):
+        days, seconds, microseconds = self._TIMEDELTA.unpack(data)
+        return timedelta(days=days, seconds=seconds, microseconds=microseconds)
+
+    def _decode_decimal(self, data):
+        return Decimal(data.decode('ascii'))
+
     def _object_encode(self, obj):
-        if isinstance(obj, Decimal):
-            return {
-                '__type__': 'decimal',
-                '__repr__': str(obj)
-            }
-        elif hasattr(obj, 'strftime'):
-            # datetime, date, and time all have a strftime method,
-            # so we need to go deeper.
-            if hasattr(obj, 'year') and hasattr(obj, 'hour'):
-                # datetime has both year and hour
-                return {
-                    '__type__': 'datetime',
-                    '__repr__': obj.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-                }
-            elif hasattr(obj, 'year'):
-                # date has a year
-                return {
-                    '__type__': 'date',
-                    '__repr__': obj.strftime('%Y-%m-%d')
-                }
+        '''
+        Return an ExtType for a value msgpack doesn't know how to pack
+        '''
+        encoder = self._encoders.get(type(obj))
+
+        if encoder is None:
+            # Subclasses are rare enough to take the slow path. Check
+            # datetime before date, since datetime is a subclass of date.
+            for cls in (datetime, date, time, timedelta, Decimal):
+                if isinstance(obj, cls):
+                    encoder = self._encoders[cls]
+                    break
             else:
-                # I guess time is all that's left
-                return {
-                    '__type__': 'time',
-                    '__repr__': obj.strftime('%H:%M:%S.%fZ')
-                }
-        elif hasattr(obj, 'total_seconds'):
-            # obj looks like a timedelta
-            return {
-                '__type__': 'timedelta',
-                '__repr__': obj.total_seconds()
-            }
-        else:
-            return obj
+                raise TypeError('cannot serialize {0!r}'.format(obj))
 
-    def _object_decode(self, obj):
+        return encoder(obj)
+
+    def _ext_decode(self, code, data):
+        '''
+        Decode an ExtType payload, passing unknown types through untouched
+        '''
+        decoder = self._decoders.get(code)
+
+        if decoder is None:
+            return ExtType(code, data)
+
+        return decoder(data)
+
+    def _legacy_decode(self, obj):
+        '''
+        Decode the maps older versions used to wrap rich types
+        '''
         type = obj.get('__type__', None)
 
-        typemap = {
-            'datetime': lambda x: datetime.strptime(x['__repr__'], "%Y-%m-%dT%H:%M:%S.%fZ"),
-            'date': lambda x: date.strptime(x['__repr__'], "%Y-%m-%d"),
-            'time': lambda x: time.strptime(x['__repr__'], "%H:%M:%S.%fZ"),
-            'timedelta': lambda x: timedelta(seconds=x['__repr__']),
-            'decimal': lambda x: Decimal(x['__repr__']),
-            None: lambda x: x
-        }
+        if type is None:
+            return obj
 
-        return typemap[type](obj)
+        return self._LEGACY_TYPES[type](obj['__repr__'])
 
-    def __init__(self):
+    def model_fields(self, model):
         '''
-        Create a new encoder instance.
+        Return a copy of a model's fields with rich values already converted
+        to ExtTypes by the model class's compiled serializer
         '''
-        self.hooks = None
+        model_class = type(model)
+        serializer = self._serializers.get(model_class)
+
+        if serializer is None:
+            serializer = self._serializers.setdefault(
+                model_class, ModelSerializer(self._encoders))
+
+        return serializer.convert(model.fields)
+
+    def _packer(self):
+        '''
+        Return this thread's packer
+        '''
+        packer = getattr(self._local, 'packer', None)
+
+        if packer is None:
+            packer = self._local.packer = msgpack.Packer(
+                use_bin_type=True, default=self._object_encode)
+
+        return packer
 
     def encode(self, obj):
         '''
         Encode an object as a MessagePack byte string
         '''
-        return msgpack.packb(obj, use_bin_type=True, default=self._object_encode)
+        return self._packer().pack(obj)
 
     def decode(self, str):
         '''
         Decode a MessagePack-encoded byte string into
         an instance of the appropriate type.
         '''
-        kwargs = dict(
-            encoding='utf-8',
-            use_list=False,
-            object_hook=self._object_decode
-        )
-        return msgpack.unpackb(str, **kwargs)
+        return msgpack.unpackb(str, **self._unpack_options)
 
 def urlify(unused_handler, string):
     '''Return a string that has been munged to remove URL-unfriendly
@@ -29,6 +29,7 @@ from json.decoder import JSONDecodeError
 import decimal
 import logging
 import functools
+import itertools
 
 
 try:
@@ -36,12 +37,17 @@ try:
 except ImportError:
     import urlparse as parse
 
-from f5.encoding import ModelJSONEncoder
+from f5.encoding import MessagePackEncoder, get_json_backend
 from f5.dispatch import multimethod
+from f5.services import Seek
+from tornado.ioloop import IOLoop
 from tornado.web import RequestHandler, HTTPError, MissingArgumentError
+from tornado.web import decode_signed_value
 
 ARG_DEFAULT = []
 
+_cursor_encoder = MessagePackEncoder()
+
 
 def authenticated(method):
     pass
@@ -111,6 +117,11 @@ class BaseRequestHandler(RequestHandler):
 
     ALLOWED_ORIGINS = [r'.*']
 
+    # Set to True in a subclass to give each request its own identity map,
+    # so a model loaded more than once in a request is only fetched once
+    # and is the same instance every time
+    use_identity_map = False
+
     def get_implemented_methods(self):
         method_list = ['OPTIONS']
 
@@ -156,11 +167,23 @@ class BaseRequestHandler(RequestHandler):
         self.object_store = kwargs.get('object_store', None)
         self.kv_store = kwargs.get('kv_store', None)
 
+        if self.use_identity_map and self.object_store is not None:
+            self.object_store = self.object_store.with_identity_map()
+
         if hasattr(self, 'initialize_delegate'):
             # pylint: disable=no-member
             # We explicitly checked for it!
             self.initialize_delegate(**kwargs)
 
+    def on_finish(self):
+        '''
+        Discard the request's identity map
+        '''
+        identity_map = getattr(self.object_store, 'identity_map', None)
+
+        if self.use_identity_map and identity_map is not None:
+            identity_map.clear()
+
     def prepare(self):
         '''
         Prepare the request
@@ -210,9 +233,53 @@ class BaseRequestHandler(RequestHandler):
 
         return value
 
-    def build_url(self, path, params=None, query=None):
+    CURSOR_MAX_AGE_DAYS = 7
+
+    def create_cursor(self, model, sort='id', ascending=True):
+        '''
+        Return an opaque, signed token for the keyset page that starts after
+        `model` in the given sort order. Signing uses the application's
+        cookie_secret setting.
+        '''
+        payload = _cursor_encoder.encode(
+            [sort, bool(ascending), model[sort], model['id']])
+        return self.create_signed_value('cursor', payload).decode('ascii')
+
+    def decode_cursor(self, token, sort='id', ascending=True):
+        '''
+        Return the (sort value, id) pair from a cursor token made by
+        create_cursor for the same sort order. Raises an HTTP 400 error if
+        the token is forged, expired, or made for a different sort.
+        '''
+        self.require_setting('cookie_secret', 'pagination cursors')
+        payload = decode_signed_value(
+            self.application.settings['cookie_secret'], 'cursor', token,
+            max_age_days=self.CURSOR_MAX_AGE_DAYS)
+
+        if payload is None:
+            raise HTTPError(400, 'invalid cursor')
+
+        cursor_sort, cursor_ascending, sort_value, item_id = \
+            _cursor_encoder.decode(payload)
+
+        if cursor_sort != sort or cursor_ascending != bool(ascending):
+            raise HTTPError(400, 'cursor does not match the sort order')
+
+        return (sort_value, item_id)
+
+    def get_seek(self, limit, sort='id', ascending=True, name='cursor'):
+        '''
+        Return a Seek for the page named by the cursor query argument, or
+        for the first page if there isn't one
         '''
-        Format the URL
+        token = self.get_argument(name, None)
+        after = self.decode_cursor(token, sort, ascending) if token else None
+        return Seek(limit, after)
+
+    def build_url(self, path, params=None, query=None, cursor=None):
+        '''
+        Format the URL. If a cursor token is given, it's added to the query
+        string as the `cursor` argument.
         '''
         if query is None:
             query = {}
@@ -224,12 +291,17 @@ class BaseRequestHandler(RequestHandler):
         elif isinstance(params, list):
             path = path.format(*params)
 
+        arguments = ['{0}={1}'.format(key, val) for key, val in query.items()]
+
+        if cursor is not None:
+            arguments.append('cursor={0}'.format(parse.quote(cursor, safe='')))
+
         return parse.urlunparse((
             self.request.protocol,
             self.request.host,
             '/'.join(x.strip('/') for x in [prefix, path]).strip('/'),
             '',
-            '&'.join('{0}={1}'.format(key, val) for key, val in query.items()),
+            '&'.join(arguments),
             ''
         ))
 
@@ -261,10 +333,10 @@ class JSONRequestHandler(BaseRequestHandler):
     '''
     # pylint: disable=abstract-method,too-many-public-methods
 
-    def __init__(self, *args, **kwargs):
-        super(JSONRequestHandler, self).__init__(*args, **kwargs)
-        self._jsonp_pattern = None
-        self._jsonp_callback = None
+    # These are class attributes rather than being set in __init__ because
+    # RequestHandler.__init__ calls initialize, which sets the callback
+    _jsonp_pattern = None
+    _jsonp_callback = None
 
     def _jsonp_callback_sanitize(self, callback_string):
         '''
@@ -275,7 +347,7 @@ class JSONRequestHandler(BaseRequestHandler):
             import re
             self._jsonp_pattern = re.compile(r'[a-zA-Z][a-zA-Z0-9_]{,50}')
 
-        match = self._jsonp_pattern.match(callback_string)
+        match = self._jsonp_pattern.fullmatch(callback_string)
 
         if match:
             return callback_string
@@ -284,6 +356,28 @@ class JSONRequestHandler(BaseRequestHandler):
 
     def initialize(self, **kwargs):
         super(JSONRequestHandler, self).initialize(**kwargs)
+
+        config = self.application.configuration['tornado']
+        self.json_backend = get_json_backend(config.get('json_backend'))
+
+        if config.get('debug', False) is True:
+            logging.info(self.request.utf_query_arguments)
+
+    def utf_get_argument(self, name, default=ARG_DEFAULT):
+        "retrieve utf-8 encoded argument"
+        raise NotImplementedError('this is goofy')
+
+    def compute_etag(self):
+        "Override Tornado's default etag support"
+        return None
+
+    def prepare(self):
+        '''
+        Read the JSONP callback, if any. (This happens here rather than in
+        `initialize` so that an invalid callback gets a 400 response, and
+        before the superclass's prepare so that nothing runs for a request
+        with one.)
+        '''
         callback = None
 
         if self.get_argument('jsonp', None):
@@ -299,20 +393,9 @@ class JSONRequestHandler(BaseRequestHandler):
 
             self._jsonp_callback = callback
 
-        if self.application.configuration['tornado'].get('debug', False) is True:
-            logging.info(self.request.utf_query_arguments)
-
-    def utf_get_argument(self, name, default=ARG_DEFAULT):
-        "retrieve utf-8 encoded argument"
-        raise NotImplementedError('this is goofy')
-
-    def compute_etag(self):
-        "Override Tornado's default etag support"
-        return None
-
-    def write_json(self, obj, mimetype=ARG_DEFAULT):
-        "Writes the JSON-stringified value of obj to the response stream"
+        super(JSONRequestHandler, self).prepare()
 
+    def _set_json_content_type(self, mimetype=ARG_DEFAULT):
         if self._jsonp_callback:
             self.set_header('Content-Type', 'application/javascript')
         elif mimetype is not ARG_DEFAULT:
@@ -320,11 +403,101 @@ class JSONRequestHandler(BaseRequestHandler):
         else:
             self.set_header('Content-Type', 'application/json; charset=UTF-8')
 
+    def _jsonp_prefix(self):
+        return b''.join([
+            b'/*_*/', self._jsonp_callback.encode('utf-8'), b'('])
+
+    def write_json(self, obj, mimetype=ARG_DEFAULT):
+        "Writes the JSON-stringified value of obj to the response stream"
+
+        self._set_json_content_type(mimetype)
+
         # TODO: Cache management using Etag and If-None-Match headers
 
-        response = json.dumps(obj, cls=ModelJSONEncoder)
+        response = self.json_backend.dumps(obj)
 
         if self._jsonp_callback:
-            response = '/*_*/{0}({1});'.format(self._jsonp_callback, response)
+            response = b''.join([self._jsonp_prefix(), response, b');'])
 
         self.write(response)
+
+    STREAM_BATCH_SIZE = 100
+    STREAM_CHUNK_SIZE = 64 * 1024
+
+    async def write_json_stream(self, items, mimetype=ARG_DEFAULT,
+                                batch_size=None, chunk_size=None):
+        '''
+        Write a JSON array of the values produced by an iterable (or async
+        iterable) without holding the whole response in memory. Values are
+        encoded `batch_size` at a time, so lists of models still go through
+        their compiled serializers, and the response is flushed to the
+        client whenever at least `chunk_size` bytes are buffered. A plain
+        iterable is read on the IOLoop's executor so that it can block (as
+        `ObjectStore.iter_models_in_range` does) without stalling the loop.
+
+        Headers go out with the first chunk, so an exception raised by the
+        iterable part of the way through can't change the status code; the
+        connection is closed with a truncated body instead.
+        '''
+        batch_size = batch_size or self.STREAM_BATCH_SIZE
+        chunk_size = chunk_size or self.STREAM_CHUNK_SIZE
+        dumps = self.json_backend.dumps
+        item_separator = self.json_backend.item_separator
+
+        self._set_json_content_type(mimetype)
+
+        chunk = [self._jsonp_prefix()] if self._jsonp_callback else []
+        chunk.append(b'[')
+        buffered = 0
+        separator = b''
+
+        async for batch in _batches(items, batch_size):
+            # Each batch encodes as a complete array; splice the arrays
+            # together by dropping their brackets
+            encoded = dumps(batch)[1:-1]
+            chunk.extend((separator, encoded))
+            buffered += len(separator) + len(encoded)
+            separator = item_separator
+
+            if buffered >= chunk_size:
+                self.write(b''.join(chunk))
+                await self.flush()
+                chunk = []
+                buffered = 0
+
+        chunk.append(b']);' if self._jsonp_callback else b']')
+        self.write(b''.join(chunk))
+        await self.flush()
+
+
+async def _batches(items, size):
+    '''
+    Yield lists of up to size values from an iterable or async iterable. A
+    plain iterable is read on the IOLoop's default executor, a batch at a
+    time, since producing its values (from a server-side cursor, say) may
+    block.
+    '''
+    if hasattr(items, '__aiter__'):
+        batch = []
+
+        async for item in items:
+            batch.append(item)
+
+            if len(batch) >= size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+    else:
+        iterator = iter(items)
+        io_loop = IOLoop.current()
+
+        while True:
+            batch = await io_loop.run_in_executor(
+                None, list, itertools.islice(iterator, size))
+
+            if not batch:
+                break
+
+            yield batch
@@ -53,7 +53,7 @@ Examples:
         # -> set(['bar_name'])
         ```
 '''
-from collections import Callable, defaultdict
+from collections import defaultdict
 from hashlib import sha1
 import base64
 import json
@@ -65,18 +65,60 @@ import logging
 SENTINEL = []
 
 
+class CachePolicy(object):
+    '''
+    Describes how the object store caches instances of a model class.
+
+    Attributes:
+        ttl: the number of seconds objects stay in the cache, or None to use
+            the cache's default TTL
+        enabled: if False, objects of this class are never cached
+        write_through: if True, creating or updating an object writes its new
+            values to the cache. If False, it just evicts the cached copy and
+            the next read repopulates it.
+        negative_ttl: if set, lookups of ids that don't exist are remembered
+            for this many seconds so repeated misses don't hit the database
+        count_ttl: if set, counts of objects of this class are cached for
+            up to this many seconds, or until the object store writes to
+            one of the tables they were counted from
+        query_ttl: if set, the ids returned by `models_matching_filter`
+            are cached the same way, and the objects loaded from them
+    '''
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, ttl=None, enabled=True, write_through=True,
+                 negative_ttl=None, count_ttl=None, query_ttl=None):
+        self.ttl = ttl
+        self.enabled = enabled
+        self.write_through = write_through
+        self.negative_ttl = negative_ttl
+        self.count_ttl = count_ttl
+        self.query_ttl = query_ttl
+
+
 class Model(object):
     '''
     Model instances are either returned populated from service classes or
     are created by the application and then saved by the service. The model
     maintains a set of fields that have been modified so that updating an
     object in the data store only modifies the changed fields.
+
+    By default the object store re-reads each new row after inserting it to
+    pick up the values the database filled in. A model class that declares
+    its `server_defaults` avoids that extra query: set it to a dictionary of
+    column names to default values (or to callables returning them), or to
+    'schema' to have the object store look the defaults up once from
+    information_schema. Declared values are cached as the row's values, so
+    they have to match what the database stores exactly; tables with
+    CURRENT_TIMESTAMP or other expression defaults should leave this unset.
     '''
     columns = ['id']
     table_name = None
     link_name = None
     service = None
     select_transform = {}
+    cache_policy = CachePolicy()
+    server_defaults = None
 
     def __init__(self, fields=None):
         if fields is None:
@@ -29,15 +29,35 @@ Handles database querying, saving, updating, deleting, etc.
 # from f5.storage import Database
 from f5.models import Model
 from f5.dispatch import multimethod
+from f5.storage import MISSING, SingleFlight
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from collections import namedtuple
+from decimal import Decimal
+from collections import deque, namedtuple
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.locks import Semaphore
+import atexit
+import copy
+import functools
+import hashlib
+import itertools
+import os
 import re
 import logging
+import tempfile
+import threading
+import time
+import weakref
 
 
 # Options = namedtuple('Options', 'present absent')
 Bounds = namedtuple('Bounds', ['limit', 'offset'])
 
+# Keyset pagination: return up to `limit` rows that sort after `after`, the
+# (sort value, id) pair of the last row of the previous page, or from the
+# start if `after` is None
+Seek = namedtuple('Seek', ['limit', 'after'])
+
 
 def build_select_expression(columns, transform, alias=None):
     '''
@@ -60,6 +80,675 @@ def build_select_expression(columns, transform, alias=None):
     return ', '.join(transform_col(col) for col in columns).format(alias)
 
 
+def build_seek_condition(sort, id_column, ascending, after):
+    '''
+    Returns a MySQL condition selecting the rows that come after the
+    (sort value, id) pair `after` in (sort, id) order, and its parameters.
+    The row comparison is written out longhand because MySQL won't use an
+    index for `(a, b) > (x, y)`. Rows with NULL sort values can't be paged
+    through this way.
+    '''
+    if after is None:
+        return None, []
+
+    sort_value, last_id = after
+    op = '>' if ascending else '<'
+
+    if sort == id_column:
+        return '{0} {1} %s'.format(id_column, op), [last_id]
+
+    return '({0} {2} %s OR ({0} = %s AND {1} {2} %s))'.format(
+        sort, id_column, op), [sort_value, sort_value, last_id]
+
+
+class IdentityMap(object):
+    '''
+    Holds the one model instance loaded for each (table, id) in a unit of
+    work, usually a request. See `ObjectStore.with_identity_map`.
+    '''
+
+    def __init__(self):
+        self._models = {}
+
+    @staticmethod
+    def _key(model_class, id):
+        return (model_class.table_name, str(id))
+
+    def get(self, model_class, id):
+        '''
+        Return the instance for an id, or None if it hasn't been loaded
+        '''
+        return self._models.get(self._key(model_class, id))
+
+    def add(self, model):
+        '''
+        Return the instance already held for a loaded model's id, holding on
+        to the model if there isn't one
+        '''
+        return self._models.setdefault(self._key(type(model), model.id), model)
+
+    def put(self, model):
+        '''
+        Hold on to a model that was just written, replacing any other
+        instance for its id
+        '''
+        self._models[self._key(type(model), model.id)] = model
+
+    def discard(self, model):
+        '''
+        Forget the instance for a model's id
+        '''
+        self._models.pop(self._key(type(model), model.id), None)
+
+    def clear(self):
+        self._models.clear()
+
+    def __len__(self):
+        return len(self._models)
+
+
+class UnitOfWork(object):
+    '''
+    Collects creates, updates, and deletes and writes them together when
+    the block exits: one transaction on one connection with a multi-row
+    INSERT per table, a single UPDATE per table, and a single DELETE per
+    table, followed by one redis pipeline for all the cache maintenance.
+
+    ```
+    with object_store.unit_of_work() as work:
+        work.create(order)
+        work.update(customer)
+        work.delete(cart)
+    ```
+
+    Nothing is written if the block raises. The models are changed in place
+    once the transaction commits: created models get their ids and column
+    defaults, and every written model is marked clean. In a coroutine, use
+    `async with` on `AsyncObjectStore.unit_of_work()` to commit on its
+    executor.
+    '''
+
+    def __init__(self, object_store, executor=None):
+        self.object_store = object_store
+        self.executor = executor
+        self.creates = []
+        self.updates = []
+        self.deletes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, unused_value, unused_traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, unused_value, unused_traceback):
+        if exc_type is None:
+            await IOLoop.current().run_in_executor(self.executor, self.commit)
+        else:
+            self.discard()
+
+    @staticmethod
+    def _contains(models, model):
+        return any(item is model for item in models)
+
+    def create(self, model):
+        '''
+        Insert a new model when the work is committed
+        '''
+        if not self._contains(self.creates, model):
+            self.creates.append(model)
+
+    def update(self, model, set_date_modified=True):
+        '''
+        Write a model's modified fields when the work is committed
+        '''
+        if not model.is_dirty:
+            return
+
+        if set_date_modified and 'date_modified' in model:
+            model['date_modified'] = datetime.now()
+
+        # A model created in the same unit of work is inserted with all of
+        # its fields, so it doesn't need an update as well
+        if not self._contains(self.creates + self.updates, model):
+            self.updates.append(model)
+
+    def delete(self, model):
+        '''
+        Delete a model, or mark it deleted, when the work is committed
+        '''
+        if 'date_deleted' in model:
+            model['date_deleted'] = datetime.now()
+            self.update(model)
+        elif self._contains(self.creates, model):
+            # It was never inserted, so there's nothing to delete
+            self.creates = [item for item in self.creates if item is not model]
+        elif not self._contains(self.deletes, model):
+            self.updates = [item for item in self.updates if item is not model]
+            self.deletes.append(model)
+
+    def discard(self):
+        '''
+        Forget the pending writes
+        '''
+        self.creates = []
+        self.updates = []
+        self.deletes = []
+
+    def commit(self):
+        '''
+        Write everything in one transaction and update the cache
+        '''
+        creates, updates, deletes = self.creates, self.updates, self.deletes
+        self.discard()
+
+        if not (creates or updates or deletes):
+            return
+
+        store = self.object_store
+
+        with store.datastores['mysql_write'] as (conn, cursor):
+            defaults = {
+                model_class: store.server_defaults(model_class, cursor)
+                for model_class in set(type(model) for model in creates)
+            }
+            ids = self._insert(cursor, creates)
+            rows = self._select(cursor, [
+                (model, item_id) for model, item_id in zip(creates, ids)
+                if defaults[type(model)] is None])
+            self._update(cursor, updates)
+            self._delete(cursor, deletes)
+            conn.commit()
+
+        for model, item_id in zip(creates, ids):
+            model.id = item_id
+            row = rows.get((model.table_name, str(item_id)))
+
+            if row is not None:
+                model.update(row)
+            elif defaults.get(type(model)):
+                store.apply_server_defaults(model, defaults[type(model)])
+
+        changed = {id(model): model.dirty for model in updates}
+
+        for model in creates + updates:
+            model.dirty = set()
+
+        store.bump_generations([model.table_name for model in creates + updates + deletes])
+
+        # Soft-deleted models are evicted rather than written through, the
+        # same as ObjectStore.delete does
+        deleted = deletes + [model for model in creates + updates
+                             if model.get('date_deleted')]
+        written = [model for model in creates + updates
+                   if not self._contains(deleted, model)]
+        cached = [model for model in written if model.cache_policy.enabled]
+
+        write_through = [model for model in cached if model.cache_policy.write_through]
+
+        store.datastores['redis'].write_models(
+            written=[model for model in write_through if id(model) not in changed],
+            evicted=[model for model in cached if not model.cache_policy.write_through] +
+            [model for model in deleted if model.cache_policy.enabled],
+            updated=[(model, changed[id(model)]) for model in write_through
+                     if id(model) in changed])
+
+        if store.identity_map is not None:
+            for model in written:
+                store.identity_map.put(model)
+
+            for model in deleted:
+                store.identity_map.discard(model)
+
+        for model in deletes:
+            model.id = None
+
+    @staticmethod
+    def _group(models, key):
+        '''
+        Return lists of models grouped by key(model), in order of first
+        appearance
+        '''
+        groups = {}
+
+        for model in models:
+            groups.setdefault(key(model), []).append(model)
+
+        return groups
+
+    def _insert(self, cursor, models):
+        '''
+        Insert models and return their new ids. Models of the same class
+        that set the same columns go in one multi-row INSERT when the server
+        hands out consecutive auto-increment ids for them; otherwise they're
+        inserted one row at a time (still inside the transaction).
+        '''
+        store = self.object_store
+        increment = store.consecutive_autoinc_increment(cursor) if models else None
+        ids = {}
+
+        groups = self._group(
+            models, lambda model: (type(model), tuple(sorted(model.dirty))))
+
+        for (unused_class, keys), group in groups.items():
+            query_fmt = 'INSERT INTO `{table}` ({key_clause}) VALUES {values}'
+            row = '(' + ', '.join(['%s'] * len(keys)) + ')'
+            parameters = {
+                'table': store.match_identifier(group[0].table_name) or '',
+                'key_clause': ', '.join(store.match_identifier(x) for x in keys)
+            }
+
+            if increment is not None:
+                cursor.execute(
+                    query_fmt.format(values=', '.join([row] * len(group)), **parameters),
+                    tuple(itertools.chain.from_iterable(
+                        [model.fields[k] for k in keys] for model in group)))
+
+                for idx, model in enumerate(group):
+                    ids[id(model)] = cursor.lastrowid + idx * increment
+            else:
+                query = query_fmt.format(values=row, **parameters)
+
+                for model in group:
+                    cursor.execute(query, tuple(model.fields[k] for k in keys))
+                    ids[id(model)] = cursor.lastrowid
+
+        return [ids[id(model)] for model in models]
+
+    def _select(self, cursor, inserted):
+        '''
+        Return the inserted rows for a list of (model, id) pairs, keyed by
+        (table name, id), with one query per table
+        '''
+        rows = {}
+        groups = self._group(inserted, lambda pair: pair[0].table_name)
+
+        for table_name, group in groups.items():
+            query = 'SELECT * FROM `{0}` WHERE id IN ({1})'.format(
+                self.object_store.match_identifier(table_name),
+                ', '.join(['%s'] * len(group)))
+            cursor.execute(query, tuple(item_id for _, item_id in group))
+
+            for row in cursor.fetchall():
+                rows[(table_name, str(row['id']))] = row
+
+        return rows
+
+    def _update(self, cursor, models):
+        '''
+        Write modified fields with one UPDATE per table. Each column is set
+        with a CASE on the id, keeping the current value for rows that
+        didn't modify it.
+        '''
+        store = self.object_store
+
+        for table_name, group in self._group(
+                models, lambda model: model.table_name).items():
+            columns = sorted(set().union(*(model.dirty for model in group)))
+            assignments = []
+            values = []
+
+            for column in columns:
+                changed = [model for model in group if column in model.dirty]
+                assignments.append('{0} = CASE id {1} ELSE {0} END'.format(
+                    store.match_identifier(column),
+                    ' '.join(['WHEN %s THEN %s'] * len(changed))))
+                values += itertools.chain.from_iterable(
+                    (model.id, model.fields[column]) for model in changed)
+
+            query = 'UPDATE `{0}` SET {1} WHERE id IN ({2})'.format(
+                store.match_identifier(table_name), ', '.join(assignments),
+                ', '.join(['%s'] * len(group)))
+            cursor.execute(query, tuple(values) + tuple(model.id for model in group))
+
+    def _delete(self, cursor, models):
+        '''
+        Delete rows with one DELETE per table
+        '''
+        for table_name, group in self._group(
+                models, lambda model: model.table_name).items():
+            query = 'DELETE FROM `{0}` WHERE id IN ({1})'.format(
+                self.object_store.match_identifier(table_name),
+                ', '.join(['%s'] * len(group)))
+            cursor.execute(query, tuple(model.id for model in group))
+
+
+def schema_defaults(columns):
+    '''
+    Returns the server defaults described by rows from
+    information_schema.COLUMNS, or None if any of them is an expression,
+    since those can only be learned by reading the row back. That includes
+    CURRENT_TIMESTAMP: the database's clock, time zone, and column precision
+    decide the stored value, and a guess made here would be cached as if it
+    were the row.
+    '''
+    defaults = {}
+
+    for row in columns:
+        value, extra = row['COLUMN_DEFAULT'], (row['EXTRA'] or '').lower()
+
+        if 'auto_increment' in extra:
+            continue
+        elif value is None or value == 'NULL':
+            defaults[row['COLUMN_NAME']] = None
+        elif 'default_generated' in extra or value.lower().startswith('current_timestamp'):
+            return None
+        else:
+            # MariaDB quotes literal defaults
+            if len(value) > 1 and value[0] == value[-1] == "'":
+                value = value[1:-1]
+
+            data_type = row['DATA_TYPE'].lower()
+
+            if data_type.endswith('int'):
+                value = int(value)
+            elif data_type == 'decimal':
+                value = Decimal(value)
+            elif data_type in ('float', 'double'):
+                value = float(value)
+
+            defaults[row['COLUMN_NAME']] = value
+
+    return defaults
+
+
+def query_digest(query, vals):
+    '''
+    Returns a digest identifying a query and its parameters
+    '''
+    normalized = repr((' '.join(query.split()), tuple(vals)))
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+def filter_tables(result_class, filters, dependencies):
+    '''
+    Returns the names of the tables a filtered query reads
+    '''
+    classes = set([result_class])
+    classes.update(flt[0] for flt in filters)
+    classes.update(dependencies.keys())
+    classes.update(dependencies.values())
+    return sorted(cls.table_name for cls in classes)
+
+
+def estimate_literal_size(value):
+    '''
+    Returns an upper bound on the length of a value once it's escaped and
+    quoted as a MySQL literal
+    '''
+    if value is None:
+        return 4
+    elif isinstance(value, str):
+        return 2 * len(value.encode('utf-8')) + 2
+    elif isinstance(value, (bytes, bytearray)):
+        return 2 * len(value) + 3
+    else:
+        return len(str(value)) + 2
+
+
+# Escapes for the characters LOAD DATA treats specially with its default
+# field and line terminators
+_TSV_ESCAPES = {
+    ord('\\'): '\\\\', ord('\t'): '\\t', ord('\n'): '\\n',
+    ord('\r'): '\\r', ord('\0'): '\\0'
+}
+
+
+def tsv_field(value):
+    '''
+    Returns a value as a field of a tab-separated file in the format that
+    LOAD DATA INFILE reads by default
+    '''
+    if value is None:
+        return '\\N'
+    elif isinstance(value, bool):
+        return '1' if value else '0'
+    elif isinstance(value, (bytes, bytearray)):
+        value = bytes(value).decode('utf-8', 'surrogateescape')
+
+    return str(value).translate(_TSV_ESCAPES)
+
+
+class BulkWriter(object):
+    '''
+    Buffers rows for one table and writes them with multi-row INSERT
+    statements. Rows are flushed when the buffer holds `max_rows` rows or
+    `max_bytes` bytes of SQL, or once the oldest row is `max_age` seconds
+    old; each flush is split into statements of at most `max_bytes` and
+    committed together.
+
+    Writers for the 'update' operation add ON DUPLICATE KEY UPDATE, so rows
+    replace the existing rows with the same key.
+
+    If the rows include an id column and the writer knows its `model_class`,
+    each flush evicts the cached objects (and negative cache entries) for
+    their ids. Rows left to get an id from AUTO_INCREMENT can't be matched
+    up with negative cache entries for the ids they end up with, so those
+    go on answering "doesn't exist" until their negative_ttl runs out.
+
+    Writers are thread-safe. If a flush fails, its rows go back in the
+    buffer to be retried by the next flush, up to `max_attempts` times.
+    Rows that still haven't been written are dropped into `failed_rows`
+    (which keeps the most recent MAX_FAILED_ROWS) and passed to `on_error`
+    along with the exception, if it's set.
+
+    Explicit calls to `flush` raise when the write fails, but `add` never
+    does: the row was accepted, and the failure is counted in `stats` and
+    reported to `on_error` instead.
+    '''
+    MAX_ATTEMPTS = 3
+    MAX_FAILED_ROWS = 10000
+
+    def __init__(self, object_store, table_name, columns, operation='create',
+                 max_rows=1000, max_bytes=None, max_age=None,
+                 max_attempts=MAX_ATTEMPTS, on_error=None, model_class=None):
+        self.object_store = object_store
+        self.table_name = table_name
+        self.columns = tuple(columns)
+        self.model_class = model_class
+        self.operation = operation
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_attempts = max_attempts
+        self.on_error = on_error
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._rows = []
+        self._bytes = 0
+        self._oldest = None
+
+        self.flushes = 0
+        self.rows_written = 0
+        self.bytes_written = 0
+        self.last_flush_rows = 0
+        self.last_flush_bytes = 0
+        self.last_flush_seconds = 0.0
+        self.flush_errors = 0
+        self.rows_failed = 0
+        self.failed_rows = deque(maxlen=self.MAX_FAILED_ROWS)
+        self.last_error = None
+
+        key = object_store.match_identifier
+        self._statement = 'INSERT INTO `{0}` ({1}) VALUES '.format(
+            key(table_name) or '', ', '.join(key(x) for x in self.columns))
+        self._row_template = '(' + ', '.join(['%s'] * len(self.columns)) + ')'
+
+        if operation == 'update':
+            self._suffix = ' ON DUPLICATE KEY UPDATE ' + ', '.join(
+                '{col}=VALUES({col})'.format(col=key(x)) for x in self.columns)
+        else:
+            self._suffix = ''
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, model):
+        '''
+        Buffer a model's row, flushing if that fills the buffer
+        '''
+        row = tuple(model.fields[k] for k in self.columns)
+        size = sum(estimate_literal_size(value) for value in row) + len(row) + 2
+
+        with self._lock:
+            if not self._rows:
+                self._oldest = time.monotonic()
+
+            self._rows.append((row, size, 0))
+            self._bytes += size
+            full = len(self._rows) >= self.max_rows or (
+                self.max_bytes is not None and self._bytes >= self.max_bytes)
+
+        if full or self.due():
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=broad-except
+                # Already counted, logged, and reported by flush
+                pass
+
+    def due(self, now=None):
+        '''
+        True if the oldest buffered row is older than max_age
+        '''
+        oldest = self._oldest
+
+        if self.max_age is None or oldest is None or not self._rows:
+            return False
+
+        return (now or time.monotonic()) - oldest >= self.max_age
+
+    def _statements(self, rows):
+        '''
+        Yield (query, parameters, size) for statements holding all of the
+        rows, each no larger than max_bytes
+        '''
+        overhead = len(self._statement) + len(self._suffix)
+        batch = []
+        size = overhead
+
+        for row, row_size, _ in rows:
+            if batch and self.max_bytes is not None and size + row_size > self.max_bytes:
+                yield self._statement_for(batch), size
+                batch = []
+                size = overhead
+
+            batch.append(row)
+            size += row_size
+
+        if batch:
+            yield self._statement_for(batch), size
+
+    def _statement_for(self, batch):
+        query = self._statement + ', '.join([self._row_template] * len(batch)) + self._suffix
+        return query, tuple(itertools.chain.from_iterable(batch))
+
+    def flush(self):
+        '''
+        Write every buffered row in one transaction
+        '''
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+                self._bytes = 0
+                self._oldest = None
+
+            if not rows:
+                return
+
+            started = time.monotonic()
+            written = 0
+
+            try:
+                with self.object_store.datastores['mysql_write'] as (conn, cursor):
+                    for (query, parameters), size in self._statements(rows):
+                        cursor.execute(query, parameters)
+                        written += size
+
+                    conn.commit()
+            except Exception as exc:
+                self._failed(rows, exc, started)
+                raise
+
+            self.object_store.bump_generations([self.table_name])
+
+            if self.model_class is not None and 'id' in self.columns:
+                index = self.columns.index('id')
+                self.object_store.evict_ids(self.model_class, [
+                    row[index] for row, _, _ in rows if row[index] is not None])
+
+            self.flushes += 1
+            self.rows_written += len(rows)
+            self.bytes_written += written
+            self.last_flush_rows = len(rows)
+            self.last_flush_bytes = written
+            self.last_flush_seconds = time.monotonic() - started
+
+            logging.debug('[BulkWriter] %s %s: %d rows, %d bytes in %.3fs',
+                          self.operation, self.table_name, len(rows), written,
+                          self.last_flush_seconds)
+
+    def _failed(self, rows, exc, started):
+        '''
+        Put the rows of a failed flush back in the buffer, or drop the ones
+        that have been tried max_attempts times
+        '''
+        retry = [(row, size, attempts + 1) for row, size, attempts in rows
+                 if attempts + 1 < self.max_attempts]
+        dropped = [row for row, _, attempts in rows if attempts + 1 >= self.max_attempts]
+
+        with self._lock:
+            self._rows[0:0] = retry
+            self._bytes += sum(size for _, size, _ in retry)
+            self._oldest = started if self._rows else None
+            self.flush_errors += 1
+            self.rows_failed += len(dropped)
+            self.failed_rows.extend(dropped)
+            self.last_error = exc
+
+        logging.error('[BulkWriter] %s %s: flush of %d rows failed, dropped %d: %s',
+                      self.operation, self.table_name, len(rows), len(dropped), exc)
+
+        if self.on_error is not None:
+            self.on_error(exc, dropped)
+
+    def stats(self):
+        '''
+        Return a dictionary of the writer's counters
+        '''
+        return {
+            'buffered_rows': len(self._rows),
+            'buffered_bytes': self._bytes,
+            'flushes': self.flushes,
+            'rows_written': self.rows_written,
+            'bytes_written': self.bytes_written,
+            'last_flush_rows': self.last_flush_rows,
+            'last_flush_bytes': self.last_flush_bytes,
+            'last_flush_seconds': self.last_flush_seconds,
+            'flush_errors': self.flush_errors,
+            'rows_failed': self.rows_failed
+        }
+
+
+# Stores with bulk writers, flushed when the interpreter exits
+_bulk_stores = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_bulk_stores():
+    for store in list(_bulk_stores):
+        try:
+            store.flush()
+        except Exception:  # pylint: disable=broad-except
+            logging.exception('[BulkWriter] flush at exit failed')
+
+
 class ObjectStore(object):
     '''
     An ObjectStore instance maintains a reference to a datastore connection
@@ -67,6 +756,10 @@ class ObjectStore(object):
     '''
     dispatch = classmethod(multimethod)
 
+    # `count(..., approximate=True)` trusts the server's row estimate for
+    # tables at least this large
+    APPROXIMATE_COUNT_THRESHOLD = 1000000
+
     def __init__(self, datastores, mysql_write=None, redis=None):
         if isinstance(datastores, dict):
             self.datastores = datastores
@@ -76,11 +769,100 @@ class ObjectStore(object):
                 'mysql_write': mysql_write,
                 'redis': redis
             }
-        self.buffer = []
-        self.update_buffer = []
         self._identifier_pattern = None
         self.MAX_BUFFER_SIZE = 1000  # can tweak this constant
 
+        # Buffers for batch_create and batch_update, one BulkWriter per
+        # operation, table, and column list. `bulk_max_age` is the number of
+        # seconds a row can wait before the flusher writes it, and
+        # `bulk_error_handler` is called with the exception and the rows a
+        # writer gives up on (see BulkWriter).
+        self.bulk_writers = {}
+        self.bulk_max_age = 5.0
+        self.bulk_error_handler = None
+        self._bulk_lock = threading.Lock()
+        self._bulk_flusher = None
+        # Server settings and schema defaults are looked up once. Like the
+        # bulk writers, the dictionaries are shared with copies of the store
+        # (see with_identity_map), so the copies don't look them up again.
+        self._server_settings = {}
+        self._server_defaults = {}
+
+        # Concurrent cache misses for the same object share one query. To
+        # also keep other processes from repopulating the same key at once,
+        # set `fill_lock_ttl` to the lifetime of a redis lock in milliseconds.
+        # Waiting for another process's lock sleeps the calling thread, so
+        # from a request handler, read through an AsyncObjectStore.
+        self.single_flight = SingleFlight()
+        self.fill_lock_ttl = None
+        self.fill_lock_poll_interval = 0.01
+        self.identity_map = None
+
+    def unit_of_work(self):
+        '''
+        Return a `UnitOfWork` that writes through this store
+        '''
+        return UnitOfWork(self)
+
+    def consecutive_autoinc_increment(self, cursor):
+        '''
+        Return the step between the auto-increment ids of the rows of a
+        multi-row INSERT, or None if the server doesn't guarantee they're
+        consecutive. With InnoDB, only the "traditional" and "consecutive"
+        lock modes (0 and 1) do.
+        '''
+        settings = self._server_settings
+
+        if 'autoinc_increment' not in settings:
+            cursor.execute('''SELECT @@innodb_autoinc_lock_mode AS lock_mode,
+                @@auto_increment_increment AS increment''')
+            result = cursor.fetchone()
+
+            if result and result['lock_mode'] is not None and int(result['lock_mode']) < 2:
+                settings['autoinc_increment'] = int(result['increment'])
+            else:
+                settings['autoinc_increment'] = None
+
+        return settings['autoinc_increment']
+
+    def with_identity_map(self):
+        '''
+        Return a copy of this store that shares its connections and caches
+        but has its own `IdentityMap`. Reads through the copy return the
+        instance already loaded for an id instead of going back to redis or
+        the database, and writes through it update the map. Use one copy
+        per request and throw it away afterwards, since instances in the map
+        are never refreshed.
+        '''
+        store = copy.copy(self)
+        store.identity_map = IdentityMap()
+        return store
+
+    def _mapped(self, model_class, item_id):
+        '''
+        Return the instance in the identity map for an id, if there is one
+        '''
+        if self.identity_map is None:
+            return None
+
+        return self.identity_map.get(model_class, item_id)
+
+    def _identify(self, model):
+        '''
+        Return the identity map's instance for a loaded model (or the model
+        itself, if there's no map or it's the first instance for its id)
+        '''
+        if self.identity_map is None or model is None:
+            return model
+
+        return self.identity_map.add(model)
+
+    def _identify_all(self, models):
+        if self.identity_map is None:
+            return models
+
+        return [self.identity_map.add(model) for model in models]
+
     def match_identifier(self, identifier):
         ''' Returns the identifier string if it is a valid MySQL table or
             column name. Use this as a precaution to prevent SQL injection via
@@ -95,10 +877,28 @@ class ObjectStore(object):
         match = self._identifier_pattern.match(identifier)
         return match and match.group()
 
-    def count(self, result_class):
+    def should_cache(self, model_class, use_cache=True):
+        '''
+        True if a read should go through the cache: the caller hasn't opted
+        out and the model class's cache policy allows caching.
+        '''
+        return bool(use_cache) and model_class.cache_policy.enabled
+
+    def count(self, result_class, use_cache=True, approximate=False):
         '''
         Return the count of all models of the service's type in the data store
+
+        Counts are cached if the model's cache policy sets a count_ttl. With
+        `approximate`, tables the server estimates to have at least
+        APPROXIMATE_COUNT_THRESHOLD rows return that estimate instead, which
+        is much cheaper than counting them (and includes soft-deleted rows).
         '''
+        if approximate:
+            estimate = self.estimated_count(result_class)
+
+            if estimate is not None and estimate >= self.APPROXIMATE_COUNT_THRESHOLD:
+                return estimate
+
         count_fmt = 'SELECT COUNT(id) AS count FROM `{0}`'
 
         if 'date_deleted' in result_class.columns:
@@ -106,8 +906,51 @@ class ObjectStore(object):
 
         query = count_fmt.format(result_class.table_name)
 
+        return self._cached_count(
+            result_class, [result_class.table_name], query, (), use_cache)
+
+    def estimated_count(self, result_class):
+        '''
+        Return the server's estimate of the number of rows in a model's
+        table, from information_schema
+        '''
+        query = '''SELECT TABLE_ROWS AS count FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s'''
+
         with self.datastores['mysql_read'] as (unused_conn, cursor):
-            cursor.execute(query)
+            cursor.execute(query, (result_class.table_name,))
+            result = cursor.fetchone()
+
+        return result and result['count']
+
+    def _cached_count(self, result_class, table_names, query, vals, use_cache):
+        '''
+        Run a count query, going through the cache if the model's cache
+        policy has a count_ttl. Cached counts are keyed by a digest of the
+        query and stored with the generations of the tables it reads.
+        '''
+        ttl = result_class.cache_policy.count_ttl
+
+        if not (ttl and self.should_cache(result_class, use_cache)):
+            return self._execute_count(query, vals)
+
+        cache = self.datastores['redis']
+        key = '{0}:count:{1}'.format(result_class.table_name, query_digest(query, vals))
+        generations = cache.generations(sorted(set(table_names)))
+        count = cache.get_versioned(key, generations)
+
+        if count is MISSING:
+            count = self._execute_count(query, vals)
+            cache.set_versioned(key, generations, count, ttl)
+
+        return count
+
+    def _execute_count(self, query, vals):
+        '''
+        Run a query that selects a count
+        '''
+        with self.datastores['mysql_read'] as (unused_conn, cursor):
+            cursor.execute(query, vals)
             result = cursor.fetchone()
 
         if result:
@@ -115,10 +958,23 @@ class ObjectStore(object):
         else:
             return None
 
+    def bump_generations(self, table_names):
+        '''
+        Mark cached counts and query results that read any of the tables as
+        stale. Called after every write the object store makes.
+        '''
+        if 'redis' in self.datastores and table_names:
+            self.datastores['redis'].bump_generations(sorted(set(table_names)))
+
     def model_with_id(self, result_class, item_id, use_cache=True):
         '''
         Return a model populated by the database object identified by item_id
         '''
+        model = self._mapped(result_class, item_id)
+
+        if model is not None:
+            return model
+
         retrieve_fmt = 'SELECT {columns} FROM `{table}` WHERE ID = %s {filter} LIMIT 1'
         filter_clause = ''
 
@@ -136,28 +992,102 @@ class ObjectStore(object):
             filter=filter_clause
         )
 
-        if use_cache:
-            result = self.datastores['redis'].get_object(result_class, item_id)
+        if self.should_cache(result_class, use_cache):
+            result = self.datastores['redis'].get_object(
+                result_class, item_id, missing=MISSING)
 
-            if result:
+            if result is MISSING:
+                return None
+            elif result:
                 # logging.error('Retrieved from cache')
-                return result
+                return self._identify(result)
 
-        with self.datastores['mysql_read'] as (unused_conn, cursor):
-            cursor.execute(query, (item_id,))
-            # logging.error(cursor.description)
-            result = cursor.fetchone()
+            result = self.load_into_cache(result_class, item_id, query)
+        else:
+            with self.datastores['mysql_read'] as (unused_conn, cursor):
+                cursor.execute(query, (item_id,))
+                # logging.error(cursor.description)
+                result = cursor.fetchone()
 
         if result:
-            model = result_class(result)
-
-            if use_cache:
-                self.datastores['redis'].set_object(model)
-
-            return model
+            return self._identify(result_class(result))
         else:
             return None
 
+    def load_into_cache(self, result_class, item_id, query):
+        '''
+        Run a single-row `query` for the object identified by `item_id`, write
+        the result to the cache, and return the row.
+
+        Concurrent calls for the same object in this process share a single
+        query. If `fill_lock_ttl` is set, a short redis lock also keeps other
+        processes from running the query at the same time; instead, they wait
+        for the lock holder to fill the cache. Either way the wait blocks the
+        calling thread (see `_wait_for_cache`), which would stall an IOLoop;
+        AsyncObjectStore runs it on an executor instead.
+        '''
+        key = (result_class.table_name, str(item_id), query)
+        return self.single_flight.do(
+            key, self._load_into_cache, result_class, item_id, query)
+
+    def _load_into_cache(self, result_class, item_id, query):
+        '''
+        Implementation of `load_into_cache` for the thread that does the work
+        '''
+        cache = self.datastores['redis']
+        lock_key = cache.build_key(result_class.table_name, id=item_id)
+        token = None
+
+        if self.fill_lock_ttl:
+            token = cache.acquire_lock(lock_key, self.fill_lock_ttl)
+
+            if token is None:
+                model = self._wait_for_cache(result_class, item_id)
+
+                if model is MISSING:
+                    return None
+                elif model:
+                    return model.fields
+
+                # The lock holder didn't come through before its lock expired,
+                # so fall back to querying the database ourselves.
+
+        try:
+            started = time.monotonic()
+
+            with self.datastores['mysql_read'] as (unused_conn, cursor):
+                cursor.execute(query, (item_id,))
+                result = cursor.fetchone()
+
+            if result:
+                cache.set_object(result_class(result),
+                                 delta=time.monotonic() - started)
+            else:
+                cache.set_missing(result_class, [item_id])
+        finally:
+            if token:
+                cache.release_lock(lock_key, token)
+
+        return result
+
+    def _wait_for_cache(self, result_class, item_id):
+        '''
+        Poll the cache for an object until it appears or the fill lock
+        expires, sleeping between polls. Returns None if the object never
+        showed up, or MISSING if it was cached as not existing.
+        '''
+        deadline = time.monotonic() + self.fill_lock_ttl / 1000.0
+
+        while time.monotonic() < deadline:
+            time.sleep(self.fill_lock_poll_interval)
+            model = self.datastores['redis'].get_object(
+                result_class, item_id, missing=MISSING)
+
+            if model is not None:
+                return model
+
+        return None
+
     def model_with_fields(self, result_class, use_cache=True, prevent_deleted=True, **kwargs):
         '''
         Return a model populated by the database object matching the
@@ -187,6 +1117,8 @@ class ObjectStore(object):
         )
 
         # logging.info(query % tuple(values))
+        started = time.monotonic()
+
         with self.datastores['mysql_read'] as (unused_conn, cursor):
             cursor.execute(query, tuple(values))
             result = cursor.fetchone()
@@ -194,28 +1126,101 @@ class ObjectStore(object):
         if result:
             model = result_class(result)
 
-            if use_cache:
-                self.datastores['redis'].set_object(model)
+            if self.should_cache(result_class, use_cache):
+                self.datastores['redis'].set_object(
+                    model, delta=time.monotonic() - started)
 
-            return model
+            return self._identify(model)
         else:
             return None
 
-    def count_matching_filter(self, result_class, filters, dependencies={}):
+    def count_matching_filter(self, result_class, filters, dependencies={},
+                              use_cache=True):
         '''
-        Return the total filtered item count
-
-        (Convenience wrapper around `retrieve_filtered`)
+        Return the total filtered item count, cached as by `count`
         '''
-        return self.models_matching_filter(result_class, filters, None, dependencies, count_only=True)
+        query, vals = self._filter_query(
+            result_class, filters, None, dependencies, True, 'id', 'ASC')
+
+        return self._cached_count(
+            result_class, filter_tables(result_class, filters, dependencies),
+            query, vals, use_cache)
 
     def models_matching_filter(self, result_class, filters, bounds=None,
-                               dependencies={}, count_only=False, sort='id', direction='ASC'):
+                               dependencies={}, count_only=False, sort='id', direction='ASC',
+                               use_cache=True):
         '''
         Return a list of objects whose attributes match the filter parameters
 
         The `filters` parameter is a list of tuples in the form:
           (JOIN_TABLE, WHERE_FIELD, OPERATOR, VALUE)
+
+        If the model's cache policy sets a query_ttl, the ids of the results
+        are cached under a digest of the query, along with the generations
+        of the tables it reads, and the objects are loaded with
+        `models_with_ids`.
+        '''
+        if count_only is True:
+            return self.count_matching_filter(
+                result_class, filters, dependencies, use_cache)
+
+        query, vals = self._filter_query(
+            result_class, filters, bounds, dependencies, count_only, sort,
+            direction)
+        ttl = result_class.cache_policy.query_ttl
+
+        if ttl and self.should_cache(result_class, use_cache):
+            cache = self.datastores['redis']
+            key = '{0}:query:{1}'.format(result_class.table_name, query_digest(query, vals))
+            generations = cache.generations(
+                filter_tables(result_class, filters, dependencies))
+            ids = cache.get_versioned(key, generations)
+
+            if ids is not MISSING:
+                return self.models_with_ids(result_class, ids)
+
+            # Cache the rows as read, before the identity map can swap in
+            # instances with unsaved changes
+            started = time.monotonic()
+            models = self._fetch_filter_query(result_class, query, vals)
+            cache.set_objects(models, delta=time.monotonic() - started)
+            cache.set_versioned(key, generations, [model.id for model in models], ttl)
+            return self._identify_all(models)
+
+        return self._identify_all(
+            self._fetch_filter_query(result_class, query, vals))
+
+    def _fetch_filter_query(self, result_class, query, vals):
+        '''
+        Run a query built by _filter_query and return new instances of its
+        rows
+        '''
+        # logging.info(query % vals)
+
+        with self.datastores['mysql_read'] as (_, cursor):
+            cursor.execute(query, vals)
+            results = cursor.fetchall()
+
+        return [result_class(r) for r in results]
+
+    def iter_models_matching_filter(self, result_class, filters, bounds=None,
+                                    dependencies={}, sort='id',
+                                    direction='ASC', batch_size=None):
+        '''
+        Yield the objects models_matching_filter would return, reading them
+        from a server-side cursor `batch_size` rows at a time. The results
+        aren't written to the cache.
+        '''
+        query, vals = self._filter_query(
+            result_class, filters, bounds, dependencies, False, sort,
+            direction)
+
+        return self._iter_models(result_class, query, vals, batch_size)
+
+    def _filter_query(self, result_class, filters, bounds, dependencies,
+                      count_only, sort, direction):
+        '''
+        Return the query and parameters for models_matching_filter
         '''
 
         def build_join_clause(dependencies, filters):
@@ -328,126 +1333,212 @@ class ObjectStore(object):
                     cls.table_name, field, mysql_op))
                 values.append(mysql_val)
 
+        page_values = []
+
         if count_only is True:
             cols = 'COUNT(*) AS count'
-            vals = tuple(values)
         else:
             cols = build_select_expression(
                 columns, transform, alias=result_class.table_name)
-            vals = tuple(values)
-            retrieve_stmt += 'ORDER BY {table_name}.{sort} {direction}'
+            table_name = self.match_identifier(result_class.table_name)
+            sort = '{0}.{1}'.format(table_name, self.match_identifier(sort) or 'id')
+            id_column = '{0}.id'.format(table_name)
+            ascending = direction.upper() != 'DESC'
+
+            page_values, limit = self._page_clauses(
+                bounds, sort, id_column, ascending, where_clauses)
+            retrieve_stmt += 'ORDER BY {0} {1}'.format(
+                self._page_order(bounds, sort, id_column, ascending), limit)
 
-            if bounds:
-                vals += bounds
-                retrieve_stmt += ' LIMIT %s OFFSET %s'
+        vals = tuple(values) + tuple(page_values)
 
         query = retrieve_stmt.format(
             columns=cols,
             table_name=self.match_identifier(result_class.table_name),
             join_clause=build_join_clause(dependencies, filters),
-            filter_clause=' AND '.join(where_clauses),
-            sort=sort, direction=direction
+            filter_clause=' AND '.join(where_clauses)
         )
 
-        # logging.info(query % vals)
+        return query, vals
 
-        with self.datastores['mysql_read'] as (_, cursor):
-            cursor.execute(query, vals)
-            if count_only is True:
-                results = cursor.fetchone()
-            else:
-                results = cursor.fetchall()
+    def _page_clauses(self, bounds, sort, id_column, ascending, conditions):
+        '''
+        Append the keyset condition for a Seek to `conditions` and return
+        the query parameters it needs (followed by the limit parameters) and
+        the LIMIT clause for a Seek or Bounds
+        '''
+        if isinstance(bounds, Seek):
+            condition, values = build_seek_condition(
+                sort, id_column, ascending, bounds.after)
 
-        if count_only is True:
-            return results['count']
+            if condition:
+                conditions.append(condition)
+
+            return values + [bounds.limit], 'LIMIT %s'
+        elif bounds:
+            return [bounds.limit, bounds.offset], 'LIMIT %s OFFSET %s'
         else:
-            return [result_class(r) for r in results]
+            return [], ''
+
+    def _page_order(self, bounds, sort, id_column, ascending):
+        '''
+        Return the ORDER BY list for a query. Keyset pages are ordered by id
+        after the sort column so the order is total.
+        '''
+        direction = 'ASC' if ascending else 'DESC'
+        order = '{0} {1}'.format(sort, direction)
+
+        if isinstance(bounds, Seek) and sort != id_column:
+            order += ', {0} {1}'.format(id_column, direction)
+
+        return order
+
+    def _iter_models(self, result_class, query, vals, batch_size):
+        '''
+        Yield models built from the rows of a query on a server-side cursor
+        '''
+        rows = self.datastores['mysql_read'].iter_rows(query, vals, batch_size)
+
+        try:
+            for row in rows:
+                yield result_class(row)
+        finally:
+            rows.close()
 
     def models_with_ids(self, result_class, id_list, use_cache=True):
         '''
         Return a list of objects specified by the list of IDs
+
+        Cached objects are fetched from redis in a single round trip and only
+        the misses are queried from the database. The result is in the same
+        order as `id_list`, skipping any ids that don't exist.
         '''
+        # Key by the string representation so that '42' and 42 are the same
+        id_list = list({str(item_id): item_id for item_id in id_list}.values())
 
-        columns = result_class.columns
-        transform = result_class.select_transform
+        if not id_list:
+            return []
 
-        select_statement = '''SELECT {columnset} FROM `{table_name}`
-            WHERE id IN ({subquery}) {deleted_clause}
-            ORDER BY FIELD(id, {subquery})'''
+        use_cache = self.should_cache(result_class, use_cache)
+        found = {}
+        absent = set()
 
-        if 'date_deleted' in result_class.columns:
-            deleted_clause = 'AND date_deleted IS NULL'
-        else:
-            deleted_clause = ''
+        if self.identity_map is not None:
+            for item_id in id_list:
+                model = self.identity_map.get(result_class, item_id)
 
-        query = select_statement.format(
-            columnset=build_select_expression(columns, transform),
-            table_name=self.match_identifier(result_class.table_name),
-            subquery=', '.join(['%s'] * len(id_list)),
-            deleted_clause=deleted_clause
-        )
+                if model is not None:
+                    found[str(item_id)] = model
 
-        with self.datastores['mysql_read'] as (_, cursor):
-            cursor.execute(query, tuple(id_list * 2))
-            results = cursor.fetchall()
+        unmapped = [item_id for item_id in id_list if str(item_id) not in found]
 
-        models = []
+        if use_cache and unmapped:
+            cached = self.datastores['redis'].get_objects(
+                result_class, unmapped, missing=MISSING)
 
-        for r in results:
-            model = result_class(r)
+            for item_id, model in zip(unmapped, cached):
+                if model is MISSING:
+                    absent.add(str(item_id))
+                elif model:
+                    found[str(item_id)] = self._identify(model)
 
-            if use_cache:
-                self.datastores['redis'].set_object(model)
+        missing = [item_id for item_id in id_list
+                   if str(item_id) not in found and str(item_id) not in absent]
+
+        if missing:
+            columns = result_class.columns
+            transform = result_class.select_transform
+
+            select_statement = '''SELECT {columnset} FROM `{table_name}`
+                WHERE id IN ({subquery}) {deleted_clause}'''
+
+            if 'date_deleted' in result_class.columns:
+                deleted_clause = 'AND date_deleted IS NULL'
+            else:
+                deleted_clause = ''
+
+            query = select_statement.format(
+                columnset=build_select_expression(columns, transform),
+                table_name=self.match_identifier(result_class.table_name),
+                subquery=', '.join(['%s'] * len(missing)),
+                deleted_clause=deleted_clause
+            )
 
-            models.append(model)
+            started = time.monotonic()
 
-        return models
+            with self.datastores['mysql_read'] as (_, cursor):
+                cursor.execute(query, tuple(missing))
+                results = cursor.fetchall()
+
+            loaded = [result_class(r) for r in results]
+            found.update(
+                (str(model.id), self._identify(model)) for model in loaded)
+
+            if use_cache:
+                self.datastores['redis'].set_objects(
+                    loaded, delta=time.monotonic() - started)
+                self.datastores['redis'].set_missing(result_class, [
+                    item_id for item_id in missing if str(item_id) not in found
+                ])
+
+        return [found[str(item_id)] for item_id in id_list if str(item_id) in found]
 
     def models_in_range(self, result_class, bounds, sort='id', ascending=True, use_cache=True):
         '''
         Return all items from the database, restricted by bounds
         '''
+        query, vals = self._range_query(result_class, bounds, sort, ascending)
+        started = time.monotonic()
+
+        with self.datastores['mysql_read'] as (_, cursor):
+            cursor.execute(query, vals)
+            results = cursor.fetchall()
+
+        models = [result_class(r) for r in results]
+
+        if self.should_cache(result_class, use_cache):
+            self.datastores['redis'].set_objects(
+                models, delta=time.monotonic() - started)
+
+        return self._identify_all(models)
+
+    def iter_models_in_range(self, result_class, bounds=None, sort='id',
+                             ascending=True, batch_size=None):
+        '''
+        Yield the objects models_in_range would return, reading them from a
+        server-side cursor `batch_size` rows at a time. The results aren't
+        written to the cache.
+        '''
+        query, vals = self._range_query(result_class, bounds, sort, ascending)
+        return self._iter_models(result_class, query, vals, batch_size)
+
+    def _range_query(self, result_class, bounds, sort, ascending):
+        '''
+        Return the query and parameters for models_in_range
+        '''
         columns = result_class.columns
         transform = result_class.select_transform
 
-        limits = [bounds.limit, bounds.offset] if bounds else []
-
         query = '''SELECT {columnset} FROM `{table}` {whereclause}
-            ORDER BY {sort} {dir} {limit}'''
+            ORDER BY {order} {limit}'''
 
-        where_clause = 'WHERE date_deleted IS NULL' if 'date_deleted' in result_class.columns else ''
-
-        direction_map = {
-            True: 'ASC',
-            False: 'DESC'
-        }
+        sort = self.match_identifier(sort) or 'id'
+        conditions = ['date_deleted IS NULL'] if 'date_deleted' in result_class.columns else []
+        values, limit = self._page_clauses(
+            bounds, sort, 'id', ascending, conditions)
 
         parameters = {
-            'whereclause': where_clause,
+            'whereclause': ('WHERE ' + ' AND '.join(conditions)) if conditions else '',
             'columnset': build_select_expression(columns, transform),
             'table': self.match_identifier(result_class.table_name) or '',
-            'sort': self.match_identifier(sort) or 'id',
-            'dir': direction_map[ascending],
-            'limit': 'LIMIT %s OFFSET %s' if bounds else ''
+            'order': self._page_order(bounds, sort, 'id', ascending),
+            'limit': limit
         }
 
-        with self.datastores['mysql_read'] as (_, cursor):
-            cursor.execute(query.format(**parameters), tuple(limits))
-            results = cursor.fetchall()
-
-        models = []
-
-        for r in results:
-            model = result_class(r)
-
-            if use_cache:
-                self.datastores['redis'].set_object(model)
-
-            models.append(model)
-
-        return models
+        return query.format(**parameters), tuple(values)
 
-    def model_referenced_by_model(self, result_class, model, set_attr=None):
+    def model_referenced_by_model(self, result_class, model, set_attr=None,
+                                  use_cache=True):
         '''
         Return a record of type specified by `result_class` that is referenced
         by the `result_class.link_name` property defined in `model`. If
@@ -460,6 +1551,7 @@ class ObjectStore(object):
                 relationship
             set_attr: (optional) if set, the attribute name to assign the
                 results to on the model instance
+            use_cache: (optional) if False, bypass the cache
 
         Returns:
             the instance referenced by model
@@ -473,6 +1565,14 @@ class ObjectStore(object):
         if not link_id:
             return None
 
+        obj = self._mapped(result_class, link_id)
+
+        if obj is not None:
+            if set_attr is not None:
+                setattr(model, set_attr, obj)
+
+            return obj
+
         columns = result_class.columns
         transform = result_class.select_transform
 
@@ -483,16 +1583,22 @@ class ObjectStore(object):
             table=self.match_identifier(result_class.table_name)
         )
 
-        obj = self.datastores['redis'].get_object(result_class, link_id)
+        if self.should_cache(result_class, use_cache):
+            obj = self.datastores['redis'].get_object(
+                result_class, link_id, missing=MISSING)
 
-        if not obj:
+            if obj is MISSING:
+                obj = None
+            elif not obj:
+                r = self.load_into_cache(result_class, link_id, query)
+                obj = r and result_class(r)
+        else:
             with self.datastores['mysql_read'] as (_, cursor):
                 cursor.execute(query, (link_id,))
                 r = cursor.fetchone()
             obj = r and result_class(r)
 
-            if obj:
-                self.datastores['redis'].set_object(obj)
+        obj = self._identify(obj)
 
         if set_attr is not None:
             setattr(model, set_attr, obj)
@@ -500,7 +1606,8 @@ class ObjectStore(object):
         return obj
 
     def models_referencing_model(self, result_class, model, bounds,
-                                 sort='id', ascending=True, set_attr=None):
+                                 sort='id', ascending=True, set_attr=None,
+                                 use_cache=True):
         '''
         Return a list of all records of the `result_class` type that refer to
         the given model in a one-to-many relationship. If `set_attr` is
@@ -512,48 +1619,176 @@ class ObjectStore(object):
                 relationship
             set_attr: (optional) if set, the attribute name to assign the
                 results to on the model instance
+            use_cache: (optional) if False, don't write the results to the
+                cache
 
         Returns:
             the list of instances that were retreived
         '''
-        limits = [bounds.limit, bounds.offset] if bounds else []
+        query, vals = self._referencing_query(
+            result_class, model, bounds, sort, ascending)
+        started = time.monotonic()
+
+        with self.datastores['mysql_read'] as (_, cursor):
+            cursor.execute(query, vals)
+            results = cursor.fetchall()
+        objs = [result_class(r) for r in results]
+
+        if self.should_cache(result_class, use_cache):
+            self.datastores['redis'].set_objects(
+                objs, delta=time.monotonic() - started)
+
+        objs = self._identify_all(objs)
+
+        if set_attr is not None:
+            setattr(model, set_attr, objs)
+
+        return objs
+
+    def iter_models_referencing_model(self, result_class, model, bounds=None,
+                                      sort='id', ascending=True,
+                                      batch_size=None):
+        '''
+        Yield the objects models_referencing_model would return, reading
+        them from a server-side cursor `batch_size` rows at a time. The
+        results aren't written to the cache.
+        '''
+        query, vals = self._referencing_query(
+            result_class, model, bounds, sort, ascending)
+
+        return self._iter_models(result_class, query, vals, batch_size)
 
+    def _referencing_query(self, result_class, model, bounds, sort, ascending):
+        '''
+        Return the query and parameters for models_referencing_model
+        '''
         columns = result_class.columns
         transform = result_class.select_transform
 
-        query_fmt = '''SELECT {columnset} FROM `{table}` obj WHERE {link} = %s
-            ORDER BY {sort} {dir} {limit}'''
+        query_fmt = '''SELECT {columnset} FROM `{table}` obj WHERE {conditions}
+            ORDER BY {order} {limit}'''
 
-        direction_map = {
-            True: 'ASC',
-            False: 'DESC'
-        }
+        sort = 'obj.{0}'.format(self.match_identifier(sort) or 'id')
+        conditions = ['{0} = %s'.format(self.match_identifier(model.link_name))]
+        values, limit = self._page_clauses(
+            bounds, sort, 'obj.id', ascending, conditions)
 
         parameters = {
             'columnset': build_select_expression(columns, transform, alias='obj'),
             'table': self.match_identifier(result_class.table_name) or '',
-            'link': self.match_identifier(model.link_name),
-            'sort': self.match_identifier(sort) or 'id',
-            'dir': direction_map[ascending],
-            'limit': 'LIMIT %s OFFSET %s' if bounds else ''
+            'conditions': ' AND '.join(conditions),
+            'order': self._page_order(bounds, sort, 'obj.id', ascending),
+            'limit': limit
         }
 
-        query = query_fmt.format(**parameters)
+        return query_fmt.format(**parameters), (model.id,) + tuple(values)
 
-        with self.datastores['mysql_read'] as (_, cursor):
-            cursor.execute(query, (model.id,) + tuple(limits))
-            results = cursor.fetchall()
-        objs = [result_class(r) for r in results]
+    def models_referenced_by_models(self, result_class, models, set_attr=None,
+                                    use_cache=True):
+        '''
+        Batch version of `model_referenced_by_model`. The referenced records
+        for every model in `models` are fetched together with
+        `models_with_ids`, so the whole list costs one cache round trip and
+        at most one query.
+
+        Args:
+            result_class: the type of object to be returned
+            models: the model instances that hold the references
+            set_attr: (optional) if set, the attribute name to assign each
+                result to on its model instance
+            use_cache: (optional) if False, bypass the cache
 
-        for obj in objs:
-            self.datastores['redis'].set_object(obj)
+        Returns:
+            a list of the instances referenced by each model, in the same
+            order as `models`, with None for models that have no reference
+            or whose reference doesn't exist
+        '''
+        link_ids = [model.get(result_class.link_name, None) for model in models]
+        found = {
+            str(obj.id): obj for obj in self.models_with_ids(
+                result_class, [link_id for link_id in link_ids if link_id],
+                use_cache=use_cache)
+        }
+        objs = [found.get(str(link_id)) if link_id else None
+                for link_id in link_ids]
 
         if set_attr is not None:
-            setattr(model, set_attr, objs)
+            for model, obj in zip(models, objs):
+                setattr(model, set_attr, obj)
 
         return objs
 
-    def models_linked_to_model(self, result_class, model):
+    def models_referencing_models(self, result_class, models, sort='id',
+                                  ascending=True, set_attr=None,
+                                  use_cache=True):
+        '''
+        Batch version of `models_referencing_model`. The records referring
+        to every model in `models` are loaded with a single
+        `WHERE link IN (...)` query and grouped by the model they refer to.
+        There's no per-model limit, so this is meant for relationships that
+        are small enough to load in full.
+
+        Args:
+            result_class: the type of object to be returned
+            models: the model instances that are the targets of the
+                one-to-many relationship. They must all be of the same class.
+            set_attr: (optional) if set, the attribute name to assign each
+                model's list of results to on the model instance
+            use_cache: (optional) if False, don't write the results to the
+                cache
+
+        Returns:
+            a list with the list of instances referring to each model, in
+            the same order as `models`
+        '''
+        ids = list({str(model.id): model.id for model in models}.values())
+        groups = {}
+
+        if ids:
+            link = self.match_identifier(models[0].link_name)
+            columns = result_class.columns
+            transform = result_class.select_transform
+
+            query_fmt = '''SELECT {columnset}, obj.{link} AS __link_id
+                FROM `{table}` obj WHERE obj.{link} IN ({ids})
+                ORDER BY obj.{sort} {dir}'''
+
+            query = query_fmt.format(
+                columnset=build_select_expression(columns, transform, alias='obj'),
+                table=self.match_identifier(result_class.table_name) or '',
+                link=link,
+                ids=', '.join(['%s'] * len(ids)),
+                sort=self.match_identifier(sort) or 'id',
+                dir='ASC' if ascending else 'DESC'
+            )
+
+            started = time.monotonic()
+
+            with self.datastores['mysql_read'] as (_, cursor):
+                cursor.execute(query, tuple(ids))
+                results = cursor.fetchall()
+
+            objs = []
+
+            for r in results:
+                obj = result_class(r)
+                objs.append(obj)
+                groups.setdefault(str(r['__link_id']), []).append(
+                    self._identify(obj))
+
+            if self.should_cache(result_class, use_cache):
+                self.datastores['redis'].set_objects(
+                    objs, delta=time.monotonic() - started)
+
+        lists = [list(groups.get(str(model.id), [])) for model in models]
+
+        if set_attr is not None:
+            for model, objs in zip(models, lists):
+                setattr(model, set_attr, objs)
+
+        return lists
+
+    def models_linked_to_model(self, result_class, model, use_cache=True):
         '''Return all entries for the specified model's type
         Note that if the model's table name is not part of a linking table
         the query will fail and you will not go to space today
@@ -561,41 +1796,120 @@ class ObjectStore(object):
         Args:
             model: the model instance that is one side of the many-to-many
                 relationship
+            use_cache: (optional) if False, bypass the cache
         Returns:
             the list of instances that were retrieved
         '''
-        columns = result_class.columns
-        transform = result_class.select_transform
+        return self.models_linked_to_models(
+            result_class, [model], use_cache=use_cache)[0]
 
-        # NOTE: This is
-        linking_table_name = "{0}_{1}".format(
-            model.table_name, result_class.table_name)
+    def models_linked_to_models(self, result_class, models, set_attr=None,
+                                use_cache=True):
+        '''
+        Batch version of `models_linked_to_model`, ordered by id. The ids
+        linked to each model are cached in redis as a set (see
+        `Redis.link_key`). Models whose sets are cached are resolved with
+        `models_with_ids`, and the rest are loaded with one query against
+        the linking table, which also fills in their sets. Soft-deleted
+        records are left out either way, though their ids stay in the sets.
 
-        query_fmt = '''SELECT {columnset} FROM `{table}` tbl_name
-            JOIN {link_table} link ON tbl_name.id = link.{self_link_name}
-            WHERE link.{other_link_name} = %s'''
+        Args:
+            result_class: the type of object to be returned
+            models: the model instances that are one side of the many-to-many
+                relationship. They must all be of the same class.
+            set_attr: (optional) if set, the attribute name to assign each
+                model's list of results to on the model instance
+            use_cache: (optional) if False, bypass the cache
 
-        query = query_fmt.format(
-            columnset=build_select_expression(
-                columns, transform, alias='tbl_name'),
-            table=self.match_identifier(result_class.table_name),
-            link_table=self.match_identifier(linking_table_name),
-            self_link_name=self.match_identifier(result_class.link_name),
-            other_link_name=self.match_identifier(model.link_name)
-        )
+        Returns:
+            a list with the list of instances linked to each model, in the
+            same order as `models`
+        '''
+        if not models:
+            return []
 
-        with self.datastores['mysql_read'] as (_, cursor):
-            cursor.execute(query, (model.id,))
-            results = cursor.fetchall()
+        use_cache = self.should_cache(result_class, use_cache)
+        redis = self.datastores['redis']
+        linked_ids = {}
+
+        if use_cache:
+            for model, ids in zip(models, redis.get_links(result_class, models)):
+                if ids is not None:
+                    linked_ids[str(model.id)] = ids
+
+        groups = {}
+        missing = list({
+            str(model.id): model for model in models
+            if str(model.id) not in linked_ids
+        }.values())
+
+        if missing:
+            columns = result_class.columns
+            transform = result_class.select_transform
+
+            # NOTE: This is
+            linking_table_name = "{0}_{1}".format(
+                models[0].table_name, result_class.table_name)
+
+            query_fmt = '''SELECT {columnset}, link.{other_link_name} AS __link_id
+                FROM `{table}` tbl_name
+                JOIN {link_table} link ON tbl_name.id = link.{self_link_name}
+                WHERE link.{other_link_name} IN ({ids})
+                ORDER BY tbl_name.id'''
+
+            query = query_fmt.format(
+                columnset=build_select_expression(
+                    columns, transform, alias='tbl_name'),
+                table=self.match_identifier(result_class.table_name),
+                link_table=self.match_identifier(linking_table_name),
+                self_link_name=self.match_identifier(result_class.link_name),
+                other_link_name=self.match_identifier(models[0].link_name),
+                ids=', '.join(['%s'] * len(missing))
+            )
+
+            started = time.monotonic()
+
+            with self.datastores['mysql_read'] as (_, cursor):
+                cursor.execute(query, tuple(model.id for model in missing))
+                results = cursor.fetchall()
+
+            loaded = []
+            ids = {}
 
-        models = []
+            for r in results:
+                obj = result_class(r)
+                ids.setdefault(str(r['__link_id']), []).append(obj.id)
 
-        for r in results:
-            model = result_class(r)
-            self.datastores['redis'].set_object(model)
-            models.append(model)
+                # The set keeps the ids of soft-deleted records, the same as
+                # model_has_assoc_item, but they aren't returned
+                if obj.get('date_deleted') is None:
+                    loaded.append(obj)
+                    groups.setdefault(str(r['__link_id']), []).append(
+                        self._identify(obj))
 
-        return models
+            if use_cache:
+                redis.set_objects(loaded, delta=time.monotonic() - started)
+                redis.set_links(result_class, [
+                    (model, ids.get(str(model.id), [])) for model in missing
+                ])
+
+        if linked_ids:
+            found = {
+                str(obj.id): obj for obj in self.models_with_ids(
+                    result_class,
+                    list(itertools.chain.from_iterable(linked_ids.values())))
+            }
+
+            for model_id, ids in linked_ids.items():
+                groups[model_id] = [found[i] for i in ids if i in found]
+
+        lists = [list(groups.get(str(model.id), [])) for model in models]
+
+        if set_attr is not None:
+            for model, objs in zip(models, lists):
+                setattr(model, set_attr, objs)
+
+        return lists
 
     # TODO: This and model_has_assoc_item need to be renamed.
     def model_assoc_items(self, base_model, items, **extra):
@@ -620,7 +1934,7 @@ class ObjectStore(object):
             values.append(val_list)
 
         first_item = items[0]
-        columns = [base_model.link_name, first_item.link_name] + extra.keys()
+        columns = [base_model.link_name, first_item.link_name] + list(extra)
         value_part = '(' + ', '.join(['%s'] * (2 + len(extra))) + ')'
         values_template = ', '.join([value_part] * len(items))
 
@@ -630,24 +1944,48 @@ class ObjectStore(object):
                                  to_name=first_item.table_name,
                                  columns=', '.join(columns), values=values_template)
 
-        values = list(chain.from_iterable(zip(*values)))
+        values = list(itertools.chain.from_iterable(zip(*values)))
 
         with self.datastores['mysql_write'] as (conn, cursor):
             cursor.execute(query, tuple(values))
             conn.commit()
 
-    def model_has_assoc_item(self, model, item):
+        if self.should_cache(type(first_item)):
+            self.datastores['redis'].add_links(
+                type(first_item), base_model, [item.id for item in items])
+
+    def model_has_assoc_item(self, model, item, use_cache=True):
         '''
         Returns true if a record exists in a linking table for the pair of
-        records.
+        records. The answer comes from the model's cached link set, which is
+        loaded if it isn't cached yet.
         '''
-        statement = '''SELECT id FROM `{from_name}_{to_name}`
-                WHERE {from_link_name} = %s AND {to_link_name} = %s'''
+        use_cache = self.should_cache(type(item), use_cache)
+
+        if use_cache:
+            linked = self.datastores['redis'].has_link(type(item), model, item.id)
+
+            if linked is not None:
+                return linked
 
-        query = statemnt.format(
+            statement = '''SELECT {to_link_name} AS id FROM `{from_name}_{to_name}`
+                    WHERE {from_link_name} = %s'''
+        else:
+            statement = '''SELECT id FROM `{from_name}_{to_name}`
+                    WHERE {from_link_name} = %s AND {to_link_name} = %s'''
+
+        query = statement.format(
             from_name=model.table_name, to_name=item.table_name,
             from_link_name=model.link_name, to_link_name=item.link_name)
 
+        if use_cache:
+            with self.datastores['mysql_read'] as (_, cursor):
+                cursor.execute(query, (model.id,))
+                ids = [r['id'] for r in cursor.fetchall()]
+
+            self.datastores['redis'].set_links(type(item), [(model, ids)])
+            return str(item.id) in {str(i) for i in ids}
+
         with self.datastores['mysql_read'] as (_, cursor):
             cursor.execute(query, (model.id, item.id))
             result = cursor.fetchone()
@@ -669,15 +2007,64 @@ class ObjectStore(object):
             cursor.execute(query, (model.id, item.id))
             conn.commit()
 
-    def write_custom(self, qry, vals=None):
-        # write a custom sql qry to the write database - ugly hack
+        if self.should_cache(type(item)):
+            self.datastores['redis'].remove_links(type(item), model, [item.id])
+
+    def write_custom(self, qry, vals=None, tables=()):
+        # write a custom sql qry to the write database - ugly hack. Pass the
+        # names of the tables it writes to so cached counts get refreshed.
+        # Cached objects, including negative cache entries, aren't touched:
+        # call evict_ids for any rows the query creates or changes.
         with self.datastores['mysql_write'] as (conn, cursor):
             cursor.execute(qry, vals)
             conn.commit()
 
-    def create(self, model):
+        self.bump_generations(list(tables))
+
+    def server_defaults(self, model_class, cursor=None):
+        '''
+        Return the model class's server defaults, looking them up from
+        information_schema the first time if it asks for that. Returns None
+        if new rows have to be re-read to learn their defaults.
+        '''
+        defaults = model_class.server_defaults
+
+        if defaults != 'schema':
+            return defaults
+
+        table_name = model_class.table_name
+
+        if table_name not in self._server_defaults:
+            query = '''SELECT COLUMN_NAME, COLUMN_DEFAULT, DATA_TYPE, EXTRA
+                FROM information_schema.COLUMNS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s'''
+
+            if cursor is None:
+                with self.datastores['mysql_write'] as (_, cursor):
+                    cursor.execute(query, (table_name,))
+                    rows = cursor.fetchall()
+            else:
+                cursor.execute(query, (table_name,))
+                rows = cursor.fetchall()
+
+            self._server_defaults[table_name] = schema_defaults(rows)
+
+        return self._server_defaults[table_name]
+
+    def apply_server_defaults(self, model, defaults):
         '''
-        Save a new object by inserting it into the database
+        Fill in the columns of a newly inserted model that it didn't set
+        '''
+        for column, value in defaults.items():
+            if column in model.fields and column != 'id' and column not in model.dirty:
+                model.fields[column] = value() if callable(value) else value
+
+    def create(self, model, refresh=None):
+        '''
+        Save a new object by inserting it into the database. The new row is
+        read back to pick up its default values unless the model class
+        declares its server defaults; pass `refresh` as True or False to
+        always or never read it back.
         '''
         data = model.fields  # transform('mysql_insert_transform')
         modified = model.modified_dict
@@ -696,18 +2083,26 @@ class ObjectStore(object):
         filter_str = 'AND date_deleted IS NULL' if 'date_deleted' in model.columns else ''
 
         with self.datastores['mysql_write'] as (conn, cursor):
+            defaults = None if refresh else self.server_defaults(type(model), cursor)
+
             cursor.execute(query.format(**parameters),
                            tuple(data[k] for k in keys))
             conn.commit()
             model.id = cursor.lastrowid
-            cursor.execute(select_stmt.format(
-                table=table_name, filter=filter_str), (model.id,))
-            result = cursor.fetchone()
 
-        model.update(result)
+            if refresh or (refresh is None and defaults is None):
+                cursor.execute(select_stmt.format(
+                    table=table_name, filter=filter_str), (model.id,))
+                model.update(cursor.fetchone())
+            elif defaults:
+                self.apply_server_defaults(model, defaults)
+
         model.dirty = set()
-        self.datastores['redis'].set_hash(model)
-        self.datastores['redis'].set_object(model)
+        self.bump_generations([model.table_name])
+        self.cache_written_model(model)
+
+        if self.identity_map is not None:
+            self.identity_map.put(model)
 
     def update(self, model, set_date_modified=True, refresh=False):
         '''
@@ -743,9 +2138,13 @@ class ObjectStore(object):
                 else:
                     model.id = None
 
+        fields = model.dirty
         model.dirty = set()
-        self.datastores['redis'].set_hash(model)
-        self.datastores['redis'].set_object(model)
+        self.bump_generations([model.table_name])
+        self.cache_written_model(model, fields)
+
+        if self.identity_map is not None and model.id is not None:
+            self.identity_map.put(model)
 
     def delete(self, model):
         '''
@@ -761,10 +2160,52 @@ class ObjectStore(object):
             with self.datastores['mysql_write'] as (conn, cursor):
                 cursor.execute(delete_stmt, (model.id,))
                 conn.commit()
-                model.id = None
 
-        self.datastores['redis'].delete_hash(model)
-        self.datastores['redis'].delete_object(model)
+            self.bump_generations([model.table_name])
+
+        self.evict_model(model)
+
+        if self.identity_map is not None:
+            self.identity_map.discard(model)
+
+        if 'date_deleted' not in model:
+            # The model's id is needed to build its cache keys, so hang on
+            # to it until the cache has been cleaned up.
+            model.id = None
+
+    def cache_written_model(self, model, fields=None):
+        '''
+        Bring the cache up to date after a model has been created or updated,
+        as directed by the model's cache policy. For an update, pass the set
+        of `fields` it changed so that only those are rewritten.
+        '''
+        if not model.cache_policy.enabled:
+            return
+
+        if model.cache_policy.write_through and fields is not None:
+            self.datastores['redis'].write_models(updated=[(model, fields)])
+        elif model.cache_policy.write_through:
+            self.datastores['redis'].write_models(written=[model])
+        else:
+            self.evict_model(model)
+
+    def evict_model(self, model):
+        '''
+        Remove a model from the cache
+        '''
+        if not model.cache_policy.enabled:
+            return
+
+        self.datastores['redis'].write_models(evicted=[model])
+
+    def evict_ids(self, model_class, ids):
+        '''
+        Remove the cached objects of a model class for a list of ids, along
+        with any negative cache entries saying they don't exist. Use this
+        after writing rows some other way than create and update.
+        '''
+        if 'redis' in self.datastores and ids and model_class.cache_policy.enabled:
+            self.datastores['redis'].delete_objects(model_class, ids)
 
     def populate(self, model):
         '''
@@ -773,61 +2214,349 @@ class ObjectStore(object):
         # pylint: disable=no-self-use
         return model
 
+    def max_packet_size(self):
+        '''
+        Return the write server's max_allowed_packet, which bounds the size
+        of a statement
+        '''
+        settings = self._server_settings
+
+        if 'max_packet_size' not in settings:
+            with self.datastores['mysql_write'] as (_, cursor):
+                cursor.execute('SELECT @@max_allowed_packet AS size')
+                settings['max_packet_size'] = int(cursor.fetchone()['size'])
+
+        return settings['max_packet_size']
+
+    def bulk_writer(self, operation, model):
+        '''
+        Return the BulkWriter that batch_create or batch_update uses for a
+        model's table and column list, creating it if necessary
+        '''
+        key = (operation, model.table_name, tuple(model.fields.keys()))
+        writer = self.bulk_writers.get(key)
+
+        if writer is None:
+            # Leave room for the packet header and the statement text that
+            # isn't part of the row estimates
+            max_bytes = self.max_packet_size() - 1024
+
+            with self._bulk_lock:
+                writer = self.bulk_writers.get(key)
+
+                if writer is None:
+                    if not self.bulk_writers:
+                        _bulk_stores.add(self)
+
+                    writer = self.bulk_writers[key] = BulkWriter(
+                        self, model.table_name, key[2], operation,
+                        max_rows=self.MAX_BUFFER_SIZE, max_bytes=max_bytes,
+                        max_age=self.bulk_max_age, on_error=self.bulk_error_handler,
+                        model_class=type(model))
+
+        return writer
+
     def batch_create(self, model):
         '''
         Fills the buffer with data to be inserted. When the buffer is full,
         it flushes the results
         '''
-        data = model.fields
-        keys = data.keys()
-
-        self.buffer.append(tuple(data[k] for k in keys))
-
-        if len(self.buffer) == self.MAX_BUFFER_SIZE:
-            self.flush('create', model)
+        self.bulk_writer('create', model).add(model)
 
     def batch_update(self, model):
         "Updates multiple entries at once"
-        data = model.fields
-        keys = data.keys()
+        self.bulk_writer('update', model).add(model)
 
-        self.update_buffer.append(tuple(data[k] for k in keys))
+    def flush(self, operation=None, model=None):
+        '''
+        Write everything in the buffers to the database. With an operation
+        or a model, only flush the buffers for that operation or that
+        model's table.
+        '''
+        for (op, table_name, _), writer in list(self.bulk_writers.items()):
+            if operation is not None and op != operation:
+                continue
+            elif model is not None and table_name != model.table_name:
+                continue
 
-        if len(self.update_buffer) == self.MAX_BUFFER_SIZE:
-            self.flush('update', model)
+            writer.flush()
 
-    def flush(self, operation, model):
-        "Write everything in the buffer to the database"
-        keys = model.fields.keys()
+    def bulk_stats(self):
+        '''
+        Return the counters of each bulk writer, keyed by
+        '{operation}:{table}'. Writers for different column lists of the
+        same table are added together.
+        '''
+        stats = {}
 
-        parameters = {
-            'table': self.match_identifier(model.table_name) or '',
-            'key_clause': ', '.join(self.match_identifier(x) for x in keys),
-            'value_clause': ', '.join(['%s'] * len(keys))
-        }
+        for (op, table_name, _), writer in list(self.bulk_writers.items()):
+            totals = stats.setdefault('{0}:{1}'.format(op, table_name), {})
 
-        if operation == 'create':
-            query = 'INSERT INTO {table} ({key_clause}) VALUES ({value_clause})'
+            for name, value in writer.stats().items():
+                totals[name] = totals.get(name, 0) + value
 
-            if len(self.buffer) > 0:
-                with self.datastores['mysql_write'] as (conn, cursor):
-                    cursor.executemany(query.format(**parameters), self.buffer)
-                    conn.commit()
+        return stats
+
+    def start_bulk_flusher(self, interval=1.0):
+        '''
+        Periodically flush, on the IOLoop's default executor, the bulk
+        writers whose oldest row has waited longer than `bulk_max_age`
+        '''
+        if self._bulk_flusher is not None:
+            return
+
+        def flush_due():
+            now = time.monotonic()
+
+            for writer in list(self.bulk_writers.values()):
+                if writer.due(now):
+                    future = IOLoop.current().run_in_executor(None, writer.flush)
+                    future.add_done_callback(log_flush_error)
 
-            self.buffer = []
-        elif operation == 'update':
-            query = '''INSERT INTO {table} ({key_clause}) VALUES ({value_clause})
-            ON DUPLICATE KEY UPDATE {update_clause}'''
+        def log_flush_error(future):
+            if future.exception() is not None:
+                logging.error('[BulkWriter] background flush failed',
+                              exc_info=future.exception())
 
-            key = self.match_identifier
+        self._bulk_flusher = PeriodicCallback(flush_due, interval * 1000)
+        self._bulk_flusher.start()
 
-            parameters['update_clause'] = ', '.join(
-                '{col}=VALUES({col})'.format(col=key(x)) for x in keys)
+    def stop_bulk_flusher(self, flush=True):
+        '''
+        Stop the periodic flusher and, unless told not to, write whatever is
+        still buffered
+        '''
+        if self._bulk_flusher is not None:
+            self._bulk_flusher.stop()
+            self._bulk_flusher = None
+
+        if flush:
+            self.flush()
+
+    def bulk_load(self, model_class, rows, columns=None, mode=None,
+                  chunk_size=100000, progress=None):
+        '''
+        Load rows into a model's table with LOAD DATA LOCAL INFILE, which is
+        much faster than INSERT statements for large imports. `rows` is an
+        iterable of models or of dictionaries with a key for each column.
+
+        Rows are written to a temporary file and loaded `chunk_size` at a
+        time, each chunk in its own transaction. `mode` is None to fail on
+        duplicate keys, 'replace' to replace existing rows, or 'ignore' to
+        skip them. If given, `progress` is called with the number of rows
+        loaded so far after each chunk.
+
+        The write database must be configured with `local_infile: true`.
+        Loaded rows aren't written to the cache. If they include ids, any
+        cached copies of them (or negative cache entries) are evicted;
+        otherwise negative cache entries for the ids they get from
+        AUTO_INCREMENT last until their negative_ttl runs out.
+
+        Returns the number of rows the server reports as affected.
+        '''
+        if mode not in (None, 'replace', 'ignore'):
+            raise ValueError('mode must be None, "replace", or "ignore"')
+
+        columns = list(columns or model_class.columns)
+        key = self.match_identifier
+        query = '''LOAD DATA LOCAL INFILE %s{mode} INTO TABLE `{table}`
+            CHARACTER SET utf8mb4 ({columns})'''.format(
+                mode=' ' + mode.upper() if mode else '', table=key(model_class.table_name) or '',
+                columns=', '.join(key(c) for c in columns))
+
+        rows = iter(rows)
+        loaded = affected = 0
+
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+
+            if not chunk:
+                break
+
+            handle, path = tempfile.mkstemp(prefix='f5-load-', suffix='.tsv')
+
+            try:
+                with os.fdopen(handle, 'w', encoding='utf-8',
+                               errors='surrogateescape', newline='\n') as tsv:
+                    for row in chunk:
+                        fields = row.fields if isinstance(row, Model) else row
+                        tsv.write('\t'.join(tsv_field(fields.get(c)) for c in columns))
+                        tsv.write('\n')
 
-            if len(self.update_buffer) > 0:
                 with self.datastores['mysql_write'] as (conn, cursor):
-                    cursor.executemany(query.format(
-                        **parameters), self.update_buffer)
+                    cursor.execute(query, (path,))
+                    affected += cursor.rowcount
                     conn.commit()
+            finally:
+                os.unlink(path)
+
+            loaded += len(chunk)
+            self.bump_generations([model_class.table_name])
+
+            if 'id' in columns:
+                self.evict_ids(model_class, [
+                    item_id for item_id in (
+                        (row.fields if isinstance(row, Model) else row).get('id')
+                        for row in chunk)
+                    if item_id is not None])
+
+            if progress is not None:
+                progress(loaded)
+
+        return affected
 
-            self.update_buffer = []
+
+def run_in_executor(name):
+    '''
+    Return a method that calls the named `ObjectStore` method on the async
+    store's executor and returns an awaitable future for its result
+    '''
+    def method(self, *args, **kwargs):
+        function = getattr(self.object_store, name)
+        return IOLoop.current().run_in_executor(
+            self.executor, functools.partial(function, *args, **kwargs))
+
+    method.__name__ = name
+    method.__doc__ = 'Awaitable version of `ObjectStore.{0}`'.format(name)
+    return method
+
+
+def iterate_in_executor(name):
+    '''
+    Return a method that runs the named `ObjectStore` iterator on the async
+    store's executor and returns an async iterator over its results. Items
+    are pulled from the executor a batch at a time.
+    '''
+    async def method(self, *args, **kwargs):
+        batch_size = kwargs.get('batch_size') or self.DEFAULT_BATCH_SIZE
+        loop = IOLoop.current()
+
+        # The iterator holds a connection from its first batch until it's
+        # closed, however slowly it's consumed, so only a few may be open
+        async with self.iterator_slots:
+            iterator = getattr(self.object_store, name)(*args, **kwargs)
+
+            def next_batch():
+                return list(itertools.islice(iterator, batch_size))
+
+            try:
+                while True:
+                    batch = await loop.run_in_executor(self.executor, next_batch)
+
+                    if not batch:
+                        break
+
+                    for item in batch:
+                        yield item
+            finally:
+                await loop.run_in_executor(self.executor, iterator.close)
+
+    method.__name__ = name
+    method.__doc__ = 'Async iterator version of `ObjectStore.{0}`'.format(name)
+    return method
+
+
+class AsyncObjectStore(object):
+    '''
+    Wraps an ObjectStore so its queries can be awaited from request handler
+    coroutines without blocking the IOLoop. Each call runs the corresponding
+    ObjectStore method on a bounded thread pool, so the query-building logic
+    is shared with the synchronous interface.
+
+    ```
+    async def get(self, item_id):
+        item = await self.object_store.model_with_id(Item, item_id)
+    ```
+
+    Unless told otherwise, the pool gets one thread per connection in the
+    read database's pool, since any more would just queue for a connection.
+    batch_create and batch_update only block when they fill a buffer, but
+    they're run on the pool too so that flush never runs on the IOLoop.
+
+    The iter_* methods return async iterators, for use with `async for` or
+    `JSONRequestHandler.write_json_stream`. Each one keeps a database
+    connection until it's exhausted or closed, so at most `max_iterators`
+    (by default, one fewer than the number of connections) run at once and
+    the rest wait their turn; that way a slow consumer can't leave the other
+    methods without a connection.
+    '''
+    DEFAULT_MAX_WORKERS = 10
+    DEFAULT_BATCH_SIZE = 1000
+
+    def __init__(self, object_store, max_workers=None, executor=None,
+                 max_iterators=None):
+        self.object_store = object_store
+        pool = getattr(object_store.datastores.get('mysql_read'), 'pool', None)
+
+        if executor is None:
+            if max_workers is None:
+                max_workers = getattr(pool, 'max_size', self.DEFAULT_MAX_WORKERS)
+
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        if max_iterators is None:
+            connections = getattr(pool, 'max_size', None) or getattr(
+                executor, '_max_workers', self.DEFAULT_MAX_WORKERS)
+            max_iterators = max(1, connections - 1)
+
+        self.executor = executor
+        self.iterator_slots = Semaphore(max_iterators)
+
+    def shutdown(self, wait=True):
+        '''
+        Stop the executor once pending queries have finished
+        '''
+        self.executor.shutdown(wait=wait)
+
+    def unit_of_work(self):
+        '''
+        Return a `UnitOfWork` for the wrapped store that commits on this
+        store's executor when used with `async with`
+        '''
+        return UnitOfWork(self.object_store, executor=self.executor)
+
+    def with_identity_map(self):
+        '''
+        Return an async store wrapping `ObjectStore.with_identity_map`,
+        sharing this store's executor and iterator limit
+        '''
+        store = AsyncObjectStore(
+            self.object_store.with_identity_map(), executor=self.executor)
+        store.iterator_slots = self.iterator_slots
+        return store
+
+    @property
+    def identity_map(self):
+        return self.object_store.identity_map
+
+    count = run_in_executor('count')
+    estimated_count = run_in_executor('estimated_count')
+    model_with_id = run_in_executor('model_with_id')
+    model_with_fields = run_in_executor('model_with_fields')
+    count_matching_filter = run_in_executor('count_matching_filter')
+    models_matching_filter = run_in_executor('models_matching_filter')
+    models_with_ids = run_in_executor('models_with_ids')
+    models_in_range = run_in_executor('models_in_range')
+    model_referenced_by_model = run_in_executor('model_referenced_by_model')
+    models_referencing_model = run_in_executor('models_referencing_model')
+    models_referenced_by_models = run_in_executor('models_referenced_by_models')
+    models_referencing_models = run_in_executor('models_referencing_models')
+    models_linked_to_model = run_in_executor('models_linked_to_model')
+    models_linked_to_models = run_in_executor('models_linked_to_models')
+    model_assoc_items = run_in_executor('model_assoc_items')
+    model_has_assoc_item = run_in_executor('model_has_assoc_item')
+    model_deassoc_item = run_in_executor('model_deassoc_item')
+    write_custom = run_in_executor('write_custom')
+    create = run_in_executor('create')
+    update = run_in_executor('update')
+    delete = run_in_executor('delete')
+    populate = run_in_executor('populate')
+    batch_create = run_in_executor('batch_create')
+    batch_update = run_in_executor('batch_update')
+    flush = run_in_executor('flush')
+    bulk_load = run_in_executor('bulk_load')
+
+    iter_models_matching_filter = iterate_in_executor('iter_models_matching_filter')
+    iter_models_in_range = iterate_in_executor('iter_models_in_range')
+    iter_models_referencing_model = iterate_in_executor(
+        'iter_models_referencing_model')
@@ -22,14 +22,21 @@
 '''
 Datastore Abstraction Classes
 
-Currently just a database context manager. Futurely, will add connection
-pools and a Redis context manager.
+Context managers for MySQL and Redis connections. MySQL connections are leased
+from a bounded pool and returned to it when the context manager exits.
 '''
 # pylint: disable=star-args,abstract-class-not-used
 
+from collections import OrderedDict, deque
+import functools
+import itertools
+import math
 import os
+import random
+import threading
+import time
+import zlib
 import redis
-from redis.exceptions import WatchError
 import pymysql as MySQLdb
 from tornado.web import HTTPError
 from f5.encoding import MessagePackEncoder
@@ -42,8 +49,16 @@ from f5.encoding import MessagePackEncoder
 # Database Wrappers & Somesuch
 # -------------------------------------------------------------------
 
-# TODO: Look into SQL Alchemy and async DB connections:
-# https://blog.chartio.com/blog/making-mysql-queries-asynchronous-in-tornado
+# Returned by the object cache for ids that are known not to exist, when the
+# caller asks to tell them apart from ids that just aren't cached
+MISSING = object()
+
+# Returned by an object format's decode for a stored value it can't read,
+# such as a blob written by another version, so the key can be dropped
+INVALID = object()
+
+# N.B. These context managers block the calling thread. Coroutines should go
+# through `f5.services.AsyncObjectStore`, which runs queries on a thread pool.
 
 class DatabaseConnectionError(HTTPError):
     '''
@@ -52,30 +67,280 @@ class DatabaseConnectionError(HTTPError):
     '''
 
     def __init__(self, log_message=None, *args, **kwargs):
-        HTTPError.__init__(self, log_message, *args, **kwargs)
+        headers = kwargs.pop('headers', None)
+        HTTPError.__init__(self, 500, log_message, *args, **kwargs)
+
+        if headers is not None:
+            self.headers = headers
+
+
+class ConnectionPool(object):
+    '''
+    A bounded pool of reusable database connections. Connections are opened
+    on demand up to `max_size`; when every connection is leased, `acquire`
+    blocks for up to `timeout` seconds waiting for one to be released.
+
+    Idle connections are closed after `idle_timeout` seconds (though the pool
+    never reaps itself below `min_size`), every connection is retired after
+    `max_lifetime` seconds, and a connection that has been idle for more than
+    `ping_interval` seconds is pinged before it is handed out again.
+    '''
+
+    def __init__(self, connect, min_size=0, max_size=10, idle_timeout=300,
+                 max_lifetime=3600, ping_interval=30, timeout=10, prepare=None):
+        if max_size < 1 or min_size > max_size:
+            raise ValueError('pool size must satisfy 0 <= min_size <= max_size')
+
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.ping_interval = ping_interval
+        self.timeout = timeout
+
+        self._connect = connect
+        self._prepare = prepare
+        self._idle = deque()
+        self._size = 0
+        self._condition = threading.Condition()
+
+    @property
+    def size(self):
+        '''
+        The number of open connections, both leased and idle
+        '''
+        return self._size
+
+    @property
+    def idle(self):
+        '''
+        The number of idle connections waiting to be leased
+        '''
+        return len(self._idle)
+
+    def _open(self):
+        '''
+        Open a new connection. The caller must already have reserved a slot
+        by incrementing `_size`.
+        '''
+        conn = self._connect()
+
+        if self._prepare:
+            self._prepare(conn)
+
+        now = time.monotonic()
+        return PooledConnection(conn, now)
+
+    def _close(self, entry):
+        '''
+        Close a connection that has been removed from the pool
+        '''
+        try:
+            entry.conn.close()
+        except Exception:  # pylint: disable=broad-except
+            # The connection is being thrown away regardless
+            pass
+
+    def _is_expired(self, entry, now):
+        '''
+        True if the connection has outlived `max_lifetime`
+        '''
+        return (self.max_lifetime is not None and
+                now - entry.created > self.max_lifetime)
+
+    def _reap(self, now):
+        '''
+        Remove idle connections that have expired or have been idle for too
+        long. Must be called with the condition lock held. Returns the list of
+        removed connections so they can be closed outside the lock.
+        '''
+        reaped = []
+
+        # The idle queue is used as a stack, so the least recently used
+        # connections are on the left.
+        while self._idle:
+            entry = self._idle[0]
+            idle_too_long = (self.idle_timeout is not None and
+                             now - entry.last_used > self.idle_timeout and
+                             self._size > self.min_size)
+
+            if not (idle_too_long or self._is_expired(entry, now)):
+                break
+
+            self._idle.popleft()
+            self._size -= 1
+            reaped.append(entry)
+
+        return reaped
+
+    def fill(self):
+        '''
+        Open connections until the pool holds at least `min_size` of them
+        '''
+        while True:
+            with self._condition:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+
+            try:
+                entry = self._open()
+            except Exception:
+                with self._condition:
+                    self._size -= 1
+                    self._condition.notify()
+                raise
+
+            with self._condition:
+                self._idle.append(entry)
+                self._condition.notify()
+
+    def acquire(self):
+        '''
+        Lease a connection from the pool. Raises `DatabaseConnectionError` if
+        no connection becomes available before the timeout elapses.
+        '''
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            entry = None
+            reaped = []
+
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    reaped += self._reap(now)
+
+                    if self._idle:
+                        entry = self._idle.pop()
+                        break
+                    elif self._size < self.max_size:
+                        self._size += 1
+                        break
 
-        self.status_code = 500
-        self.log_message = log_message
-        self.args = args
-        self.reason = kwargs.get('reason', None)
+                    remaining = deadline - now
 
-        if 'headers' in kwargs:
-            self.headers = kwargs['headers']
+                    if remaining <= 0:
+                        for stale in reaped:
+                            self._close(stale)
+                        raise DatabaseConnectionError(
+                            'timed out waiting for a database connection')
+
+                    self._condition.wait(remaining)
+
+            for stale in reaped:
+                self._close(stale)
+
+            if entry is None:
+                try:
+                    entry = self._open()
+                except Exception:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify()
+                    raise
+
+                return entry
+
+            if (self.ping_interval is not None and
+                    now - entry.last_used > self.ping_interval):
+                try:
+                    entry.conn.ping(reconnect=False)
+                except MySQLdb.Error:
+                    # The server went away while the connection was idle.
+                    # Throw it out and try again.
+                    self.release(entry, discard=True)
+                    continue
+
+            return entry
+
+    def release(self, entry, discard=False):
+        '''
+        Return a leased connection to the pool. Any open transaction is rolled
+        back first. If `discard` is true or the connection has outlived
+        `max_lifetime`, it is closed instead.
+        '''
+        now = time.monotonic()
+
+        if not discard and self._is_expired(entry, now):
+            discard = True
+
+        if not discard:
+            try:
+                # Read connections have their rollback method locked out,
+                # so call the implementation on the class directly.
+                type(entry.conn).rollback(entry.conn)
+            except MySQLdb.Error:
+                discard = True
+
+        if discard:
+            self._close(entry)
+
+        with self._condition:
+            if discard:
+                self._size -= 1
+            else:
+                entry.last_used = now
+                self._idle.append(entry)
+
+            self._condition.notify()
+
+    def close(self):
+        '''
+        Close every idle connection. Leased connections are closed when they
+        are released.
+        '''
+        with self._condition:
+            entries = list(self._idle)
+            self._idle.clear()
+            self._size -= len(entries)
+            self._condition.notify_all()
+
+        for entry in entries:
+            self._close(entry)
+
+
+class PooledConnection(object):
+    '''
+    A connection held by a `ConnectionPool`, along with the bookkeeping the
+    pool needs to expire it
+    '''
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, conn, created):
+        self.conn = conn
+        self.created = created
+        self.last_used = created
 
 
 class Database(object):
     '''
     Database context manager. Instantiate with database connection
     parameters, including debug mode and read xor write mode flag. Entering the
-    context manager opens a connection and returns a tuple containing the
-    connection and cursor
+    context manager leases a connection from the instance's pool and returns a
+    tuple containing the connection and cursor. Exiting rolls back anything
+    left uncommitted and returns the connection to the pool.
+
+    Pool behavior is configured with the `pool_min_size`, `pool_max_size`,
+    `pool_idle_timeout`, `pool_max_lifetime`, `pool_ping_interval`, and
+    `pool_timeout` keyword arguments. Each instance has its own pool, so the
+    read and write datastores never share connections.
     '''
     # pylint: disable=too-few-public-methods
 
+    POOL_OPTIONS = ('min_size', 'max_size', 'idle_timeout', 'max_lifetime',
+                    'ping_interval', 'timeout')
+
     def __init__(self, *args, **kwargs):
         self._debug = bool(kwargs.pop('debug', False))
         self._mode = kwargs.pop('mode', 'read')
 
+        pool_options = {
+            option: kwargs.pop('pool_' + option)
+            for option in self.POOL_OPTIONS if 'pool_' + option in kwargs
+        }
+
+        settings = kwargs
         config = dict(settings)
         if 'read' in config:
             del config['read']
@@ -88,39 +353,504 @@ class Database(object):
             config.update(settings.get('read', {}))
 
         self._settings = config
-        self._conn = None
-        self._cursor = None
+        self._pool = ConnectionPool(
+            functools.partial(MySQLdb.connect, **config),
+            prepare=self._prepare_connection, **pool_options)
+        self._local = threading.local()
 
-    def __enter__(self):
+    @property
+    def pool(self):
         '''
-        Open a connection and return a tuple containing the connection and cursor
+        The connection pool backing this context manager
         '''
-        self._conn = MySQLdb.connect(**self._settings)
+        return self._pool
 
+    def _prepare_connection(self, conn):
+        '''
+        Set up a newly opened connection before it joins the pool
+        '''
         if self._mode == 'read':
             def not_implemented():
                 'lockout function for read connections'
                 raise NotImplementedError(
                     'Cannot write to a read-only connection')
-            self._conn.commit = not_implemented
-            self._conn.rollback = not_implemented
+            conn.commit = not_implemented
+            conn.rollback = not_implemented
 
-        self._cursor = self._conn.cursor(MySQLdb.cursors.DictCursor)
-        return (self._conn, self._cursor)
+    def _leases(self):
+        '''
+        Return the stack of connections leased by the current thread
+        '''
+        leases = getattr(self._local, 'leases', None)
 
-    def __exit__(self, unused_type, unused_value, unused_traceback):
+        if leases is None:
+            leases = self._local.leases = []
+
+        return leases
+
+    def __enter__(self):
+        '''
+        Lease a connection and return a tuple containing the connection and
+        cursor
+        '''
+        entry = self._pool.acquire()
+
+        try:
+            cursor = entry.conn.cursor(MySQLdb.cursors.DictCursor)
+        except Exception:
+            self._pool.release(entry, discard=True)
+            raise
+
+        self._leases().append((entry, cursor))
+        return (entry.conn, cursor)
+
+    def __exit__(self, exc_type, unused_value, unused_traceback):
         "Clean up when you're done"
-        self._cursor.close()
-        self._conn.close()
+        entry, cursor = self._leases().pop()
+
+        # A connection that raised a connection-level error is in an unknown
+        # state, so it doesn't go back in the pool.
+        discard = exc_type is not None and issubclass(
+            exc_type, (MySQLdb.OperationalError, MySQLdb.InterfaceError))
+
+        try:
+            cursor.close()
+        except MySQLdb.Error:
+            discard = True
+
+        self._pool.release(entry, discard=discard)
+
+    DEFAULT_FETCH_SIZE = 1000
+
+    def iter_rows(self, query, args=None, batch_size=None):
+        '''
+        Execute a query on an unbuffered server-side cursor and yield its
+        rows, fetching `batch_size` at a time. A connection is leased when
+        iteration starts and returned when the rows run out.
+
+        If the generator is closed before the last row, the rest of the
+        result is still on the wire, so the connection is closed rather
+        than drained and returned to the pool.
+        '''
+        batch_size = batch_size or self.DEFAULT_FETCH_SIZE
+        entry = self._pool.acquire()
+        finished = False
+
+        try:
+            cursor = entry.conn.cursor(MySQLdb.cursors.SSDictCursor)
+            cursor.execute(query, args)
+
+            while True:
+                rows = cursor.fetchmany(batch_size)
+
+                if not rows:
+                    break
+
+                for row in rows:
+                    yield row
+
+            cursor.close()
+            finished = True
+        finally:
+            self._pool.release(entry, discard=not finished)
+
+    def close(self):
+        '''
+        Close all idle connections in the pool
+        '''
+        self._pool.close()
+
+
+class SingleFlight(object):
+    '''
+    Coalesces concurrent calls that share a key so that only one of them does
+    the work. Threads that call `do` while a call with the same key is in
+    flight wait for it to finish and get its result (or its exception).
+    '''
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function, *args, **kwargs):
+        '''
+        Call `function` unless a call for `key` is already in flight, in
+        which case wait for that call and return its result
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = self._calls[key] = PendingCall()
+
+        if not leader:
+            call.event.wait()
+
+            if call.error is not None:
+                raise call.error
+
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+            call.event.set()
+
+        return call.result
+
+
+class PendingCall(object):
+    '''
+    The shared state of a call in flight in a `SingleFlight` group
+    '''
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class LocalCache(object):
+    '''
+    A thread-safe, size-bounded LRU cache whose entries expire `ttl` seconds
+    after they were set. Keeps counts of hits, misses, evictions (entries
+    pushed out to make room), expirations, and invalidations.
+    '''
+    DEFAULT_TTL = 30
+
+    def __init__(self, max_size, ttl=DEFAULT_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''
+        Return the value for key, or None if it isn't cached
+        '''
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, expires = entry
+
+            if expires <= now:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        '''
+        Cache a value for key, evicting the least recently used entries if
+        the cache is full
+        '''
+        expires = time.monotonic() + self.ttl
+
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        '''
+        Remove key from the cache
+        '''
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        '''
+        Remove every entry from the cache
+        '''
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        '''
+        Return a dictionary of the cache's counters
+        '''
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations
+        }
+
+
+class HashObjectFormat(object):
+    '''
+    Stores each cached object as a redis hash with one msgpack-encoded
+    value per column, keyed by column name. Updates can rewrite just the
+    columns that changed.
+    '''
+    name = 'hash'
+    partial_writes = True
+
+    def __init__(self, encoder):
+        self.encoder = encoder
+
+    def key(self, table_name, id):
+        '''
+        Return the key an object is stored under
+        '''
+        return '{0}:{1}'.format(table_name, id)
+
+    def _encoded(self, model, meta):
+        '''
+        Return a model's encoded fields and metadata, keyed by field name
+        '''
+        fields = self.encoder.model_fields(model)
+        del fields['id']
+        fields.update(meta)
+
+        return {
+            name.encode('utf-8'): self.encoder.encode(val)
+            for name, val in fields.items()
+        }
+
+    def write(self, pipe, key, model, meta):
+        '''
+        Queue the commands that store a model and its metadata fields
+        '''
+        pipe.hmset(key, self._encoded(model, meta))
+
+        if model.cache_policy.negative_ttl:
+            pipe.hdel(key, Redis.ABSENT_FIELD)
+
+    def script_values(self, model, meta, fields=None):
+        '''
+        Return the arguments that Redis.WRITE_MODEL_SCRIPT stores a model
+        with: the hash's fields and values, alternating. Pass a set of
+        `fields` to only include those (and the metadata).
+        '''
+        encoded = self._encoded(model, meta)
+
+        if fields is not None:
+            names = set(name.encode('utf-8') for name in itertools.chain(fields, meta))
+            encoded = {name: val for name, val in encoded.items() if name in names}
+
+        return list(itertools.chain.from_iterable(encoded.items()))
+
+    def write_missing(self, pipe, key, unused_model_class):
+        '''
+        Queue the commands that mark an object as not existing
+        '''
+        pipe.hmset(key, {
+            Redis.ABSENT_FIELD.encode('utf-8'): self.encoder.encode(True)})
+
+    def read_many(self, redis, keys):
+        '''
+        Return the raw stored values for a list of keys in one round trip
+        '''
+        with redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hgetall(key)
+
+            return pipe.execute()
+
+    def decode(self, unused_model_class, mapping):
+        '''
+        Return a dictionary of decoded field values from a hash of encoded
+        field values, or None if the hash is empty
+        '''
+        if mapping:
+            return {
+                str(key, encoding='utf-8'): self.encoder.decode(val)
+                for key, val in mapping.items()
+            }
+        else:
+            return None
+
+
+class BlobObjectFormat(object):
+    '''
+    Stores each cached object as a single msgpack blob. The blob is a list
+    that starts with a format version and a fingerprint of the model's
+    columns, followed by the expiry time, the load time, and the column
+    values in `Model.columns` order. Blobs written for a different version
+    or column list, or that don't have that shape, read as misses and are
+    deleted.
+
+    The blobs live under their own keys ('{table}:{id}#blob') so they can't
+    collide with hashes written by processes using the hash format, or with
+    link sets, whose names can't contain '#'.
+    '''
+    name = 'blob'
+    partial_writes = False
+    VERSION = 1
+
+    def __init__(self, encoder):
+        self.encoder = encoder
+        self._schemas = {}
+
+    def _schema(self, model_class):
+        '''
+        Return the fingerprint and non-id column list for a model class
+        '''
+        schema = self._schemas.get(model_class)
+
+        if schema is None:
+            columns = tuple(col for col in model_class.columns if col != 'id')
+            fingerprint = zlib.crc32(','.join(columns).encode('utf-8'))
+            schema = self._schemas[model_class] = (fingerprint, columns)
+
+        return schema
+
+    def key(self, table_name, id):
+        '''
+        Return the key an object is stored under
+        '''
+        return '{0}:{1}#blob'.format(table_name, id)
+
+    def _encoded(self, model, meta):
+        '''
+        Return a model and its metadata encoded as a blob
+        '''
+        fingerprint, columns = self._schema(type(model))
+        fields = self.encoder.model_fields(model)
+        return self.encoder.encode([
+            self.VERSION, fingerprint,
+            meta.get(Redis.EXPIRY_FIELD), meta.get(Redis.DELTA_FIELD),
+            [fields[col] for col in columns]
+        ])
+
+    def write(self, pipe, key, model, meta):
+        '''
+        Queue the command that stores a model and its metadata
+        '''
+        pipe.set(key, self._encoded(model, meta))
+
+    def script_values(self, model, meta):
+        '''
+        Return the arguments that Redis.WRITE_MODEL_SCRIPT stores a model
+        with: just the blob
+        '''
+        return [self._encoded(model, meta)]
+
+    def write_missing(self, pipe, key, model_class):
+        '''
+        Queue the command that marks an object as not existing
+        '''
+        fingerprint, _ = self._schema(model_class)
+        pipe.set(key, self.encoder.encode(
+            [self.VERSION, fingerprint, None, None, None]))
+
+    def read_many(self, redis, keys):
+        '''
+        Return the raw stored values for a list of keys in one round trip
+        '''
+        return redis.mget(keys)
+
+    def decode(self, model_class, blob):
+        '''
+        Return a dictionary of decoded field values from a blob, None if the
+        blob is empty, or INVALID if it can't be decoded or was written for a
+        different version or schema
+        '''
+        if not blob:
+            return None
+
+        try:
+            record = self.encoder.decode(blob)
+        except ValueError:
+            return INVALID
+
+        # Check the shape before unpacking, since another version may have
+        # written a record with a different number of items
+        if not isinstance(record, (list, tuple)) or len(record) != 5 or \
+                record[0] != self.VERSION:
+            return INVALID
+
+        _, fingerprint, expiry, delta, values = record
+        expected, columns = self._schema(model_class)
+
+        if fingerprint != expected:
+            return INVALID
+        elif values is None:
+            return {Redis.ABSENT_FIELD: True}
+
+        data = dict(zip(columns, values))
+        data[Redis.EXPIRY_FIELD] = expiry
+
+        if delta is not None:
+            data[Redis.DELTA_FIELD] = delta
+
+        return data
 
 
 class Redis(object):
     '''
     Redis context manager. Instantiate with redis server parameters.
+
+    To keep decoded objects in a per-process LRU cache in front of redis,
+    pass `local_cache_size` (and optionally `local_cache_ttl` in seconds).
+    Processes with a local cache tell each other to drop changed objects
+    over the `invalidation_channel` pub/sub channel, so every process that
+    writes to a table should have the same local cache configuration.
+
+    Objects are stored as one hash per object by default. Pass
+    `object_format='blob'` to store each one as a single compact msgpack
+    blob instead (see `BlobObjectFormat`).
     '''
     # pylint: disable=too-few-public-methods
 
     DEFAULT_TTL = 3600
+    BULK_CHUNK_SIZE = 500
+
+    # Objects written together would otherwise expire together, so each
+    # write's TTL is randomly stretched or shrunk by up to this fraction.
+    TTL_JITTER = 0.1
+
+    # Objects also carry their absolute expiry time and how long they took to
+    # load, so readers can refresh them early with a probability that rises
+    # as expiry approaches (the XFetch algorithm). Higher values of beta
+    # favor earlier refreshes.
+    XFETCH_BETA = 1.0
+    EXPIRY_FIELD = '__expiry__'
+    DELTA_FIELD = '__delta__'
+
+    # Ids that are known not to exist are cached (if the model's cache policy
+    # has a negative TTL) as an object containing only this field.
+    ABSENT_FIELD = '__absent__'
+
+    OBJECT_FORMATS = {
+        'hash': HashObjectFormat,
+        'blob': BlobObjectFormat
+    }
 
     def __init__(self, *args, **settings):
         self._settings = {
@@ -131,6 +861,20 @@ class Redis(object):
         self._conn = None
         self._pool = redis.ConnectionPool(**self._settings)
         self.encoder = MessagePackEncoder()
+        self.object_format = self.OBJECT_FORMATS[
+            settings.get('object_format', 'hash')](self.encoder)
+
+        self.local_cache = None
+        self.invalidation_channel = settings.get(
+            'invalidation_channel', 'f5:invalidate')
+        self._origin = os.urandom(8).hex()
+        self._listener = None
+        self._listener_lock = threading.Lock()
+
+        if settings.get('local_cache_size'):
+            self.local_cache = LocalCache(
+                settings['local_cache_size'],
+                settings.get('local_cache_ttl', LocalCache.DEFAULT_TTL))
 
     def __enter__(self):
         self._conn = redis.StrictRedis(connection_pool=self._pool)
@@ -198,67 +942,209 @@ class Redis(object):
         with self as redis:
             redis.delete(key.encode('utf-8'))
 
-    def set_hash(self, model, retries=None):
+    # Writes everything the cache keeps for a model in one atomic step: its
+    # hash ('{table}:{id}:hash'), the reverse mapping from the hash to the
+    # object's key (replacing the mapping from its previous hash), then the
+    # object itself and its TTL. The hash key and reverse mapping expire a
+    # few seconds before the object, in that order, so neither can outlast
+    # what it points to. KEYS are the hash key, the model's hash, and the
+    # object key; ARGV is the object's '{table}:{id}' key for the reverse
+    # mapping, the object's TTL, the object format, and the format's
+    # script_values.
+    WRITE_MODEL_SCRIPT = '''
+        local old = redis.call('get', KEYS[1])
+        if old and old ~= KEYS[2] then
+            redis.call('del', old)
+        end
+        redis.call('set', KEYS[1], KEYS[2], 'EX', math.max(ARGV[2] - 2, 1))
+        redis.call('set', KEYS[2], ARGV[1], 'EX', math.max(ARGV[2] - 4, 1))
+        if ARGV[3] == 'hash' then
+            redis.call('del', KEYS[3])
+            redis.call('hset', KEYS[3], unpack(ARGV, 4))
+        else
+            redis.call('set', KEYS[3], ARGV[4])
+        end
+        redis.call('expire', KEYS[3], ARGV[2])
+    '''
+
+    # Like WRITE_MODEL_SCRIPT, but for an update that only changed some of
+    # a model's fields: only those are set in the cached hash. If the object
+    # isn't cached (or is cached as absent) nothing is written and the
+    # script returns 0, so the caller can write the whole object instead.
+    # The third ARGV is the negative cache marker field rather than the
+    # object format.
+    UPDATE_FIELDS_SCRIPT = '''
+        if redis.call('exists', KEYS[3]) == 0 or
+                redis.call('hexists', KEYS[3], ARGV[3]) == 1 then
+            return 0
+        end
+        local old = redis.call('get', KEYS[1])
+        if old and old ~= KEYS[2] then
+            redis.call('del', old)
+        end
+        redis.call('set', KEYS[1], KEYS[2], 'EX', math.max(ARGV[2] - 2, 1))
+        redis.call('set', KEYS[2], ARGV[1], 'EX', math.max(ARGV[2] - 4, 1))
+        redis.call('hset', KEYS[3], unpack(ARGV, 4))
+        redis.call('expire', KEYS[3], ARGV[2])
+        return 1
+    '''
+
+    # Removes a model's hash key and the reverse mapping it points to
+    DELETE_HASH_SCRIPT = '''
+        local old = redis.call('get', KEYS[1])
+        if old then
+            redis.call('del', old)
+        end
+        return redis.call('del', KEYS[1])
+    '''
+
+    def write_models(self, written=(), evicted=(), updated=()):
         '''
-        Set the hash for an object...
+        Bring the cache up to date after a batch of writes in one pipeline.
+        Each model in `written` has its object, hash, and reverse mapping
+        written by WRITE_MODEL_SCRIPT, and each model in `evicted` has them
+        removed.
+
+        `updated` is a list of (model, fields) pairs for models that were
+        updated, where fields is the set of column names that changed. With
+        the hash object format, only those fields are written if the object
+        is already cached; otherwise the whole object is written.
+
+        All of the models are dropped from the local cache of every process.
         '''
-        obj_key = self.build_key(model)
-        hash_key = '{key}:hash'.format(key=obj_key).encode('utf-8')
-        model_hash = model.hash
+        keys = []
+        written = list(written)
+
+        if not self.object_format.partial_writes:
+            written += [model for model, _ in updated]
+            updated = ()
 
         with self as redis:
-            with redis.pipeline() as pipe:
-                while 1:
-                    try:
-                        pipe.watch(hash_key)
-                        old_hash = pipe.get(hash_key)
-
-                        pipe.multi()
-                        if old_hash:
-                            pipe.delete(old_hash)
-
-                        # When we set the hash values, we also set expiration
-                        # TTLs. The hash itself should expire before the hash
-                        # key ('{model}:{id}:hash') since we definitely don't
-                        # want it outlasting the hash key.
-                        pipe.set(hash_key, model_hash)
-                        pipe.expire(hash_key, self.DEFAULT_TTL - 2)
-                        pipe.set(model_hash, obj_key.encode('utf-8'))
-                        pipe.expire(model_hash, self.DEFAULT_TTL - 4)
-                        pipe.execute()
+            with redis.pipeline(transaction=False) as pipe:
+                updated = list(updated)
 
-                        break
-                    except redis.WatchError:
-                        continue
+                for model, fields in updated:
+                    self._queue_write(pipe, model, fields)
+                    keys.append(self.object_key(model))
 
-    def delete_hash(self, model):
+                results = pipe.execute() if updated else []
+
+                # Objects that weren't cached get written in full
+                written += [model for (model, _), result in zip(updated, results)
+                            if not result]
+
+                for model in written:
+                    self._queue_write(pipe, model)
+                    keys.append(self.object_key(model))
+
+                for model in evicted:
+                    pipe.eval(self.DELETE_HASH_SCRIPT, 1,
+                              '{0}:hash'.format(self.build_key(model)))
+                    pipe.delete(self.object_key(model))
+                    keys.append(self.object_key(model))
+
+                if self.local_cache is not None:
+                    for key in keys:
+                        pipe.publish(self.invalidation_channel,
+                                     '{0} {1}'.format(self._origin, key))
+
+                pipe.execute()
+
+        if self.local_cache is not None:
+            for key in keys:
+                self.local_cache.invalidate(key)
+
+    def delete_objects(self, model_class, ids):
         '''
-        Delete the hash for an object
+        Remove the cached objects, or negative cache entries, of a model
+        class for a list of ids, and drop them from the local cache of every
+        process. Their hashes are left to expire.
         '''
-        obj_key = self.build_key(model)
-        hash_key = '{key}:hash'.format(key=obj_key).encode('utf-8')
+        keys = [self.object_key(model_class, id) for id in ids]
+
+        if not keys:
+            return
 
         with self as redis:
-            with redis.pipeline() as pipe:
-                while 1:
-                    try:
-                        pipe.watch(hash_key)
-                        old_hash = pipe.get(hash_key)
+            with redis.pipeline(transaction=False) as pipe:
+                pipe.delete(*keys)
 
-                        pipe.multi()
-                        if old_hash:
-                            pipe.delete(old_hash)
+                if self.local_cache is not None:
+                    for key in keys:
+                        pipe.publish(self.invalidation_channel,
+                                     '{0} {1}'.format(self._origin, key))
 
-                        pipe.delete(hash_key)
-                        pipe.execute()
+                pipe.execute()
 
-                        break
-                    except WatchError:
-                        continue
+        if self.local_cache is not None:
+            for key in keys:
+                self.local_cache.invalidate(key)
 
-    def set_object(self, model):
+    def set_hash(self, model):
         '''
-        Set values for each of a model's fields in redis.
+        Write a model to the cache, along with its hash and the hash's
+        reverse mapping. (The hash can't be written on its own without
+        leaving it out of step with the object, so this is `write_models`
+        for one model.)
+        '''
+        self.write_models(written=[model])
+
+    def delete_hash(self, model):
+        '''
+        Delete the hash for an object and its reverse mapping
+        '''
+        with self as redis:
+            redis.eval(self.DELETE_HASH_SCRIPT, 1,
+                       '{0}:hash'.format(self.build_key(model)))
+
+    def delete_object(self, model):
+        '''
+        Deletes the cached object for the specified model, along with its
+        hash, from redis and from every process's local cache
+        '''
+        self.write_models(evicted=[model])
+
+    def invalidate(self, model):
+        '''
+        Drop a model from the local cache of every process. This process's
+        copy is dropped immediately and other processes are notified over the
+        invalidation channel.
+        '''
+        if self.local_cache is None:
+            return
+
+        key = self.object_key(model)
+        self.local_cache.invalidate(key)
+
+        with self as redis:
+            redis.publish(self.invalidation_channel,
+                          '{0} {1}'.format(self._origin, key))
+
+    def _queue_write(self, pipe, model, fields=None):
+        '''
+        Queue the script that writes a model to the cache, or only the given
+        fields of it
+        '''
+        obj_key = self.build_key(model)
+        ttl = self.object_ttl(model)
+        meta = self._object_meta(ttl)
+
+        if fields is None:
+            pipe.eval(self.WRITE_MODEL_SCRIPT, 3,
+                      '{0}:hash'.format(obj_key), model.hash, self.object_key(model),
+                      obj_key, ttl, self.object_format.name,
+                      *self.object_format.script_values(model, meta))
+        else:
+            pipe.eval(self.UPDATE_FIELDS_SCRIPT, 3,
+                      '{0}:hash'.format(obj_key), model.hash, self.object_key(model),
+                      obj_key, ttl, self.ABSENT_FIELD,
+                      *self.object_format.script_values(model, meta, fields))
+
+    def set_object(self, model, delta=None):
+        '''
+        Set values for each of a model's fields in redis. Pass the number of
+        seconds it took to load the model as `delta` to have readers refresh
+        it shortly before it expires.
         '''
 
         # >>> model.table_name
@@ -282,52 +1168,433 @@ class Redis(object):
         #     'birthday': b'...'
         # }
 
-        # TODO: Figure out how to encode references in msgpack
-        # 'person:42:friends', ['person:12', 'person:92']
-
-        key = self.build_key(model)
-        mapitems = dict(model.fields)  # .items()
-        del mapitems['id']
+        # References are cached separately, as sets of ids under keys like
+        # 'person:42:friends' (see `link_key`)
 
-        mapping = {
-            key.encode('utf-8'): self.encoder.encode(val)
-            for key, val in mapitems.items()
-        }
+        key = self.object_key(model)
+        ttl = self.object_ttl(model)
 
         with self as redis:
-            response = redis.hmset(key, mapping)
-            redis.expire(key, self.DEFAULT_TTL)
+            with redis.pipeline(transaction=False) as pipe:
+                self.object_format.write(pipe, key, model, self._object_meta(ttl, delta))
+                pipe.expire(key, ttl)
+                response = pipe.execute()[0]
 
+        self._cache_locally(key, model.fields)
         return response
 
-    def get_object(self, model_class, id):
+    def set_objects(self, models, chunk_size=None, delta=None):
         '''
-        Get all field values for a model class specified by id.
+        Set the field values for each model in a list in a single pipeline.
+        Very large lists are sent in chunks of `chunk_size` models so that
+        neither side has to buffer the whole batch. See `set_object` for the
+        meaning of `delta`; for models read by one query, it's the time the
+        whole query took.
         '''
+        if chunk_size is None:
+            chunk_size = self.BULK_CHUNK_SIZE
 
-        key = self.build_key(model_class.table_name, id=id)
+        if not models:
+            return
 
         with self as redis:
-            mapping = redis.hgetall(key)
+            with redis.pipeline(transaction=False) as pipe:
+                for idx, model in enumerate(models, 1):
+                    key = self.object_key(model)
+                    ttl = self.object_ttl(model)
+                    self.object_format.write(pipe, key, model, self._object_meta(ttl, delta))
+                    pipe.expire(key, ttl)
 
-        if mapping:
-            data = {
-                str(key, encoding='utf-8'): self.encoder.decode(val)
-                for key, val in mapping.items()
-            }
-            model = model_class(data)
-            model.id = int(id)
-            return model
-        else:
-            return None
+                    if idx % chunk_size == 0:
+                        pipe.execute()
 
-    def delete_object(self, model):
+                pipe.execute()
+
+        for model in models:
+            self._cache_locally(self.object_key(model), model.fields)
+
+    def get_object(self, model_class, id, missing=None):
+        '''
+        Get all field values for a model class specified by id. Returns None
+        if the object isn't cached, or `missing` if it's cached as not
+        existing.
         '''
-        Deletes all values for the specified model in redis.
+        return self.get_objects(model_class, [id], missing=missing)[0]
+
+    def get_objects(self, model_class, ids, missing=None):
+        '''
+        Get the models of a class for each id in a list, fetching all of
+        their field values in a single round trip. The returned list is in
+        the same order as the ids, with None in place of any uncached objects
+        and `missing` in place of any objects cached as not existing.
         '''
-        key = self.build_key(model)
+        keys = [self.object_key(model_class, id) for id in ids]
+        found = {}
+
+        if self.local_cache is not None:
+            for key in keys:
+                data = self.local_cache.get(key)
+
+                if data is not None and not self._is_stale(data):
+                    found[key] = data
+
+        uncached = [key for key in keys if key not in found]
+        invalid = []
+
+        if uncached:
+            with self as redis:
+                values = self.object_format.read_many(redis, uncached)
+
+            for key, value in zip(uncached, values):
+                data = self.object_format.decode(model_class, value)
+
+                if data is INVALID:
+                    invalid.append(key)
+                elif data is not None and not self._is_stale(data):
+                    self._cache_locally(key, data)
+                    found[key] = data
+
+        if invalid:
+            with self as redis:
+                redis.delete(*invalid)
+
+        return [
+            self._build_model(model_class, id, found[key], missing) if key in found else None
+            for id, key in zip(ids, keys)
+        ]
+
+    def set_missing(self, model_class, ids):
+        '''
+        Remember that the objects of a model class with the specified ids
+        don't exist. Does nothing unless the class's cache policy has a
+        negative TTL.
+        '''
+        ttl = model_class.cache_policy.negative_ttl
+
+        if not ttl or not ids:
+            return
 
         with self as redis:
-            response = redis.delete(key)
+            with redis.pipeline(transaction=False) as pipe:
+                for id in ids:
+                    key = self.object_key(model_class, id)
+                    self.object_format.write_missing(pipe, key, model_class)
+                    pipe.expire(key, ttl)
 
-        return response
+                pipe.execute()
+
+    def object_key(self, model_class, id=None):
+        '''
+        Return the key a cached object is stored under. Pass either a model
+        instance, or a model class and an id.
+        '''
+        if id is None:
+            id = model_class.id
+
+        return self.object_format.key(model_class.table_name, id)
+
+    def object_ttl(self, model_class=None):
+        '''
+        Return a TTL for a newly written object, jittered so that objects
+        written at the same time don't all expire at the same time. The base
+        TTL comes from the model class's cache policy if it sets one.
+        '''
+        policy = getattr(model_class, 'cache_policy', None)
+        ttl = (policy and policy.ttl) or self.DEFAULT_TTL
+        jitter = random.uniform(-self.TTL_JITTER, self.TTL_JITTER)
+        return max(1, int(ttl * (1 + jitter)))
+
+    def _object_meta(self, ttl, delta=None):
+        '''
+        Return the metadata fields stored alongside an object: its expiry time
+        and, if known, how long it took to load
+        '''
+        meta = {self.EXPIRY_FIELD: time.time() + ttl}
+
+        if delta is not None:
+            meta[self.DELTA_FIELD] = delta
+
+        return meta
+
+    def _is_stale(self, data):
+        '''
+        True if a cached object should be treated as a miss so that the caller
+        refreshes it ahead of its expiry. The probability increases the closer
+        the object is to expiring and the longer it took to load.
+        '''
+        delta = data.get(self.DELTA_FIELD)
+        expiry = data.get(self.EXPIRY_FIELD)
+
+        if not delta or expiry is None:
+            return False
+
+        # log(U) for U in (0, 1] is never positive, so this is `now` pushed
+        # forward by a random, usually small, multiple of delta.
+        draw = math.log(1.0 - random.random())
+        return time.time() - delta * self.XFETCH_BETA * draw >= expiry
+
+    def _build_model(self, model_class, id, data, missing=None):
+        '''
+        Return a model instance populated with decoded field values, or
+        `missing` if the values are a negative cache marker
+        '''
+        if self.ABSENT_FIELD in data:
+            return missing
+
+        model = model_class(data)
+        model.id = int(id)
+        return model
+
+    def _cache_locally(self, key, data):
+        '''
+        Keep a copy of an object's decoded field values in the local cache
+        '''
+        if self.local_cache is None:
+            return
+
+        if self._listener is None:
+            self.start_invalidation_listener()
+
+        self.local_cache.set(key, dict(data))
+
+    def start_invalidation_listener(self):
+        '''
+        Start a background thread that drops objects from the local cache
+        when other processes publish invalidations for them
+        '''
+        with self._listener_lock:
+            if self._listener is not None:
+                return
+
+            with self as redis:
+                pubsub = redis.pubsub(ignore_subscribe_messages=True)
+
+            pubsub.subscribe(**{self.invalidation_channel: self._handle_invalidation})
+            self._listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def stop_invalidation_listener(self):
+        '''
+        Stop the invalidation listener thread
+        '''
+        with self._listener_lock:
+            if self._listener is not None:
+                self._listener.stop()
+                self._listener = None
+
+    def _handle_invalidation(self, message):
+        '''
+        Drop the object named in an invalidation message from the local cache,
+        unless this process sent the message
+        '''
+        origin, key = str(message['data'], encoding='utf-8').split(' ', 1)
+
+        if origin != self._origin:
+            self.local_cache.invalidate(key)
+
+    # Link sets always contain this member, so a cached empty set still
+    # exists and can be told apart from one that isn't cached
+    LINK_SENTINEL = ''
+
+    ADD_LINKS_SCRIPT = '''
+        if redis.call('exists', KEYS[1]) == 1 then
+            return redis.call('sadd', KEYS[1], unpack(ARGV))
+        end
+        return 0
+    '''
+
+    def link_key(self, result_class, model):
+        '''
+        Return the key of the set of ids of `result_class` records linked to
+        a model, e.g. 'person:42:pet'
+        '''
+        return '{0}:{1}:{2}'.format(
+            model.table_name, model.id, result_class.table_name)
+
+    def get_links(self, result_class, models):
+        '''
+        Return the cached ids of the `result_class` records linked to each
+        model in a list, fetched in one round trip. Each entry is a list of
+        id strings in ascending order, or None if that model's links aren't
+        cached.
+        '''
+        with self as redis:
+            with redis.pipeline(transaction=False) as pipe:
+                for model in models:
+                    pipe.smembers(self.link_key(result_class, model))
+
+                results = pipe.execute()
+
+        links = []
+
+        for members in results:
+            if not members:
+                links.append(None)
+            else:
+                # Sorting by length first puts numeric ids in numeric order
+                links.append(sorted((
+                    str(member, encoding='utf-8') for member in members
+                    if member != self.LINK_SENTINEL.encode('utf-8')
+                ), key=lambda id: (len(id), id)))
+
+        return links
+
+    def set_links(self, result_class, links):
+        '''
+        Cache the complete set of linked ids for each (model, ids) pair in a
+        list, replacing whatever was cached
+        '''
+        ttl = self.object_ttl(result_class)
+
+        with self as redis:
+            with redis.pipeline(transaction=False) as pipe:
+                for model, ids in links:
+                    key = self.link_key(result_class, model)
+                    pipe.delete(key)
+                    pipe.sadd(key, self.LINK_SENTINEL, *ids)
+                    pipe.expire(key, ttl)
+
+                pipe.execute()
+
+    def add_links(self, result_class, model, ids):
+        '''
+        Add ids to a model's cached link set. Nothing is written if the set
+        isn't cached, since it would then hold only the new ids.
+        '''
+        if not ids:
+            return
+
+        with self as redis:
+            redis.eval(self.ADD_LINKS_SCRIPT, 1,
+                       self.link_key(result_class, model), *ids)
+
+    def remove_links(self, result_class, model, ids):
+        '''
+        Remove ids from a model's cached link set
+        '''
+        if not ids:
+            return
+
+        with self as redis:
+            redis.srem(self.link_key(result_class, model), *ids)
+
+    def has_link(self, result_class, model, id):
+        '''
+        Return whether a model's cached link set contains an id, or None if
+        the set isn't cached
+        '''
+        key = self.link_key(result_class, model)
+
+        with self as redis:
+            with redis.pipeline(transaction=False) as pipe:
+                pipe.exists(key)
+                pipe.sismember(key, id)
+                exists, member = pipe.execute()
+
+        return bool(member) if exists else None
+
+    RELEASE_LOCK_SCRIPT = '''
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('del', KEYS[1])
+        end
+        return 0
+    '''
+
+    def acquire_lock(self, key, ttl):
+        '''
+        Try to take a short-lived lock named `key` that expires after `ttl`
+        milliseconds. Returns a token to pass to `release_lock` if the lock
+        was acquired and None if someone else holds it.
+        '''
+        token = os.urandom(8).hex()
+
+        with self as redis:
+            acquired = redis.set('{0}:lock'.format(key), token, nx=True, px=ttl)
+
+        return token if acquired else None
+
+    def release_lock(self, key, token):
+        '''
+        Release a lock taken with `acquire_lock`, unless it has expired and
+        been taken by someone else in the meantime
+        '''
+        with self as redis:
+            redis.eval(self.RELEASE_LOCK_SCRIPT, 1, '{0}:lock'.format(key), token)
+
+    # A table's generation counter changes whenever the object store writes
+    # to it, and cached counts and query results are stored with the
+    # generations of the tables they read. A counter that doesn't exist
+    # (or was evicted) starts from the clock, in microseconds, so it can't
+    # come back with a value that a cached entry was stored under.
+    BUMP_GENERATIONS_SCRIPT = '''
+        for _, key in ipairs(KEYS) do
+            if redis.call('exists', key) == 1 then
+                redis.call('incr', key)
+            else
+                redis.call('set', key, ARGV[1])
+            end
+        end
+    '''
+
+    def generation_key(self, table_name):
+        '''
+        Return the key of a table's generation counter
+        '''
+        return '{0}:generation'.format(table_name)
+
+    def generations(self, table_names):
+        '''
+        Return the current generation of each table in a list
+        '''
+        keys = [self.generation_key(name) for name in table_names]
+
+        with self as redis:
+            values = redis.mget(keys)
+            missing = [key for key, value in zip(keys, values) if value is None]
+
+            if missing:
+                start = int(time.time() * 1000000)
+
+                with redis.pipeline(transaction=False) as pipe:
+                    for key in missing:
+                        pipe.set(key, start, nx=True)
+
+                    pipe.mget(keys)
+                    values = pipe.execute()[-1]
+
+        return [int(value) for value in values]
+
+    def bump_generations(self, table_names):
+        '''
+        Advance the generation of each table in a list, making everything
+        cached with the old generations stale
+        '''
+        if not table_names:
+            return
+
+        with self as redis:
+            redis.eval(self.BUMP_GENERATIONS_SCRIPT, len(table_names),
+                       *[self.generation_key(name) for name in table_names],
+                       int(time.time() * 1000000))
+
+    def get_versioned(self, key, generations):
+        '''
+        Return the value cached under `key` if it was stored with the given
+        table generations, or MISSING if it wasn't cached or is stale
+        '''
+        with self as redis:
+            data = redis.get(key)
+
+        if data is None:
+            return MISSING
+
+        stored, value = self.encoder.decode(data)
+        return value if list(stored) == list(generations) else MISSING
+
+    def set_versioned(self, key, generations, value, ttl=None):
+        '''
+        Cache a value under `key` along with the table generations it was
+        computed from
+        '''
+        with self as redis:
+            redis.set(key, self.encoder.encode([list(generations), value]),
+                      ex=ttl or self.DEFAULT_TTL)
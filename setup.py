@@ -10,7 +10,7 @@ setup(
     description = "Use F5 to build more powerful Tornado apps",
     license = "MIT",
     install_requires = [
-        'msgpack',
+        'msgpack>=1.0',
         'tornado'
     ],
     keywords = "tornado orm rest api",
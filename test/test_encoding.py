@@ -0,0 +1,243 @@
+'''
+Tests for model encodings
+'''
+
+from unittest import TestCase, skipIf
+from datetime import date, time, datetime, timedelta, timezone
+from decimal import Decimal
+import json
+
+import msgpack
+
+from f5.encoding import JSON_BACKENDS, JSONBackend, MessagePackEncoder
+from f5.encoding import ModelJSONEncoder
+from f5.encoding import ModelSerializer, get_json_backend, orjson
+
+
+class TestMessagePackEncoder(TestCase):
+
+    def setUp(self):
+        self.encoder = MessagePackEncoder()
+
+    def assertRoundTrips(self, value):
+        decoded = self.encoder.decode(self.encoder.encode(value))
+        self.assertEqual(decoded, value)
+        self.assertIs(type(decoded), type(value))
+
+    def test_rich_types(self):
+        '''
+        datetimes, dates, times, timedeltas, and decimals survive a round trip
+        '''
+        self.assertRoundTrips(datetime(1928, 8, 6, 12, 30, 15, 123456))
+        self.assertRoundTrips(date(1928, 8, 6))
+        self.assertRoundTrips(time(23, 59, 59, 999999))
+        self.assertRoundTrips(timedelta(days=-2, seconds=5, microseconds=7))
+        self.assertRoundTrips(Decimal('-1234.5678'))
+
+    def test_aware_values_keep_their_offset(self):
+        '''
+        timezone-aware datetimes and times keep their UTC offset
+        '''
+        tz = timezone(timedelta(hours=-5))
+        value = datetime(2015, 3, 1, 9, 0, tzinfo=tz)
+        decoded = self.encoder.decode(self.encoder.encode(value))
+
+        self.assertEqual(decoded, value)
+        self.assertEqual(decoded.utcoffset(), timedelta(hours=-5))
+        self.assertRoundTrips(time(9, 0, tzinfo=tz))
+
+    def test_nested_values(self):
+        '''
+        rich types are encoded inside lists and maps
+        '''
+        value = {'when': date(2015, 1, 1), 'prices': (Decimal('1.50'), None)}
+        self.assertEqual(self.encoder.decode(self.encoder.encode(value)), value)
+
+    def test_legacy_format(self):
+        '''
+        values written in the old {'__type__', '__repr__'} format still decode
+        '''
+        def legacy(type, repr):
+            return msgpack.packb({'__type__': type, '__repr__': repr}, use_bin_type=True)
+
+        decode = self.encoder.decode
+        self.assertEqual(decode(legacy('datetime', '1928-08-06T12:30:15.000001Z')),
+                         datetime(1928, 8, 6, 12, 30, 15, 1))
+        self.assertEqual(decode(legacy('date', '1928-08-06')), date(1928, 8, 6))
+        self.assertEqual(decode(legacy('time', '12:30:15.000001Z')), time(12, 30, 15, 1))
+        self.assertEqual(decode(legacy('timedelta', 90.5)), timedelta(seconds=90.5))
+        self.assertEqual(decode(legacy('decimal', '1.10')), Decimal('1.10'))
+
+    def test_unsupported_types(self):
+        '''
+        values msgpack can't represent raise TypeError
+        '''
+        with self.assertRaises(TypeError):
+            self.encoder.encode(object())
+
+
+class FakeModel(object):
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    @property
+    def public_dict(self):
+        return self.fields
+
+
+class TestModelSerializer(TestCase):
+
+    def test_types_are_learned_and_rechecked(self):
+        '''
+        converters come from the first row and adapt to later values
+        '''
+        serializer = ModelSerializer({Decimal: str, date: date.isoformat})
+        rows = serializer.convert_all([
+            {'price': Decimal('1.5'), 'day': None, 'name': 'a'},
+            {'price': 3, 'day': date(2001, 2, 3), 'name': 'b'},
+            {'price': Decimal('2'), 'day': date(2001, 2, 4), 'name': 'c'},
+        ])
+
+        self.assertEqual(rows, [
+            {'price': '1.5', 'day': None, 'name': 'a'},
+            {'price': 3, 'day': '2001-02-03', 'name': 'b'},
+            {'price': '2', 'day': '2001-02-04', 'name': 'c'},
+        ])
+
+    def test_rows_are_copied(self):
+        '''
+        converting a row leaves the original dictionary alone
+        '''
+        row = {'price': Decimal('1.5')}
+        ModelSerializer({Decimal: str}).convert(row)
+        self.assertEqual(row, {'price': Decimal('1.5')})
+
+    def test_msgpack_model_fields(self):
+        '''
+        precompiled fields pack to the same bytes as the raw fields
+        '''
+        encoder = MessagePackEncoder()
+        model = FakeModel({'id': 1, 'price': Decimal('1.5'),
+                           'created': datetime(2001, 2, 3, 4, 5, 6)})
+
+        self.assertEqual(encoder.encode(encoder.model_fields(model)),
+                         encoder.encode(model.fields))
+
+
+class TestJSONBackends(TestCase):
+    '''
+    Every backend must decode to the same values as the standard library
+    '''
+
+    VALUES = [
+        None, True, False, 0, -1, 2 ** 63 - 1, 1.5, -0.25, 3.141592653589793,
+        '', 'plain', 'quote " backslash \\ slash /', 'tab\tnewline\n\x00\x1f',
+        'café ☃ \U0001f600', '  ',
+        [], {}, [1, [2, [3]]], (1, 2), {'a': {'b': [None]}},
+        {1: 'int key', 'x': 'str key'},
+        Decimal('0'), Decimal('12.50'), Decimal('-0.001'), Decimal('1E+3'),
+        datetime(1928, 8, 6, 12, 30, 15, 123456),
+        datetime(2020, 2, 29, 23, 59, 59, tzinfo=timezone.utc),
+        date(1999, 12, 31), time(7, 5, 3, 999), time(7, 5, 3, tzinfo=timezone.utc),
+        timedelta(hours=26, minutes=3, seconds=4), timedelta(0),
+        FakeModel({'id': 1, 'name': 'Nø', 'price': Decimal('9.99'),
+                   'created': datetime(2015, 1, 1),
+                   'pets': [FakeModel({'id': 2})]}),
+        [FakeModel({'id': 1, 'price': None, 'created': date(2001, 1, 1)}),
+         FakeModel({'id': 2, 'price': Decimal('1.10'), 'created': None}),
+         FakeModel({'id': 3, 'price': 7, 'created': datetime(2001, 1, 1)})],
+        {'items': [FakeModel({'id': 1}), FakeModel({'id': 2})], 'next': None},
+    ]
+
+    # Values the backends are most likely to disagree on
+    EDGE_VALUES = [
+        1e16, 1.5e-07, -2.5e300, 5e-324, float('nan'), float('inf'),
+        [float('-inf'), 1.0], 2 ** 64, -2 ** 100, {'big': [2 ** 70, 1]},
+        'naïve façade', '日本語', '\u2028\u2029', {'ключ': 'значение'},
+        datetime(1, 1, 1), datetime(9999, 12, 31, 23, 59, 59, 999999),
+        datetime(2015, 6, 1, 8, tzinfo=timezone(timedelta(hours=-7))),
+        [date(2000, 1, 1), time(0, 0), {'at': datetime(2015, 1, 1, 0, 0, 1)}],
+    ]
+
+    @staticmethod
+    def decode(encoded):
+        '''
+        Decode backend output, reading NaN and infinity the way orjson
+        writes them
+        '''
+        return json.loads(encoded.decode('utf-8'),
+                          parse_constant=lambda constant: None)
+
+    def assertConforms(self, backend):
+        reference = get_json_backend('json')
+
+        for value in self.VALUES + self.EDGE_VALUES:
+            self.assertEqual(self.decode(backend.dumps(value)),
+                             self.decode(reference.dumps(value)), value)
+
+    def test_standard_library(self):
+        '''
+        the standard library backend writes what json.dumps always has
+        '''
+        backend = get_json_backend('json')
+
+        for value in self.VALUES + self.EDGE_VALUES:
+            self.assertEqual(backend.dumps(value),
+                             json.dumps(value, cls=ModelJSONEncoder).encode(
+                                 'utf-8'), value)
+
+    @skipIf(orjson is None, 'orjson is not installed')
+    def test_orjson(self):
+        '''
+        the orjson backend decodes to the same values as the standard library
+        '''
+        self.assertConforms(get_json_backend('orjson'))
+
+    @skipIf(orjson is None, 'orjson is not installed')
+    def test_orjson_edge_cases(self):
+        '''
+        orjson writes non-finite floats as null and falls back to the
+        standard library for integers wider than 64 bits
+        '''
+        backend = get_json_backend('orjson')
+
+        self.assertEqual(backend.dumps([float('nan'), float('inf')]),
+                         b'[null,null]')
+        self.assertEqual(backend.dumps({'big': [2 ** 70, 'ü']}),
+                         get_json_backend('json').dumps(
+                             {'big': [2 ** 70, 'ü']}))
+
+    def test_unsupported_types(self):
+        '''
+        every backend raises TypeError for values it can't encode
+        '''
+        for name in JSON_BACKENDS:
+            if name == 'orjson' and orjson is None:
+                continue
+
+            with self.assertRaises(TypeError):
+                get_json_backend(name).dumps({'x': object()})
+
+    def test_backends_must_encode(self):
+        '''
+        a backend class that doesn't implement encode can't be instantiated
+        '''
+        class Incomplete(JSONBackend):
+            name = 'incomplete'
+
+        with self.assertRaises(TypeError):
+            Incomplete()
+
+    def test_backend_selection(self):
+        '''
+        backends are shared, the standard library is the default, and
+        auto-detection prefers orjson
+        '''
+        self.assertIs(get_json_backend('json'), get_json_backend('json'))
+        self.assertEqual(get_json_backend().name, 'json')
+        self.assertEqual(get_json_backend('auto').name,
+                         'orjson' if orjson else 'json')
+
+        with self.assertRaises(ValueError):
+            get_json_backend('yaml')
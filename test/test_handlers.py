@@ -4,13 +4,19 @@ Tests for basic HTTP request handling
 
 from unittest import TestCase
 from urllib import parse
+from decimal import Decimal
+import threading
 
-from tornado.web import Application
+from tornado.testing import AsyncHTTPTestCase
+
+from tornado.web import Application, HTTPError
 from tornado.httputil import HTTPHeaders
 from tornado.httputil import HTTPConnection
 from tornado.httputil import HTTPServerRequest
 
-from f5.handlers import BaseRequestHandler
+from f5.encoding import get_json_backend
+from f5.handlers import BaseRequestHandler, JSONRequestHandler
+from f5.services import ObjectStore
 
 
 class TestBuildURL(TestCase):
@@ -19,7 +25,7 @@ class TestBuildURL(TestCase):
         def set_close_callback(_, *args, **kwargs):
             return None
 
-        app = Application()
+        app = Application(cookie_secret='secret')
         app.configuration = {
                 'tornado': {'debug': True}
             }
@@ -95,3 +101,141 @@ class TestBuildURL(TestCase):
         url = handler.build_url('/', query={'a': 'apple', 'b': 'banana'})
         self.assertEqual(get_query_args(url), {'a': ['apple'], 'b': ['banana']})
 
+
+    def test_cursor(self):
+        '''
+        build_url adds a quoted cursor that decodes to the last row's keys
+        '''
+        handler = self.get_handler()
+        token = handler.create_cursor({'id': 9, 'age': 30}, 'age', False)
+        url = handler.build_url('/', query={'a': 'apple'}, cursor=token)
+        args = parse.parse_qs(parse.urlparse(url).query)
+
+        self.assertEqual(args, {'a': ['apple'], 'cursor': [token]})
+        self.assertEqual(handler.decode_cursor(token, 'age', False), (30, 9))
+
+    def test_invalid_cursor(self):
+        '''
+        forged cursors and cursors for a different sort are rejected
+        '''
+        handler = self.get_handler()
+        token = handler.create_cursor({'id': 9, 'age': 30}, 'age')
+        forged = token[:-1] + ('1' if token[-1] == '0' else '0')
+
+        with self.assertRaises(HTTPError):
+            handler.decode_cursor(forged, 'age')
+
+        with self.assertRaises(HTTPError):
+            handler.decode_cursor(token, 'age', ascending=False)
+
+    def test_identity_map(self):
+        '''
+        handlers that opt in get a per-request identity map, cleared when
+        the request finishes
+        '''
+        class MappedHandler(BaseRequestHandler):
+            use_identity_map = True
+
+        store = ObjectStore({})
+        req = HTTPServerRequest(method='GET', uri='/')
+        req.connection = self.conn
+        handler = MappedHandler(self.app, req, object_store=store)
+
+        self.assertIsNot(handler.object_store, store)
+        handler.object_store.identity_map.put(FakeModel({'id': 1}))
+        handler.on_finish()
+        self.assertEqual(len(handler.object_store.identity_map), 0)
+
+
+class FakeModel(dict):
+    table_name = 'fake'
+
+    @property
+    def id(self):
+        return self['id']
+
+
+class StreamingHandler(JSONRequestHandler):
+
+    def initialize(self, **kwargs):
+        self.items = kwargs.pop('items')
+        super(StreamingHandler, self).initialize(**kwargs)
+
+    async def get(self):
+        await self.write_json_stream(self.items(), batch_size=3, chunk_size=10)
+
+
+class TestWriteJSONStream(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.threads = set()
+
+        def items():
+            for i in range(10):
+                self.threads.add(threading.get_ident())
+                yield {'id': i, 'price': Decimal('{0}.50'.format(i))}
+
+        app = Application([
+            (r'/', StreamingHandler, {'items': items}),
+            (r'/empty', StreamingHandler, {'items': lambda: iter([])}),
+        ])
+        app.configuration = {'tornado': {'json_backend': 'json'}}
+        self.expected = get_json_backend('json').dumps(list(items()))
+        self.threads.clear()
+        return app
+
+    def test_stream_matches_write_json(self):
+        '''
+        a streamed response is the same JSON array write_json would send
+        '''
+        response = self.fetch('/')
+
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, self.expected)
+        self.assertEqual(response.headers['Transfer-Encoding'], 'chunked')
+
+    def test_iterables_are_read_off_the_loop(self):
+        '''
+        a plain iterable is read on the executor, not the IOLoop's thread
+        '''
+        self.fetch('/')
+
+        self.assertTrue(self.threads)
+        self.assertNotIn(threading.get_ident(), self.threads)
+
+    def test_empty_stream(self):
+        '''
+        an empty iterable streams an empty array
+        '''
+        self.assertEqual(self.fetch('/empty').body, b'[]')
+
+    def test_jsonp(self):
+        '''
+        streamed responses are wrapped in the JSONP callback
+        '''
+        response = self.fetch('/?callback=handle')
+
+        self.assertEqual(response.headers['Content-Type'],
+                         'application/javascript')
+        self.assertEqual(response.body,
+                         b'/*_*/handle(' + self.expected + b');')
+
+    def test_jsonp_rejects_script(self):
+        '''
+        callbacks that aren't bare identifiers are rejected
+        '''
+        for callback in ('x%3Balert(1)', 'x(1)', 'x%2F%2F', 'x.y'):
+            response = self.fetch('/?callback=' + callback)
+
+            self.assertEqual(response.code, 400)
+            self.assertNotIn(b'alert', response.body)
+
+    def test_callback_is_checked_first(self):
+        '''
+        an invalid callback is rejected before the request body is read
+        '''
+        response = self.fetch('/?callback=x(1)', method='POST', body='{',
+                              headers={'Content-Type': 'application/json'})
+
+        self.assertEqual(response.code, 400)
+        self.assertNotIn(b'JSONDecodeError', response.body)
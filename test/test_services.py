@@ -0,0 +1,1165 @@
+'''
+Tests for the object store
+'''
+
+import asyncio
+from datetime import datetime
+import threading
+import time
+from unittest import TestCase, skipIf
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from f5.models import CachePolicy, Model
+from f5.services import AsyncObjectStore, IdentityMap, ObjectStore
+from f5.services import build_seek_condition, schema_defaults, tsv_field
+from f5.storage import MISSING
+
+from test.test_storage import MemoryRedis, fakeredis
+
+
+class FakeObjectStore(object):
+
+    def __init__(self):
+        self.datastores = {}
+        self.threads = []
+
+    def model_with_id(self, result_class, item_id, use_cache=True):
+        self.threads.append(threading.current_thread())
+        return (result_class, item_id, use_cache)
+
+    def delete(self, model):
+        raise ValueError('cannot delete {0}'.format(model))
+
+    def iter_models_in_range(self, result_class, bounds=None, batch_size=None):
+        try:
+            for item_id in range(5):
+                self.threads.append(threading.current_thread())
+                yield (result_class, item_id)
+        finally:
+            self.closed = True
+
+
+class PooledObjectStore(FakeObjectStore):
+    '''
+    A fake store whose reads need one of a fixed number of connections, which
+    iterators hold until they're closed
+    '''
+
+    def __init__(self, connections):
+        super(PooledObjectStore, self).__init__()
+        self.connections = threading.BoundedSemaphore(connections)
+
+    def model_with_id(self, result_class, item_id, use_cache=True):
+        if not self.connections.acquire(timeout=1):
+            raise RuntimeError('no connection available')
+
+        try:
+            return super(PooledObjectStore, self).model_with_id(
+                result_class, item_id, use_cache)
+        finally:
+            self.connections.release()
+
+    def iter_models_in_range(self, result_class, bounds=None, batch_size=None):
+        if not self.connections.acquire(timeout=1):
+            raise RuntimeError('no connection available')
+
+        try:
+            yield from super(PooledObjectStore, self).iter_models_in_range(
+                result_class, bounds, batch_size)
+        finally:
+            self.connections.release()
+
+
+class TestAsyncObjectStore(AsyncTestCase):
+
+    def setUp(self):
+        super(TestAsyncObjectStore, self).setUp()
+        self.store = FakeObjectStore()
+        self.async_store = AsyncObjectStore(self.store, max_workers=2)
+
+    def tearDown(self):
+        self.async_store.shutdown()
+        super(TestAsyncObjectStore, self).tearDown()
+
+    @gen_test
+    def test_runs_off_the_ioloop_thread(self):
+        '''
+        awaiting a method returns the ObjectStore result from a worker thread
+        '''
+        result = yield self.async_store.model_with_id('item', 42, use_cache=False)
+
+        self.assertEqual(result, ('item', 42, False))
+        self.assertIsNot(self.store.threads[0], threading.current_thread())
+
+    @gen_test
+    def test_exceptions_propagate(self):
+        '''
+        exceptions raised by the ObjectStore are raised by the awaitable
+        '''
+        with self.assertRaises(ValueError):
+            yield self.async_store.delete('item')
+
+    @gen_test
+    def test_iterators(self):
+        '''
+        iter_* methods are async iterators fed from the executor
+        '''
+        results = []
+
+        async def collect():
+            async for item in self.async_store.iter_models_in_range('item', batch_size=2):
+                results.append(item)
+
+        yield collect()
+
+        self.assertEqual(results, [('item', i) for i in range(5)])
+        self.assertNotIn(threading.current_thread(), self.store.threads)
+        self.assertTrue(self.store.closed)
+
+    @gen_test
+    async def test_open_iterators_leave_a_connection(self):
+        '''
+        iterators that aren't being consumed can't take every connection
+        '''
+        store = AsyncObjectStore(PooledObjectStore(2), max_workers=2)
+        first = store.iter_models_in_range('item', batch_size=1)
+        second = store.iter_models_in_range('item', batch_size=1)
+
+        self.assertEqual(await first.__anext__(), ('item', 0))
+
+        waiting = asyncio.ensure_future(second.__anext__())
+        await asyncio.sleep(0.01)
+
+        self.assertFalse(waiting.done())
+        self.assertEqual(await store.model_with_id('item', 7), ('item', 7, True))
+
+        await first.aclose()
+
+        self.assertEqual(await waiting, ('item', 0))
+
+        await second.aclose()
+        store.shutdown()
+
+
+class TestBuildSeekCondition(TestCase):
+
+    def test_first_page(self):
+        '''
+        the first page has no condition
+        '''
+        self.assertEqual(build_seek_condition('age', 'id', True, None), (None, []))
+
+    def test_sort_by_id(self):
+        '''
+        sorting by id compares the id alone
+        '''
+        self.assertEqual(build_seek_condition('id', 'id', False, (7, 7)),
+                         ('id < %s', [7]))
+
+    def test_ties_are_broken_by_id(self):
+        '''
+        rows that tie on the sort column are ordered by id
+        '''
+        condition, values = build_seek_condition('t.age', 't.id', True, (30, 4))
+
+        self.assertEqual(condition, '(t.age > %s OR (t.age = %s AND t.id > %s))')
+        self.assertEqual(values, [30, 30, 4])
+
+
+class Item(object):
+    table_name = 'item'
+
+    def __init__(self, id):
+        self.id = id
+
+
+class TestIdentityMap(TestCase):
+
+    def test_first_instance_wins_on_load(self):
+        '''
+        loading an id twice returns the first instance
+        '''
+        identity_map = IdentityMap()
+        first = identity_map.add(Item(1))
+
+        self.assertIs(identity_map.add(Item(1)), first)
+        self.assertIs(identity_map.get(Item, '1'), first)
+        self.assertIsNone(identity_map.get(Item, 2))
+
+    def test_writes_replace_instances(self):
+        '''
+        a written instance replaces the one in the map, and discard drops it
+        '''
+        identity_map = IdentityMap()
+        identity_map.add(Item(1))
+        written = Item(1)
+        identity_map.put(written)
+
+        self.assertIs(identity_map.get(Item, 1), written)
+
+        identity_map.discard(written)
+        self.assertEqual(len(identity_map), 0)
+
+    def test_with_identity_map(self):
+        '''
+        each copy of a store gets its own map and shares its datastores
+        '''
+        store = ObjectStore({'redis': None})
+        first, second = store.with_identity_map(), store.with_identity_map()
+
+        self.assertIsNone(store.identity_map)
+        self.assertIsNot(first.identity_map, second.identity_map)
+        self.assertIs(first.datastores, store.datastores)
+
+
+class Person(Model):
+    table_name = 'person'
+    columns = ['id', 'name', 'age']
+
+
+class SoftPerson(Person):
+    columns = ['id', 'name', 'age', 'date_deleted']
+
+
+class FakeCursor(object):
+
+    def __init__(self, lock_mode):
+        self.lock_mode = lock_mode
+        self.queries = []
+        self.lastrowid = 100
+        self.result = None
+
+    def execute(self, query, args=None):
+        query = ' '.join(query.split())
+        self.queries.append((query, args))
+
+        if query.startswith('SELECT @@'):
+            self.result = [{'lock_mode': self.lock_mode, 'increment': 2}]
+        elif query.startswith('SELECT'):
+            self.result = [{'id': item_id, 'age': 0} for item_id in args]
+        elif query.startswith('INSERT'):
+            self.lastrowid += 10
+
+    def fetchone(self):
+        return self.result[0]
+
+    def fetchall(self):
+        return self.result
+
+
+class FakeDatabase(object):
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.commits = 0
+
+    def __enter__(self):
+        return (self, self.cursor)
+
+    def __exit__(self, *unused_exc_info):
+        pass
+
+    def commit(self):
+        self.commits += 1
+
+
+class FakeRedis(object):
+
+    def write_models(self, written=(), evicted=(), updated=()):
+        self.written = list(written)
+        self.evicted = list(evicted)
+        self.updated = list(updated)
+
+    def bump_generations(self, table_names):
+        self.bumped = table_names
+
+    def delete_objects(self, model_class, ids):
+        self.deleted = getattr(self, 'deleted', []) + list(ids)
+
+
+class StoreTestCase(TestCase):
+    '''
+    Tests of an ObjectStore over fake datastores
+    '''
+
+    def make_store(self, cursor, redis=None):
+        '''
+        Return a store that reads and writes through one fake database with
+        the given cursor, and caches in redis if it's given. The cursor,
+        database, and cache are kept as attributes for assertions.
+        '''
+        self.cursor = cursor
+        self.database = FakeDatabase(cursor)
+        self.redis = redis
+        datastores = {'mysql_read': self.database, 'mysql_write': self.database}
+
+        if redis is not None:
+            datastores['redis'] = redis
+
+        return ObjectStore(datastores)
+
+
+class TestUnitOfWork(StoreTestCase):
+
+    def people(self, count):
+        people = []
+
+        for idx in range(count):
+            person = Person()
+            person['name'] = 'p{0}'.format(idx)
+            people.append(person)
+
+        return people
+
+    def test_multi_row_insert(self):
+        '''
+        creates are one INSERT, with ids counted from the first row's id
+        '''
+        store = self.make_store(FakeCursor(1), FakeRedis())
+        people = self.people(3)
+
+        with store.unit_of_work() as work:
+            for person in people:
+                work.create(person)
+
+        inserts = [q for q, _ in self.cursor.queries if q.startswith('INSERT')]
+        self.assertEqual(inserts, [
+            'INSERT INTO `person` (name) VALUES (%s), (%s), (%s)'])
+        self.assertEqual([p.id for p in people], [110, 112, 114])
+        self.assertEqual([p['age'] for p in people], [0, 0, 0])
+        self.assertEqual(self.database.commits, 1)
+        self.assertEqual(self.redis.written, people)
+
+    def test_interleaved_lock_mode_inserts_rows_one_at_a_time(self):
+        '''
+        without consecutive ids, each row is inserted on its own
+        '''
+        store = self.make_store(FakeCursor(2), FakeRedis())
+        people = self.people(2)
+
+        with store.unit_of_work() as work:
+            for person in people:
+                work.create(person)
+
+        self.assertEqual([p.id for p in people], [110, 120])
+        self.assertEqual(self.database.commits, 1)
+
+    def test_grouped_updates_and_deletes(self):
+        '''
+        updates to a table are one UPDATE, deletes are one DELETE
+        '''
+        store = self.make_store(FakeCursor(1), FakeRedis())
+        first, second, third = Person({'id': 1}), Person({'id': 2}), Person({'id': 3})
+        first['name'] = 'a'
+        second['age'] = 5
+
+        with store.unit_of_work() as work:
+            work.update(first)
+            work.update(second)
+            work.delete(third)
+
+        self.assertEqual(self.cursor.queries, [
+            ('UPDATE `person` SET age = CASE id WHEN %s THEN %s ELSE age END, '
+             'name = CASE id WHEN %s THEN %s ELSE name END WHERE id IN (%s, %s)',
+             (2, 5, 1, 'a', 1, 2)),
+            ('DELETE FROM `person` WHERE id IN (%s)', (3,)),
+        ])
+        self.assertFalse(first.is_dirty)
+        self.assertEqual(self.redis.updated, [(first, {'name'}), (second, {'age'})])
+        self.assertEqual(self.redis.evicted, [third])
+        self.assertIsNone(third.id)
+
+    def test_deleting_a_created_model(self):
+        '''
+        a model created and deleted in the same unit is never inserted
+        '''
+        store = self.make_store(FakeCursor(1), FakeRedis())
+        kept, dropped = self.people(2)
+
+        with store.unit_of_work() as work:
+            work.create(kept)
+            work.create(dropped)
+            work.delete(dropped)
+
+        self.assertEqual([q for q, _ in self.cursor.queries if not q.startswith('SELECT')],
+                         ['INSERT INTO `person` (name) VALUES (%s)'])
+        self.assertIsNone(dropped.id)
+        self.assertEqual(self.redis.written, [kept])
+
+    def test_soft_deleting_a_created_model(self):
+        '''
+        a model created and soft-deleted in the same unit is inserted as
+        deleted and evicted rather than cached
+        '''
+        store = self.make_store(FakeCursor(1), FakeRedis())
+        person = SoftPerson()
+        person['name'] = 'a'
+
+        with store.unit_of_work() as work:
+            work.create(person)
+            work.delete(person)
+
+        self.assertEqual(self.cursor.queries[1][0],
+                         'INSERT INTO `person` (date_deleted, name) VALUES (%s, %s)')
+        self.assertEqual(self.redis.written, [])
+        self.assertEqual(self.redis.evicted, [person])
+
+    def test_update_caches_changed_fields(self):
+        '''
+        ObjectStore.update hands the cache only the fields it changed
+        '''
+        store = self.make_store(FakeCursor(1), FakeRedis())
+        person = Person({'id': 1, 'name': 'a', 'age': 2})
+        person['age'] = 3
+        store.update(person)
+
+        self.assertEqual(self.redis.updated, [(person, {'age'})])
+        self.assertEqual(self.redis.written, [])
+
+    def test_nothing_is_written_on_error(self):
+        '''
+        pending writes are discarded if the block raises
+        '''
+        store = self.make_store(FakeCursor(1), FakeRedis())
+
+        with self.assertRaises(KeyError):
+            with store.unit_of_work() as work:
+                work.create(self.people(1)[0])
+                raise KeyError('x')
+
+        self.assertEqual(self.cursor.queries, [])
+
+
+class PacketCursor(FakeCursor):
+
+    def __init__(self, packet_size, fail=False):
+        super(PacketCursor, self).__init__(1)
+        self.packet_size = packet_size
+        self.fail = fail
+
+    def execute(self, query, args=None):
+        if query.startswith('SELECT @@max_allowed_packet'):
+            self.result = [{'size': self.packet_size}]
+        elif self.fail:
+            raise IOError('gone away')
+        else:
+            super(PacketCursor, self).execute(query, args)
+
+
+class TestBulkWriters(StoreTestCase):
+
+    def person(self, name):
+        return Person({'id': None, 'name': name, 'age': 1})
+
+    def inserts(self):
+        return [q for q, _ in self.cursor.queries if q.startswith('INSERT')]
+
+    def test_full_buffer_is_one_statement(self):
+        '''
+        a full buffer is written as a single multi-row INSERT
+        '''
+        store = self.make_store(PacketCursor(1 << 20))
+        store.MAX_BUFFER_SIZE = 3
+
+        for name in 'abc':
+            store.batch_create(self.person(name))
+
+        self.assertEqual(self.inserts(), [
+            'INSERT INTO `person` (id, name, age) VALUES '
+            '(%s, %s, %s), (%s, %s, %s), (%s, %s, %s)'])
+        self.assertEqual(self.database.commits, 1)
+
+        stats = store.bulk_stats()['create:person']
+        self.assertEqual(stats['flushes'], 1)
+        self.assertEqual(stats['rows_written'], 3)
+        self.assertEqual(stats['buffered_rows'], 0)
+
+    def test_statements_are_split_by_packet_size(self):
+        '''
+        a flush is split into statements that fit in max_allowed_packet
+        '''
+        store = self.make_store(PacketCursor(1024 + 220))
+
+        for name in 'abcd':
+            store.batch_update(self.person(name * 20))
+
+        store.flush()
+
+        inserts = self.inserts()
+        self.assertGreater(len(inserts), 1)
+        self.assertTrue(all(q.endswith('age=VALUES(age)') for q in inserts))
+        self.assertEqual(self.database.commits, 1)
+        self.assertEqual(store.bulk_stats()['update:person']['rows_written'], 4)
+
+    def test_failed_flush_keeps_rows(self):
+        '''
+        rows stay buffered if a flush fails
+        '''
+        store = self.make_store(PacketCursor(1 << 20, fail=True))
+        store.batch_create(self.person('a'))
+
+        with self.assertRaises(IOError), self.assertLogs(level='ERROR'):
+            store.flush('create')
+
+        self.assertEqual(store.bulk_stats()['create:person']['buffered_rows'], 1)
+
+    def test_add_does_not_raise_and_gives_up(self):
+        '''
+        a flush that keeps failing doesn't raise from add, and its rows are
+        dropped and reported after max_attempts
+        '''
+        store = self.make_store(PacketCursor(1 << 20, fail=True))
+        store.MAX_BUFFER_SIZE = 2
+        failures = []
+        store.bulk_error_handler = lambda exc, rows: failures.append(rows)
+
+        with self.assertLogs(level='ERROR'):
+            for name in 'abcd':
+                store.batch_create(self.person(name))
+
+        stats = store.bulk_stats()['create:person']
+        self.assertEqual(stats['flush_errors'], 3)
+        self.assertEqual(stats['rows_failed'], 2)
+        self.assertEqual(stats['buffered_rows'], 2)
+        self.assertEqual(failures, [[], [], [(None, 'a', 1), (None, 'b', 1)]])
+
+        writer = list(store.bulk_writers.values())[0]
+        self.assertEqual(list(writer.failed_rows), [(None, 'a', 1), (None, 'b', 1)])
+
+    def test_copies_share_server_settings(self):
+        '''
+        copies of a store reuse the server settings it already looked up
+        '''
+        store = self.make_store(PacketCursor(1 << 20))
+        copy = store.with_identity_map()
+
+        self.assertEqual(store.max_packet_size(), 1 << 20)
+        self.assertEqual(store.consecutive_autoinc_increment(self.cursor), 2)
+
+        self.cursor.packet_size = 1
+
+        self.assertEqual(copy.max_packet_size(), 1 << 20)
+        self.assertEqual(copy.consecutive_autoinc_increment(self.cursor), 2)
+        self.assertEqual(len(self.cursor.queries), 1)
+
+    def test_written_ids_are_evicted(self):
+        '''
+        a flush evicts cached objects and negative cache entries for the ids
+        it wrote
+        '''
+        store = self.make_store(PacketCursor(1 << 20), FakeRedis())
+
+        store.batch_update(Person({'id': 5, 'name': 'e', 'age': 1}))
+        store.batch_create(self.person('f'))
+        store.flush()
+
+        self.assertEqual(self.redis.deleted, [5])
+
+    def test_old_rows_are_due(self):
+        '''
+        a writer is due once its oldest row is older than max_age
+        '''
+        store = self.make_store(PacketCursor(1 << 20))
+        store.batch_create(self.person('a'))
+        writer = list(store.bulk_writers.values())[0]
+
+        self.assertFalse(writer.due())
+        self.assertTrue(writer.due(writer._oldest + store.bulk_max_age))
+
+
+class LoadCursor(FakeCursor):
+
+    def __init__(self):
+        super(LoadCursor, self).__init__(1)
+        self.files = []
+        self.rowcount = 0
+
+    def execute(self, query, args=None):
+        super(LoadCursor, self).execute(query, args)
+
+        with open(args[0], encoding='utf-8') as tsv:
+            self.files.append(tsv.read())
+
+        self.rowcount = self.files[-1].count('\n')
+
+
+class TestBulkLoad(StoreTestCase):
+
+    def test_tsv_field(self):
+        '''
+        NULLs, booleans, and special characters use LOAD DATA's escapes
+        '''
+        self.assertEqual(tsv_field(None), '\\N')
+        self.assertEqual(tsv_field(False), '0')
+        self.assertEqual(tsv_field('a\tb\\c\n'), 'a\\tb\\\\c\\n')
+
+    def test_chunks(self):
+        '''
+        rows are loaded in chunks, each committed and reported
+        '''
+        store = self.make_store(LoadCursor())
+        rows = [Person({'id': 1, 'name': 'a'}), {'id': 2, 'name': None, 'age': 3},
+                {'id': 3, 'name': 'c\td', 'age': 4}]
+        progress = []
+
+        affected = store.bulk_load(Person, rows, mode='replace', chunk_size=2,
+                                   progress=progress.append)
+
+        self.assertEqual(affected, 3)
+        self.assertEqual(progress, [2, 3])
+        self.assertEqual(self.database.commits, 2)
+        self.assertEqual(self.cursor.files, ['1\ta\t\\N\n2\t\\N\t3\n', '3\tc\\td\t4\n'])
+        self.assertTrue(self.cursor.queries[0][0].startswith('LOAD DATA LOCAL INFILE %s '
+                                                             'REPLACE INTO TABLE `person`'))
+
+    def test_loaded_ids_are_evicted(self):
+        '''
+        cached copies and negative cache entries for loaded ids are evicted
+        '''
+        store = self.make_store(LoadCursor(), FakeRedis())
+
+        store.bulk_load(Person, [{'id': 1, 'name': 'a'}, {'id': None, 'name': 'b'},
+                                 Person({'id': 3})], chunk_size=2)
+
+        self.assertEqual(self.redis.deleted, [1, 3])
+
+
+class DefaultedPerson(Person):
+    server_defaults = {'age': 18}
+
+
+class TestServerDefaults(StoreTestCase):
+
+    def test_declared_defaults_skip_the_read(self):
+        '''
+        a model with server defaults is filled in without re-reading the row
+        '''
+        store = self.make_store(FakeCursor(1), FakeRedis())
+        person = DefaultedPerson()
+        person['name'] = 'a'
+        store.create(person)
+
+        self.assertEqual([q for q, _ in self.cursor.queries],
+                         ['INSERT INTO `person` (name) VALUES (%s)'])
+        self.assertEqual(person.fields, {'id': 110, 'name': 'a', 'age': 18})
+        self.assertEqual(self.redis.written, [person])
+
+    def test_refresh(self):
+        '''
+        refresh=True re-reads the row even if the defaults are known
+        '''
+        store = self.make_store(FakeCursor(1), FakeRedis())
+        person = DefaultedPerson()
+        person['name'] = 'a'
+        store.create(person, refresh=True)
+
+        self.assertEqual(person['age'], 0)
+        self.assertTrue(self.cursor.queries[-1][0].startswith('SELECT * FROM `person`'))
+
+    def test_schema_defaults(self):
+        '''
+        column defaults from information_schema are converted by type
+        '''
+        defaults = schema_defaults([
+            schema_column('id', None, 'int', 'auto_increment'),
+            schema_column('age', '18', 'int'),
+            schema_column('name', "'anon'"),
+            schema_column('note', None)
+        ])
+
+        self.assertEqual(defaults, {'age': 18, 'name': 'anon', 'note': None})
+        self.assertIsNone(schema_defaults([
+            schema_column('code', 'uuid()', extra='DEFAULT_GENERATED')]))
+
+    def test_current_timestamp_is_read_back(self):
+        '''
+        CURRENT_TIMESTAMP defaults (as reported by MySQL or MariaDB) can't be
+        known without reading the row back
+        '''
+        self.assertIsNone(schema_defaults([schema_column(
+            'date_created', 'CURRENT_TIMESTAMP', 'datetime', 'DEFAULT_GENERATED')]))
+        self.assertIsNone(schema_defaults([schema_column(
+            'date_created', 'current_timestamp()', 'timestamp')]))
+
+        cursor = SchemaCursor([schema_column('age', '18', 'int'), schema_column(
+            'date_created', 'CURRENT_TIMESTAMP(3)', 'datetime', 'DEFAULT_GENERATED')])
+        store = self.make_store(cursor, FakeRedis())
+        person = SchemaPerson()
+        person['name'] = 'a'
+        store.create(person)
+
+        self.assertTrue(cursor.queries[-1][0].startswith('SELECT * FROM `person`'))
+        self.assertEqual(person['age'], 0)
+
+
+def schema_column(name, default, data_type='varchar', extra=''):
+    return {'COLUMN_NAME': name, 'COLUMN_DEFAULT': default,
+            'DATA_TYPE': data_type, 'EXTRA': extra}
+
+
+class SchemaPerson(Person):
+    server_defaults = 'schema'
+
+
+class SchemaCursor(FakeCursor):
+
+    def __init__(self, columns):
+        super(SchemaCursor, self).__init__(1)
+        self.columns = columns
+
+    def execute(self, query, args=None):
+        super(SchemaCursor, self).execute(query, args)
+
+        if 'information_schema.COLUMNS' in query:
+            self.result = self.columns
+
+
+class CountCursor(FakeCursor):
+
+    def __init__(self):
+        super(CountCursor, self).__init__(1)
+        self.estimate = 0
+
+    def execute(self, query, args=None):
+        super(CountCursor, self).execute(query, args)
+
+        if 'information_schema.TABLES' in query:
+            self.result = [{'count': self.estimate}]
+        elif 'COUNT' in query:
+            self.result = [{'count': len(self.queries)}]
+
+
+class VersionedRedis(FakeRedis):
+
+    def __init__(self):
+        self.values = {}
+        self.table_generations = {}
+
+    def bump_generations(self, table_names):
+        for name in table_names:
+            self.table_generations[name] = self.table_generations.get(name, 0) + 1
+
+    def generations(self, table_names):
+        return [self.table_generations.get(name, 0) for name in table_names]
+
+    def get_versioned(self, key, generations):
+        stored, value = self.values.get(key, (None, MISSING))
+        return value if stored == generations else MISSING
+
+    def set_versioned(self, key, generations, value, ttl=None):
+        self.values[key] = (generations, value)
+
+    def set_objects(self, models, delta=None):
+        self.values.update((('object', model.id), model) for model in models)
+
+    def get_objects(self, model_class, ids, missing=None):
+        return [self.values.get(('object', item_id)) for item_id in ids]
+
+
+class CountedPerson(Person):
+    cache_policy = CachePolicy(count_ttl=60)
+
+
+class TestCachedCounts(StoreTestCase):
+
+    def test_counts_are_cached_until_a_write(self):
+        '''
+        a cached count is reused until the table's generation changes
+        '''
+        store = self.make_store(CountCursor(), VersionedRedis())
+
+        self.assertEqual(store.count(CountedPerson), 1)
+        self.assertEqual(store.count(CountedPerson), 1)
+        self.assertEqual(store.count(Person), 2)
+
+        store.delete(CountedPerson({'id': 1}))
+
+        self.assertEqual(store.count(CountedPerson), 4)
+
+    def test_filtered_counts_depend_on_joined_tables(self):
+        '''
+        filtered counts are keyed by their filters and go stale when any
+        table they read changes
+        '''
+        store = self.make_store(CountCursor(), VersionedRedis())
+        filters = [(Item, 'name', '=', 'a')]
+
+        self.assertEqual(store.count_matching_filter(CountedPerson, list(filters)), 1)
+        self.assertEqual(store.count_matching_filter(CountedPerson, list(filters)), 1)
+        self.assertEqual(store.count_matching_filter(
+            CountedPerson, [(Item, 'name', '=', 'b')]), 2)
+
+        store.bump_generations(['item'])
+
+        self.assertEqual(store.count_matching_filter(CountedPerson, list(filters)), 3)
+
+    def test_approximate_count(self):
+        '''
+        large tables return the server's estimate, small ones are counted
+        '''
+        store = self.make_store(CountCursor(), VersionedRedis())
+        self.cursor.estimate = store.APPROXIMATE_COUNT_THRESHOLD
+
+        self.assertEqual(store.count(Person, approximate=True), self.cursor.estimate)
+
+        self.cursor.estimate = 10
+
+        self.assertEqual(store.count(Person, approximate=True), 3)
+
+
+class QueriedPerson(Person):
+    cache_policy = CachePolicy(query_ttl=60)
+
+
+class TestQueryCache(StoreTestCase):
+
+    def test_results_are_cached_until_a_write(self):
+        '''
+        repeated queries load their cached ids from the object cache
+        '''
+        store = self.make_store(FakeCursor(1), VersionedRedis())
+
+        first = store.models_matching_filter(QueriedPerson, [(Person, 'age', '=', 7)])
+        second = store.models_matching_filter(QueriedPerson, [(Person, 'age', '=', 7)])
+
+        self.assertEqual([model.id for model in second], [7])
+        self.assertIs(second[0], first[0])
+        self.assertEqual(len(self.cursor.queries), 1)
+
+        store.bump_generations(['person'])
+        store.models_matching_filter(QueriedPerson, [(Person, 'age', '=', 7)])
+
+        self.assertEqual(len(self.cursor.queries), 2)
+
+    def test_unsaved_changes_are_not_cached(self):
+        '''
+        a miss caches the rows as read, not the identity map's dirty instances
+        '''
+        redis = VersionedRedis()
+        store = self.make_store(FakeCursor(1), redis).with_identity_map()
+
+        mapped = store.identity_map.add(QueriedPerson({'id': 7, 'age': 0}))
+        mapped['age'] = 30
+
+        models = store.models_matching_filter(QueriedPerson, [(Person, 'age', '=', 7)])
+
+        self.assertIs(models[0], mapped)
+        self.assertIsNot(redis.values[('object', 7)], mapped)
+        self.assertEqual(redis.values[('object', 7)]['age'], 0)
+
+
+class Owner(Model):
+    table_name = 'owner'
+    link_name = 'owner_id'
+    columns = ['id', 'name']
+
+
+class Pet(Model):
+    table_name = 'pet'
+    link_name = 'pet_id'
+    columns = ['id', 'owner_id', 'name', 'date_deleted']
+
+
+class ScriptedCursor(FakeCursor):
+
+    def __init__(self, *results):
+        super(ScriptedCursor, self).__init__(1)
+        self.results = list(results)
+
+    def execute(self, query, args=None):
+        self.queries.append((' '.join(query.split()), args))
+        self.result = self.results.pop(0)
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+
+def pet_row(item_id, owner_id, deleted=False):
+    return {'id': item_id, 'owner_id': None, 'name': 'pet{0}'.format(item_id),
+            'date_deleted': datetime(2020, 1, 1) if deleted else None,
+            '__link_id': owner_id}
+
+
+@skipIf(fakeredis is None, 'fakeredis with Lua support is not installed')
+class TestLinkedModels(StoreTestCase):
+
+    def ids(self, lists):
+        return [[model.id for model in models] for models in lists]
+
+    def test_database_and_cached_sets_agree(self):
+        '''
+        soft-deleted records are left out whether or not the links are
+        cached, and the cached sets still hold their ids
+        '''
+        store = self.make_store(ScriptedCursor(
+            [pet_row(10, 1), pet_row(11, 1, deleted=True), pet_row(12, 2)], []), MemoryRedis())
+        owners = [Owner({'id': 1}), Owner({'id': 2}), Owner({'id': 3})]
+
+        loaded = store.models_linked_to_models(Pet, owners, set_attr='pets')
+
+        self.assertEqual(self.ids(loaded), [[10], [12], []])
+        self.assertEqual(self.ids([owner.pets for owner in owners]), [[10], [12], []])
+        self.assertEqual(len(self.cursor.queries), 1)
+        self.assertIn('JOIN owner_pet link ON tbl_name.id = link.pet_id '
+                      'WHERE link.owner_id IN (%s, %s, %s)', self.cursor.queries[0][0])
+        self.assertEqual(self.redis.get_links(Pet, owners), [['10', '11'], ['12'], []])
+
+        cached = store.models_linked_to_models(Pet, owners)
+
+        self.assertEqual(self.ids(cached), [[10], [12], []])
+        self.assertEqual(self.cursor.queries[1][1], ('11',))
+
+    def test_has_assoc_item_loads_the_set(self):
+        '''
+        a cache miss loads the whole link set, which answers later checks
+        '''
+        store = self.make_store(ScriptedCursor([{'id': 10}]), MemoryRedis())
+        owner = Owner({'id': 1})
+
+        self.assertTrue(store.model_has_assoc_item(owner, Pet({'id': 10})))
+        self.assertFalse(store.model_has_assoc_item(owner, Pet({'id': 11})))
+        self.assertEqual(self.cursor.queries, [
+            ('SELECT pet_id AS id FROM `owner_pet` WHERE owner_id = %s', (1,))])
+
+    def test_assoc_and_deassoc_items(self):
+        '''
+        linking writes one multi-row INSERT with the extra columns, and both
+        linking and unlinking keep a cached set current
+        '''
+        store = self.make_store(ScriptedCursor([], None), MemoryRedis())
+        owner = Owner({'id': 1})
+        pets = [Pet({'id': 11}), Pet({'id': 12})]
+        self.redis.set_links(Pet, [(owner, [10])])
+
+        store.model_assoc_items(owner, pets, note='x')
+        store.model_deassoc_item(owner, pets[0])
+
+        self.assertEqual(self.cursor.queries, [
+            ('INSERT INTO owner_pet (owner_id, pet_id, note) VALUES (%s, %s, %s), (%s, %s, %s)',
+             (1, 11, 'x', 1, 12, 'x')),
+            ('DELETE FROM `owner_pet` WHERE owner_id = %s AND pet_id = %s', (1, 11))])
+        self.assertEqual(self.redis.get_links(Pet, [owner]), [['10', '12']])
+
+        with self.assertRaises(ValueError):
+            store.model_assoc_items(owner, pets, note=['x'])
+
+
+@skipIf(fakeredis is None, 'fakeredis with Lua support is not installed')
+class TestBatchLoaders(StoreTestCase):
+
+    def test_models_referenced_by_models(self):
+        '''
+        each model gets its referenced record, or None, from one query
+        '''
+        store = self.make_store(ScriptedCursor([{'id': 2, 'name': 'b'}, {'id': 1, 'name': 'a'}]),
+                                MemoryRedis())
+        pets = [Pet({'id': 10, 'owner_id': owner_id}) for owner_id in (1, None, 2, 1, 3)]
+
+        owners = store.models_referenced_by_models(Owner, pets, set_attr='owner')
+
+        self.assertEqual([owner and owner.id for owner in owners], [1, None, 2, 1, None])
+        self.assertIs(owners[0], owners[3])
+        self.assertEqual([pet.owner for pet in pets], owners)
+        self.assertEqual(len(self.cursor.queries), 1)
+        self.assertTrue(self.cursor.queries[0][0].endswith('WHERE id IN (%s, %s, %s)'))
+        self.assertEqual(self.cursor.queries[0][1], (1, 2, 3))
+
+    def test_models_referencing_models(self):
+        '''
+        records are grouped by the model they refer to, from one IN query
+        '''
+        store = self.make_store(ScriptedCursor(
+            [pet_row(10, 2), pet_row(11, 1), pet_row(12, 2)]), MemoryRedis())
+        owners = [Owner({'id': 1}), Owner({'id': 2}), Owner({'id': 1}), Owner({'id': 3})]
+
+        pets = store.models_referencing_models(Pet, owners, set_attr='pets')
+
+        self.assertEqual([[pet.id for pet in group] for group in pets],
+                         [[11], [10, 12], [11], []])
+        self.assertEqual([owner.pets for owner in owners], pets)
+        self.assertEqual(len(self.cursor.queries), 1)
+        self.assertIn('WHERE obj.owner_id IN (%s, %s, %s) ORDER BY obj.id ASC',
+                      self.cursor.queries[0][0])
+        self.assertEqual(self.cursor.queries[0][1], (1, 2, 3))
+
+
+@skipIf(fakeredis is None, 'fakeredis with Lua support is not installed')
+class TestModelsWithIds(StoreTestCase):
+
+    def test_cache_hits_and_misses_keep_their_order(self):
+        '''
+        cached, known-missing, and uncached ids are resolved together and
+        returned in the order asked for, without duplicates
+        '''
+        redis = MemoryRedis()
+        store = self.make_store(
+            ScriptedCursor([{'id': 5, 'name': 'e'}, {'id': 3, 'name': 'c'}]), redis)
+        redis.set_objects([RememberedPerson({'id': 1, 'name': 'a'})])
+        redis.set_missing(RememberedPerson, [2])
+
+        people = store.models_with_ids(RememberedPerson, [3, 1, 2, 4, '3', 5])
+
+        self.assertEqual([person.id for person in people], [3, 1, 5])
+        self.assertEqual(people[1]['name'], 'a')
+        self.assertEqual(len(self.cursor.queries), 1)
+        self.assertTrue(self.cursor.queries[0][0].endswith('WHERE id IN (%s, %s, %s)'))
+        self.assertEqual(self.cursor.queries[0][1], ('3', 4, 5))
+        self.assertIs(redis.get_object(RememberedPerson, 4, missing=MISSING), MISSING)
+        self.assertEqual(redis.get_object(RememberedPerson, 5)['name'], 'e')
+
+
+class UncachedPerson(Person):
+    cache_policy = CachePolicy(enabled=False)
+
+
+class EvictedPerson(Person):
+    cache_policy = CachePolicy(write_through=False)
+
+
+class RememberedPerson(Person):
+    cache_policy = CachePolicy(negative_ttl=60)
+
+
+class TestCachePolicy(StoreTestCase):
+
+    def test_disabled(self):
+        '''
+        classes with caching disabled never read from or write to the cache
+        '''
+        redis = FakeRedis()
+        store = self.make_store(ScriptedCursor([{'id': 1, 'name': 'a'}], None), redis)
+
+        person = store.model_with_id(UncachedPerson, 1)
+        person['name'] = 'b'
+        store.update(person)
+
+        self.assertEqual(len(self.cursor.queries), 2)
+        self.assertFalse(store.should_cache(UncachedPerson))
+        self.assertIsNone(getattr(redis, 'written', None))
+
+    def test_write_through_off_evicts(self):
+        '''
+        without write-through, writes evict the cached object
+        '''
+        redis = FakeRedis()
+        store = self.make_store(ScriptedCursor(None), redis)
+        person = EvictedPerson({'id': 1})
+        person['name'] = 'b'
+
+        store.update(person)
+
+        self.assertEqual(redis.written, [])
+        self.assertEqual(redis.updated, [])
+        self.assertEqual(redis.evicted, [person])
+
+    @skipIf(fakeredis is None, 'fakeredis with Lua support is not installed')
+    def test_negative_ttl(self):
+        '''
+        an id that doesn't exist is looked up once, then answered from the
+        cache
+        '''
+        redis = MemoryRedis()
+        store = self.make_store(ScriptedCursor([]), redis)
+
+        self.assertIsNone(store.model_with_id(RememberedPerson, 5))
+        self.assertIsNone(store.model_with_id(RememberedPerson, 5))
+        self.assertEqual(len(self.cursor.queries), 1)
+
+
+class BlockingCursor(FakeCursor):
+    '''
+    A cursor whose queries don't return until they're allowed to
+    '''
+
+    def __init__(self, row):
+        super(BlockingCursor, self).__init__(1)
+        self.row = row
+        self.started = threading.Event()
+        self.proceed = threading.Event()
+
+    def execute(self, query, args=None):
+        self.queries.append((' '.join(query.split()), args))
+        self.started.set()
+        self.proceed.wait(5)
+
+    def fetchone(self):
+        return self.row
+
+
+@skipIf(fakeredis is None, 'fakeredis with Lua support is not installed')
+class TestFillLock(StoreTestCase):
+
+    def load_concurrently(self, result_class, row):
+        '''
+        Load the same id through two stores (standing in for two processes)
+        sharing one redis, the second starting while the first is querying
+        '''
+        redis = MemoryRedis()
+        cursor = BlockingCursor(row)
+        stores = [self.make_store(cursor, redis) for _ in range(2)]
+
+        for store in stores:
+            store.fill_lock_ttl = 1000
+
+        results = {}
+
+        def load(store):
+            results[store] = store.model_with_id(result_class, 7)
+
+        threads = [threading.Thread(target=load, args=(store,)) for store in stores]
+        threads[0].start()
+        self.cursor.started.wait(5)
+        threads[1].start()
+
+        # Give the second loader time to find the lock taken
+        time.sleep(0.05)
+        self.cursor.proceed.set()
+
+        for thread in threads:
+            thread.join(5)
+
+        return [results[store] for store in stores]
+
+    def test_concurrent_loaders_share_one_query(self):
+        '''
+        a loader that finds the fill lock taken waits for the holder to fill
+        the cache instead of querying
+        '''
+        first, second = self.load_concurrently(
+            Person, {'id': 7, 'name': 'Ann', 'age': 3})
+
+        self.assertEqual(len(self.cursor.queries), 1)
+        self.assertEqual(first['name'], 'Ann')
+        self.assertEqual(second['name'], 'Ann')
+
+    def test_missing_rows_are_shared(self):
+        '''
+        a waiting loader sees the holder's negative cache entry
+        '''
+        first, second = self.load_concurrently(RememberedPerson, None)
+
+        self.assertEqual(len(self.cursor.queries), 1)
+        self.assertIsNone(first)
+        self.assertIsNone(second)
+        self.assertIs(self.redis.get_object(RememberedPerson, 7, missing=MISSING),
+                      MISSING)
+
+    def test_expired_lock_falls_back_to_the_database(self):
+        '''
+        if the lock holder never fills the cache, the waiter queries once
+        its lock expires
+        '''
+        store = self.make_store(
+            ScriptedCursor([{'id': 7, 'name': 'Ann', 'age': 3}]), MemoryRedis())
+        store.fill_lock_ttl = 50
+
+        self.assertIsNotNone(
+            self.redis.acquire_lock(self.redis.build_key('person', id=7), 50))
+
+        started = time.monotonic()
+        person = store.model_with_id(Person, 7)
+
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+        self.assertEqual(person['name'], 'Ann')
+        self.assertEqual(len(self.cursor.queries), 1)
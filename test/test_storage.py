@@ -0,0 +1,602 @@
+'''
+Tests for datastore connection management
+'''
+
+from datetime import date
+from decimal import Decimal
+from unittest import TestCase, skipIf
+from unittest import mock
+import threading
+import time
+
+import msgpack
+import pymysql
+
+try:
+    import fakeredis
+    import lupa  # pylint: disable=unused-import
+except ImportError:
+    fakeredis = None
+
+from f5.models import CachePolicy, Model
+from f5.storage import ConnectionPool, Database, DatabaseConnectionError
+from f5.storage import LocalCache, Redis
+from f5.storage import SingleFlight
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.closed = False
+        self.pings = 0
+        self.rollbacks = 0
+        self.fail_ping = False
+
+    def ping(self, reconnect=False):
+        self.pings += 1
+        if self.fail_ping:
+            raise pymysql.err.OperationalError(2006, 'MySQL server has gone away')
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class TestConnectionPool(TestCase):
+
+    def setUp(self):
+        self.opened = []
+
+        def connect():
+            conn = FakeConnection()
+            self.opened.append(conn)
+            return conn
+
+        self.connect = connect
+        self.clock = 1000.0
+        patcher = mock.patch('f5.storage.time.monotonic', lambda: self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_connections_are_reused(self):
+        '''
+        a released connection is handed out again instead of reconnecting
+        '''
+        pool = ConnectionPool(self.connect, max_size=2)
+
+        first = pool.acquire()
+        pool.release(first)
+        second = pool.acquire()
+
+        self.assertIs(first.conn, second.conn)
+        self.assertEqual(len(self.opened), 1)
+        self.assertEqual(first.conn.rollbacks, 1)
+
+    def test_pool_is_bounded(self):
+        '''
+        acquire times out once max_size connections are leased
+        '''
+        pool = ConnectionPool(self.connect, max_size=2, timeout=0)
+
+        pool.acquire()
+        pool.acquire()
+
+        with self.assertRaises(DatabaseConnectionError):
+            pool.acquire()
+
+        self.assertEqual(pool.size, 2)
+
+    def test_idle_timeout_respects_min_size(self):
+        '''
+        idle connections are reaped, but never below min_size
+        '''
+        pool = ConnectionPool(self.connect, min_size=1, max_size=3,
+                              idle_timeout=60, ping_interval=None)
+        leased = [pool.acquire() for _ in range(3)]
+        for entry in leased:
+            pool.release(entry)
+
+        self.clock += 120
+        entry = pool.acquire()
+
+        self.assertEqual(pool.size, 1)
+        self.assertEqual(sum(conn.closed for conn in self.opened), 2)
+        self.assertFalse(entry.conn.closed)
+
+    def test_max_lifetime(self):
+        '''
+        connections older than max_lifetime are closed on release
+        '''
+        pool = ConnectionPool(self.connect, max_lifetime=3600)
+        entry = pool.acquire()
+
+        self.clock += 3601
+        pool.release(entry)
+
+        self.assertTrue(entry.conn.closed)
+        self.assertEqual(pool.size, 0)
+
+    def test_dead_connections_are_replaced(self):
+        '''
+        a connection that fails its liveness ping is discarded
+        '''
+        pool = ConnectionPool(self.connect, ping_interval=30)
+        entry = pool.acquire()
+        pool.release(entry)
+
+        entry.conn.fail_ping = True
+        self.clock += 31
+        replacement = pool.acquire()
+
+        self.assertTrue(entry.conn.closed)
+        self.assertIsNot(replacement.conn, entry.conn)
+        self.assertEqual(pool.size, 1)
+
+    def test_fill(self):
+        '''
+        fill opens connections up to min_size
+        '''
+        pool = ConnectionPool(self.connect, min_size=3, max_size=5)
+        pool.fill()
+
+        self.assertEqual(pool.size, 3)
+        self.assertEqual(pool.idle, 3)
+
+
+class TestSingleFlight(TestCase):
+
+    def test_concurrent_calls_share_a_result(self):
+        '''
+        callers that arrive while a call is in flight get its result
+        '''
+        group = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def load():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return {'id': 1}
+
+        leader = threading.Thread(target=lambda: results.append(group.do('k', load)))
+        leader.start()
+        started.wait()
+
+        followers = [
+            threading.Thread(target=lambda: results.append(group.do('k', load)))
+            for _ in range(4)
+        ]
+        for thread in followers:
+            thread.start()
+
+        # Give the followers a moment to block on the leader's call
+        time.sleep(0.1)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'id': 1}] * 5)
+
+    def test_calls_after_completion_run_again(self):
+        '''
+        a finished call doesn't cache its result or its exception
+        '''
+        group = SingleFlight()
+
+        def fail():
+            raise KeyError('x')
+
+        with self.assertRaises(KeyError):
+            group.do('k', fail)
+
+        self.assertEqual(group.do('k', lambda: 42), 42)
+
+
+class TestLocalCache(TestCase):
+
+    def setUp(self):
+        self.clock = 1000.0
+        patcher = mock.patch('f5.storage.time.monotonic', lambda: self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        '''
+        the cache holds at most max_size entries, evicting the stalest
+        '''
+        cache = LocalCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_entries_expire(self):
+        '''
+        entries are misses once their ttl has elapsed
+        '''
+        cache = LocalCache(10, ttl=30)
+        cache.set('a', 1)
+
+        self.clock += 31
+
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_counters(self):
+        '''
+        hits, misses, and invalidations are counted
+        '''
+        cache = LocalCache(10)
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('b')
+        cache.invalidate('a')
+        cache.invalidate('b')
+
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['invalidations'], 1)
+        self.assertIsNone(cache.get('a'))
+
+
+class FakeCursor(object):
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.closed = False
+
+    def execute(self, query, args=None):
+        self.query = query
+
+    def fetchmany(self, size):
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+    def close(self):
+        self.closed = True
+
+
+class TestIterRows(TestCase):
+
+    def setUp(self):
+        self.opened = []
+
+        def connect(**unused_config):
+            conn = FakeConnection()
+            conn.cursor = lambda unused_class: FakeCursor(
+                {'id': i} for i in range(5))
+            self.opened.append(conn)
+            return conn
+
+        patcher = mock.patch('f5.storage.MySQLdb.connect', connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.database = Database(mode='write', host='localhost')
+
+    def test_rows_are_yielded_in_batches(self):
+        '''
+        every row is yielded and the connection returns to the pool
+        '''
+        rows = list(self.database.iter_rows('SELECT', batch_size=2))
+
+        self.assertEqual(rows, [{'id': i} for i in range(5)])
+        self.assertEqual(self.database.pool.idle, 1)
+        self.assertFalse(self.opened[0].closed)
+
+    def test_connection_is_leased_while_iterating(self):
+        '''
+        the connection is leased on the first row, not when the generator
+        is created
+        '''
+        rows = self.database.iter_rows('SELECT')
+        self.assertEqual(self.database.pool.size, 0)
+
+        next(rows)
+        self.assertEqual(self.database.pool.size, 1)
+        self.assertEqual(self.database.pool.idle, 0)
+
+    def test_early_close_discards_the_connection(self):
+        '''
+        a connection with unread rows is closed instead of reused
+        '''
+        rows = self.database.iter_rows('SELECT', batch_size=2)
+        next(rows)
+        rows.close()
+
+        self.assertTrue(self.opened[0].closed)
+        self.assertEqual(self.database.pool.size, 0)
+
+
+class MemoryRedis(Redis):
+    '''
+    A Redis context manager backed by an in-process fake server. The object
+    store tests use it too, so every test runs against the real scripts.
+    '''
+
+    def __init__(self, **settings):
+        super(MemoryRedis, self).__init__(**settings)
+        self.client = fakeredis.FakeStrictRedis()
+
+    def __enter__(self):
+        return self.client
+
+    def __exit__(self, *unused_exc_info):
+        pass
+
+
+class Owner(Model):
+    table_name = 'owner'
+    columns = ['id', 'name']
+
+
+class Pet(Model):
+    table_name = 'pet'
+    columns = ['id', 'name', 'age']
+
+
+@skipIf(fakeredis is None, 'fakeredis with Lua support is not installed')
+class TestLinks(TestCase):
+
+    def setUp(self):
+        self.redis = MemoryRedis()
+        self.owners = [Owner({'id': 1}), Owner({'id': 2})]
+
+    def test_empty_sets_are_cached(self):
+        '''
+        a cached empty set reads as no links, an uncached one as None
+        '''
+        self.redis.set_links(Pet, [(self.owners[0], [])])
+
+        self.assertEqual(self.redis.get_links(Pet, self.owners), [[], None])
+        self.assertFalse(self.redis.has_link(Pet, self.owners[0], 10))
+        self.assertIsNone(self.redis.has_link(Pet, self.owners[1], 10))
+
+    def test_ids_are_in_numeric_order(self):
+        '''
+        linked ids come back in ascending numeric order
+        '''
+        self.redis.set_links(Pet, [(self.owners[0], [10, 9, 100])])
+
+        self.assertEqual(self.redis.get_links(Pet, self.owners[:1]), [['9', '10', '100']])
+
+    def test_add_and_remove(self):
+        '''
+        ids are only added to sets that are cached
+        '''
+        self.redis.set_links(Pet, [(self.owners[0], [1])])
+        self.redis.add_links(Pet, self.owners[0], [2])
+        self.redis.add_links(Pet, self.owners[1], [2])
+        self.redis.remove_links(Pet, self.owners[0], [1])
+
+        self.assertEqual(self.redis.get_links(Pet, self.owners), [['2'], None])
+        self.assertTrue(self.redis.has_link(Pet, self.owners[0], 2))
+
+
+class Toy(Model):
+    table_name = 'toy'
+    columns = ['id', 'name', 'price', 'made']
+    cache_policy = CachePolicy(negative_ttl=60)
+
+
+class RenamedToy(Toy):
+    columns = ['id', 'name', 'cost', 'made']
+
+
+@skipIf(fakeredis is None, 'fakeredis with Lua support is not installed')
+class TestBlobObjectFormat(TestCase):
+
+    def setUp(self):
+        self.redis = MemoryRedis(object_format='blob')
+        self.toy = Toy({'id': 7, 'name': 'top', 'price': Decimal('2.50'),
+                        'made': date(2020, 1, 2)})
+
+    def test_round_trip(self):
+        '''
+        an object is stored as one blob and read back with its types intact
+        '''
+        self.redis.set_object(self.toy)
+
+        self.assertEqual(self.redis.client.type('toy:7#blob'), b'string')
+        self.assertEqual(self.redis.get_object(Toy, 7).fields, self.toy.fields)
+
+    def test_schema_and_version_mismatches_are_misses(self):
+        '''
+        blobs written for other columns or another format version read as
+        misses
+        '''
+        self.redis.set_object(self.toy)
+
+        self.assertIsNone(self.redis.get_object(RenamedToy, 7))
+
+        self.redis.object_format.VERSION += 1
+
+        self.assertIsNone(self.redis.get_object(Toy, 7))
+
+    def test_unreadable_blobs_are_dropped(self):
+        '''
+        blobs of another shape or version, or that aren't msgpack at all,
+        read as misses and are deleted
+        '''
+        fingerprint, _ = self.redis.object_format._schema(Toy)
+        blobs = [
+            msgpack.packb([2, fingerprint, 1.0, None, ['top', '2.50'], 'extra']),
+            msgpack.packb([0, fingerprint, ['top', '2.50', None]]),
+            msgpack.packb({'name': 'top'}),
+            b'\xc1',
+        ]
+
+        for blob in blobs:
+            self.redis.client.set('toy:7#blob', blob)
+
+            self.assertIsNone(self.redis.get_object(Toy, 7), blob)
+            self.assertEqual(self.redis.client.keys(), [], blob)
+
+    def test_negative_marker(self):
+        '''
+        ids cached as missing read as the `missing` value
+        '''
+        self.redis.set_missing(Toy, [8])
+
+        self.assertEqual(self.redis.get_object(Toy, 8, missing='gone'), 'gone')
+        self.assertIsNone(self.redis.get_object(Toy, 9, missing='gone'))
+
+    def test_delete_objects(self):
+        '''
+        delete_objects removes cached objects and negative cache entries
+        '''
+        self.redis.set_object(self.toy)
+        self.redis.set_missing(Toy, [8])
+
+        self.redis.delete_objects(Toy, [7, 8])
+
+        self.assertIsNone(self.redis.get_object(Toy, 7, missing='gone'))
+        self.assertIsNone(self.redis.get_object(Toy, 8, missing='gone'))
+
+    def test_misses_need_a_negative_ttl(self):
+        '''
+        misses aren't remembered for classes without a negative TTL
+        '''
+        self.redis.set_missing(Pet, [8])
+
+        self.assertEqual(self.redis.client.keys(), [])
+
+    def test_get_objects_is_one_mget(self):
+        '''
+        several objects are read with a single MGET
+        '''
+        self.redis.set_object(self.toy)
+
+        with mock.patch.object(self.redis.client, 'mget',
+                               wraps=self.redis.client.mget) as mget:
+            toys = self.redis.get_objects(Toy, [7, 8, 7])
+
+        mget.assert_called_once_with(['toy:7#blob', 'toy:8#blob', 'toy:7#blob'])
+        self.assertEqual([toy and toy.id for toy in toys], [7, None, 7])
+
+
+@skipIf(fakeredis is None, 'fakeredis with Lua support is not installed')
+class TestCompatibilityWrappers(TestCase):
+
+    def test_set_hash_and_delete_object(self):
+        '''
+        set_hash writes the object with its hash, and delete_object and
+        delete_hash remove them
+        '''
+        redis = MemoryRedis()
+        toy = Toy({'id': 7, 'name': 'top'})
+
+        redis.set_hash(toy)
+
+        self.assertEqual(redis.client.get('toy:7:hash'), toy.hash)
+        self.assertEqual(redis.get_object(Toy, 7).fields['name'], 'top')
+
+        redis.delete_hash(toy)
+
+        self.assertEqual(redis.client.keys(), [b'toy:7'])
+
+        redis.delete_object(toy)
+
+        self.assertEqual(redis.client.keys(), [])
+
+
+class LongLivedToy(Toy):
+    cache_policy = CachePolicy(ttl=86400)
+
+
+class TestObjectExpiry(TestCase):
+
+    def test_ttls_are_jittered_within_bounds(self):
+        '''
+        object TTLs vary by at most TTL_JITTER either side of the policy's
+        '''
+        redis = Redis()
+
+        with mock.patch('f5.storage.random.uniform', side_effect=lambda a, b: a):
+            self.assertEqual(redis.object_ttl(LongLivedToy), 77760)
+            self.assertEqual(redis.object_ttl(Toy), 3240)
+
+        with mock.patch('f5.storage.random.uniform', side_effect=lambda a, b: b):
+            self.assertEqual(redis.object_ttl(LongLivedToy), 95040)
+            self.assertEqual(redis.object_ttl(Toy), 3960)
+
+    def test_early_refresh(self):
+        '''
+        objects are refreshed early more often the closer they are to
+        expiring and the longer they took to load
+        '''
+        redis = Redis()
+        data = {redis.EXPIRY_FIELD: 1000.0, redis.DELTA_FIELD: 2.0}
+
+        # Ten seconds out, only a draw of 1 - e^-5 or more refreshes
+        with mock.patch('f5.storage.time.time', return_value=990.0):
+            with mock.patch('f5.storage.random.random', return_value=0.99):
+                self.assertFalse(redis._is_stale(data))
+
+            with mock.patch('f5.storage.random.random', return_value=0.995):
+                self.assertTrue(redis._is_stale(data))
+                self.assertFalse(redis._is_stale({redis.EXPIRY_FIELD: 1000.0}))
+
+        with mock.patch('f5.storage.time.time', return_value=1000.0):
+            with mock.patch('f5.storage.random.random', return_value=0.0):
+                self.assertTrue(redis._is_stale(data))
+
+    @skipIf(fakeredis is None, 'fakeredis with Lua support is not installed')
+    def test_hash_keys_expire_with_the_object(self):
+        '''
+        a model's hash key and reverse mapping expire just before the
+        object, whatever the policy's TTL
+        '''
+        redis = MemoryRedis()
+        toy = LongLivedToy({'id': 7, 'name': 'top'})
+
+        with mock.patch('f5.storage.random.uniform', return_value=0.0):
+            redis.write_models([toy])
+
+        self.assertEqual(redis.client.ttl('toy:7'), 86400)
+        self.assertEqual(redis.client.ttl('toy:7:hash'), 86398)
+        self.assertEqual(redis.client.ttl(toy.hash), 86396)
+
+
+@skipIf(fakeredis is None, 'fakeredis with Lua support is not installed')
+class TestSetObjects(TestCase):
+
+    def test_large_lists_are_sent_in_chunks(self):
+        '''
+        the pipeline is executed after every chunk_size models and once more
+        for the rest, and every model is cached
+        '''
+        redis = MemoryRedis()
+        owners = [Owner({'id': i, 'name': str(i)}) for i in range(1, 8)]
+        pipeline = redis.client.pipeline
+        executed = []
+
+        def spy(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+
+            def counted(*args, **kwargs):
+                executed.append(len(pipe.command_stack))
+                return execute(*args, **kwargs)
+
+            pipe.execute = counted
+            return pipe
+
+        with mock.patch.object(redis.client, 'pipeline', side_effect=spy):
+            redis.set_objects(owners, chunk_size=3)
+
+        # A write and an expire for each model
+        self.assertEqual(executed, [6, 6, 2])
+        self.assertEqual([owner.id for owner in redis.get_objects(Owner, range(1, 8))],
+                         list(range(1, 8)))